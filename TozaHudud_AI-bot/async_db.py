@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from db_session import active_session, current_session
+from metrics import DB_ERRORS, DB_LATENCY
+from profile_cache import LRUSet, ProfileCache
+from query_log import current_caller, describe_caller
+
+logger = logging.getLogger(__name__)
+
+# Blocking backends never get more than this many queries in flight
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+# get_user_info cache: registered profiles and "not registered" answers
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_NEGATIVE_TTL = float(os.getenv("PROFILE_CACHE_NEGATIVE_TTL", "60"))
+
+# Functions every database backend module must provide
+API = (
+    "init_db",
+    "add_subscriber",
+    "touch_user",
+    "add_user",
+    "add_problem",
+    "update_problem_status",
+    "add_rating",
+    "add_feedback",
+    "get_stats",
+    "get_recent_problems",
+    "get_user_problems",
+    "get_recent_feedbacks",
+    "get_user_info",
+    "get_all_users",
+    "get_user_count",
+    "get_users_page",
+    "delete_user_completely",
+    "search_users",
+    "claim_notifications",
+    "mark_notification_sent",
+    "update_notification_payload",
+    "retry_notification",
+    "dead_letter_notification",
+    "requeue_dead_notifications",
+    "get_dead_notifications",
+    "outbox_stats",
+    "prune_notifications",
+    "create_broadcast",
+    "get_broadcast",
+    "set_broadcast_status",
+    "get_running_broadcasts",
+    "recover_broadcast",
+    "claim_broadcast_chunk",
+    "release_broadcast_recipients",
+    "record_broadcast_results",
+    "load_user_data",
+    "save_user_data",
+    "load_conversations",
+    "save_conversations",
+    "pool_stats",
+    "close_connections",
+)
+
+class AsyncDatabase:
+    """Awaitable facade over a database backend module.
+
+    Synchronous backends (database, database_pg) run on a bounded thread
+    pool so a slow query never blocks the event loop; coroutine functions
+    of a native async backend are awaited directly.
+
+    get_user_info is served from an in-process ProfileCache; add_user and
+    delete_user_completely invalidate the user's entry. touch_user skips
+    the subscriber write for users already known to be subscribed (up to
+    PROFILE_CACHE_SIZE of the most recent), and record_broadcast_results
+    forgets the subscribers it prunes.
+
+    Every backend call is timed into the tozahudud_db_call_* metrics, and
+    the code that made it is recorded for query_log's per-statement stats.
+    """
+
+    def __init__(self, backend, max_workers=DB_EXECUTOR_WORKERS):
+        self.backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        for name in API:
+            setattr(self, name, self._wrap(getattr(backend, name)))
+        
+        self.profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_CACHE_NEGATIVE_TTL)
+        # Same bound as the profile cache: one entry per recently active user
+        self.known_subscribers = LRUSet(PROFILE_CACHE_SIZE)
+        self._touch_user = self.touch_user
+        self.touch_user = self._cached_touch_user
+        self._get_user_info = self.get_user_info
+        self._add_user = self.add_user
+        self._delete_user_completely = self.delete_user_completely
+        self._record_broadcast_results = self.record_broadcast_results
+        self.get_user_info = self._cached_get_user_info
+        self.add_user = self._invalidating_add_user
+        self.delete_user_completely = self._invalidating_delete_user_completely
+        self.record_broadcast_results = self._unsubscribing_record_broadcast_results
+
+    def _wrap(self, func):
+        backend, name = self.backend.__name__, func.__name__
+        if inspect.iscoroutinefunction(func):
+            run = func
+        else:
+            async def run(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                # Carry the caller's context (and so its DB session) into the worker thread
+                ctx = contextvars.copy_context()
+                return await loop.run_in_executor(self._executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            session = active_session()
+            if session is not None:
+                # The call would run on another task's connection
+                session.check_owner()
+            started = time.perf_counter()
+            # The worker thread's stack ends at the executor; the caller is only known here
+            token = current_caller.set(describe_caller(sys._getframe(1), (__file__,)))
+            try:
+                return await run(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.labels(backend, name).inc()
+                raise
+            finally:
+                current_caller.reset(token)
+                DB_LATENCY.observe(time.perf_counter() - started, backend, name)
+
+        return call
+
+    @asynccontextmanager
+    async def session(self):
+        """Per-update unit of work: ``async with db.session(): ...``.
+
+        Database calls made inside share one lazily checked-out
+        connection, committed by commit() (before each Bot API request)
+        and on exit. Backends without sessions simply get per-call
+        connections.
+        """
+        open_session = getattr(self.backend, "open_session", None)
+        if open_session is None or active_session() is not None:
+            yield active_session()
+            return
+        session = open_session()
+        token = current_session.set(session)
+        try:
+            yield session
+        except BaseException:
+            session.failed = True
+            raise
+        finally:
+            current_session.reset(token)
+            self._run_callbacks(await self._end_session(session.close, session))
+
+    async def commit(self):
+        """Commits the current update's writes now and gives its connection back.
+
+        Called before every Bot API request, so no reply goes out for
+        writes that are not committed, and no connection or lock is held
+        while waiting for Telegram. Raises when the commit fails, or when
+        called from a task other than the one that opened the session.
+        """
+        session = active_session()
+        if session is not None:
+            session.check_owner()
+            self._run_callbacks(await self._end_session(session.commit, session))
+
+    async def _end_session(self, method, session):
+        if inspect.iscoroutinefunction(method):
+            return await method()
+        if not session.used:
+            return method()
+        # Default executor: the commit must not queue behind calls waiting for a connection
+        return await asyncio.get_running_loop().run_in_executor(None, method)
+
+    def _run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in DB session commit hook: {e}")
+
+    def after_commit(self, callback):
+        """Runs ``callback`` once the current session commits, or now without one."""
+        session = active_session()
+        if session is not None:
+            session.after_commit(callback)
+        else:
+            callback()
+
+    def _after_commit(self, callback):
+        """Runs ``callback`` now and, inside a session, again once it commits."""
+        callback()
+        session = active_session()
+        if session is not None:
+            session.after_commit(callback)
+
+    async def _cached_get_user_info(self, user_id):
+        found, user_info = self.profile_cache.get(user_id)
+        if found:
+            return user_info
+        generation = self.profile_cache.generation()
+        user_info = await self._get_user_info(user_id)
+        self.profile_cache.put(user_id, user_info, generation)
+        return user_info
+
+    async def _cached_touch_user(self, user_id):
+        if user_id in self.known_subscribers:
+            return await self.get_user_info(user_id)
+        generation = self.profile_cache.generation()
+        user_info = await self._touch_user(user_id)
+        self.after_commit(functools.partial(self.known_subscribers.add, user_id))
+        self.profile_cache.put(user_id, user_info, generation)
+        return user_info
+
+    async def _invalidating_add_user(self, user_id, name, phone):
+        try:
+            return await self._add_user(user_id, name, phone)
+        finally:
+            self._after_commit(functools.partial(self.profile_cache.invalidate, user_id))
+
+    async def _invalidating_delete_user_completely(self, user_id):
+        try:
+            return await self._delete_user_completely(user_id)
+        finally:
+            self.known_subscribers.discard(user_id)
+            self._after_commit(functools.partial(self.profile_cache.invalidate, user_id))
+
+    async def _unsubscribing_record_broadcast_results(self, broadcast_id, sent_ids, failed_ids, blocked_ids):
+        try:
+            return await self._record_broadcast_results(broadcast_id, sent_ids, failed_ids, blocked_ids)
+        finally:
+            # Blocked users were removed from subscribers; /start must add them back
+            self.known_subscribers.difference_update(blocked_ids)
+
+    async def close(self):
+        """Closes backend connections and stops the worker threads."""
+        try:
+            await self.close_connections()
+        except Exception as e:
+            logger.error(f"Error closing database connections: {e}")
+        self._executor.shutdown(wait=True)
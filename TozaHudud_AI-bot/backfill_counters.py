@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Hisoblagichlarni qayta hisoblash.
+
+Har bir foydalanuvchining murojaat/fikr/reyting sonlarini va umumiy
+hisoblagichlarni jadvallardan qaytadan hisoblaydi. Migratsiya buni bir
+marta o'zi bajaradi; bu buyruq ma'lumotlar qo'lda o'zgartirilganda
+(masalan, trigger'larsiz import) kerak bo'ladi.
+
+    python backfill_counters.py
+"""
+
+import asyncio
+import inspect
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+if os.getenv("DATABASE_URL"):
+    if os.getenv("DB_DRIVER", "").lower() == "asyncpg":
+        import database_asyncpg as database
+    else:
+        import database_pg as database
+else:
+    import database
+
+async def main():
+    print("🔄 Hisoblagichlar qayta hisoblanmoqda...")
+    await _call(database.init_db)
+    updated = await _call(database.backfill_counters)
+    print(f"✅ {updated} ta foydalanuvchi yangilandi")
+    await _call(database.close_connections)
+
+async def _call(func):
+    result = func()
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+SQLite ulanish boshqaruvchisi uchun benchmark.
+
+Eski usul (har bir chaqiruvda sqlite3.connect) va database.py dagi
+doimiy, sozlangan ulanishlar (va group commit navbati)
+o'tkazuvchanligini solishtiradi.
+
+    python benchmark_db.py --ops 5000 --threads 4
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import database
+
+LEGACY_DB = None
+
+def legacy_get_user_info(user_id):
+    conn = sqlite3.connect(LEGACY_DB)
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, phone FROM users WHERE user_id = ?', (user_id,))
+    user_info = cursor.fetchone()
+    conn.close()
+    return user_info
+
+def legacy_get_user_problems(user_id, limit=5):
+    conn = sqlite3.connect(LEGACY_DB)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT description, status, created_at
+        FROM problems
+        WHERE user_id = ?
+        ORDER BY created_at DESC
+        LIMIT ?
+    ''', (user_id, limit))
+    problems = cursor.fetchall()
+    conn.close()
+    return problems
+
+def legacy_add_rating(user_id, rating):
+    conn = sqlite3.connect(LEGACY_DB)
+    cursor = conn.cursor()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute('''
+        INSERT INTO ratings (user_id, rating, created_at)
+        VALUES (?, ?, ?)
+    ''', (user_id, rating, now))
+    conn.commit()
+    conn.close()
+
+LEGACY = (legacy_get_user_info, legacy_get_user_problems, legacy_add_rating)
+POOLED = (database.get_user_info, database.get_user_problems, database.add_rating)
+
+def seed(path, users):
+    """Creates the schema in a fresh file and fills it with demo rows."""
+    database.DB_NAME = path
+    database.init_db()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with database.connection() as conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, name, phone, created_at) VALUES (?, ?, ?, ?)',
+            [(i, f"User {i}", f"+99890{i:07d}", now) for i in range(1, users + 1)],
+        )
+        conn.executemany(
+            'INSERT INTO problems (user_id, description, media_type, status, created_at) VALUES (?, ?, ?, ?, ?)',
+            [(i % users + 1, f"Muammo {i}", "Rasm", "Kutilmoqda", now) for i in range(users * 3)],
+        )
+    database.close_connections()
+
+def run_mixed(funcs, ops, users):
+    """Single caller: 80% reads, 20% writes. Returns ops/sec."""
+    get_user_info, get_user_problems, add_rating = funcs
+    start = time.perf_counter()
+    for i in range(ops):
+        user_id = i % users + 1
+        if i % 5 == 4:
+            add_rating(user_id, i % 5 + 1)
+        elif i % 2:
+            get_user_info(user_id)
+        else:
+            get_user_problems(user_id)
+    database.flush_writes()
+    return ops / (time.perf_counter() - start)
+
+def run_write_burst(add_rating, ops, users):
+    """Back-to-back rating inserts, as during a busy morning. Returns ops/sec."""
+    start = time.perf_counter()
+    for i in range(ops):
+        add_rating(i % users + 1, 5)
+    database.flush_writes()
+    return ops / (time.perf_counter() - start)
+
+def run_concurrent(funcs, ops, users, threads):
+    """One writer thread plus N reader threads. Returns (read ops/sec, write ops/sec)."""
+    get_user_info, get_user_problems, add_rating = funcs
+    reads = [0] * threads
+    writes = [0]
+    errors = []
+    stop = threading.Event()
+
+    def reader(slot):
+        i = slot
+        while not stop.is_set():
+            try:
+                get_user_problems(i % users + 1)
+                reads[slot] += 1
+            except sqlite3.Error as e:
+                errors.append(e)
+            i += threads
+
+    def writer():
+        for i in range(ops // 5):
+            try:
+                add_rating(i % users + 1, 5)
+                writes[0] += 1
+            except sqlite3.Error as e:
+                errors.append(e)
+        database.flush_writes()
+        stop.set()
+
+    workers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    writer()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"   ⚠️ {len(errors)} ta xatolik (masalan: {errors[0]})")
+    return sum(reads) / elapsed, writes[0] / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    global LEGACY_DB
+    database.SQLITE_POOL_SIZE = max(database.SQLITE_POOL_SIZE, args.threads + 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.STATS_FILE = os.path.join(tmp, "stats.json")
+        legacy_path = os.path.join(tmp, "legacy.db")
+        pooled_path = os.path.join(tmp, "pooled.db")
+
+        # Eski baza WAL'siz (rollback journal) bo'lishi kerak
+        seed(legacy_path, args.users)
+        conn = sqlite3.connect(legacy_path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        LEGACY_DB = legacy_path
+
+        seed(pooled_path, args.users)
+        database.DB_NAME = pooled_path
+
+        print("=" * 50)
+        print(f"Aralash yuklama ({args.ops} ta amal, bitta oqim):")
+        legacy_rate = run_mixed(LEGACY, args.ops, args.users)
+        pooled_rate = run_mixed(POOLED, args.ops, args.users)
+        print(f"   - Eski (connect/close): {legacy_rate:10.0f} amal/s")
+        print(f"   - Yangi (pool + WAL):   {pooled_rate:10.0f} amal/s")
+        print(f"   - Tezlashish:           {pooled_rate / legacy_rate:10.1f}x")
+
+        print(f"\nYozuvlar to'lqini ({args.ops} ta reyting):")
+        legacy_rate = run_write_burst(legacy_add_rating, args.ops, args.users)
+        pooled_rate = run_write_burst(database.add_rating, args.ops, args.users)
+        print(f"   - Eski (har biri commit):  {legacy_rate:10.0f} amal/s")
+        print(f"   - Yangi (group commit):    {pooled_rate:10.0f} amal/s")
+
+        print(f"\n1 ta yozuvchi + {args.threads} ta o'quvchi oqim:")
+        legacy_reads, legacy_writes = run_concurrent(LEGACY, args.ops, args.users, args.threads)
+        pooled_reads, pooled_writes = run_concurrent(POOLED, args.ops, args.users, args.threads)
+        print(f"   - Eski:  o'qish {legacy_reads:10.0f}/s, yozish {legacy_writes:8.0f}/s")
+        print(f"   - Yangi: o'qish {pooled_reads:10.0f}/s, yozish {pooled_writes:8.0f}/s")
+        print("=" * 50)
+
+        database.close_connections()
+
+if __name__ == "__main__":
+    main()
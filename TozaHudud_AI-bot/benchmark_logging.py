@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Har bir yangilanish uchun log yozish narxi benchmarki.
+
+Bitta yangilanishda bot yozadigan loglar (handler INFO/DEBUG, ma'lumotlar
+bazasi DEBUG, httpx so'rov qatorlari) takrorlanadi va chaqiruvchi oqimda
+(ya'ni event loop'da) o'tgan vaqt o'lchanadi. --stall-ms bilan diskning
+vaqti-vaqti bilan qotib qolishi taqlid qilinadi.
+
+    python benchmark_logging.py --updates 10000 --rate 1000 --stall-ms 50
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import log_config
+
+USER_ID = 123456789
+TEXT = "🗑 Chiqindi bor"
+API_URL = "https://api.telegram.org/bot"
+
+class StallingFileHandler(logging.FileHandler):
+    """A file on a disk that stalls for ``stall`` seconds every ``every`` records."""
+
+    def __init__(self, filename, stall, every=500):
+        super().__init__(filename, encoding="utf-8")
+        self.stall = stall
+        self.every = every
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+        if self.stall and self.count % self.every == 0:
+            time.sleep(self.stall)
+        super().emit(record)
+
+def update_eager(bot_log, db_log, http_log):
+    """The log calls of one update as they were: f-strings, formatted even when disabled."""
+    bot_log.info(f"🎯 Menu button pressed by user {USER_ID}: {TEXT}")
+    bot_log.debug(f"🧹 Auto chat clean completed for user {USER_ID}")
+    bot_log.info(f"🗑 Problem report started by user {USER_ID}")
+    db_log.debug(f"🔍 Getting user info for {USER_ID}")
+    db_log.debug(f"✅ User info found for {USER_ID}: Test User")
+    http_log.info(f'HTTP Request: POST {API_URL}/sendMessage "HTTP/1.1 200 OK"')
+    http_log.info(f'HTTP Request: POST {API_URL}/getUpdates "HTTP/1.1 200 OK"')
+
+def update_lazy(bot_log, db_log, http_log):
+    """The same calls with %-style arguments, as httpx and the bot now log."""
+    bot_log.info("🎯 Menu button pressed by user %s: %s", USER_ID, TEXT)
+    bot_log.debug("🧹 Auto chat clean completed for user %s", USER_ID)
+    bot_log.info("🗑 Problem report started by user %s", USER_ID)
+    db_log.debug("🔍 Getting user info for %s", USER_ID)
+    db_log.debug("✅ User info found for %s: %s", USER_ID, "Test User")
+    http_log.info('HTTP Request: %s %s "%s %d %s"', "POST", f"{API_URL}/sendMessage", "HTTP/1.1", 200, "OK")
+    http_log.info('HTTP Request: %s %s "%s %d %s"', "POST", f"{API_URL}/getUpdates", "HTTP/1.1", 200, "OK")
+
+def setup_sync(path, stall, devnull):
+    """The old setup: FileHandler and StreamHandler called on the event loop."""
+    log_config.stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers:
+        handler.close()
+    formatter = logging.Formatter(log_config.TEXT_FORMAT)
+    handlers = [logging.StreamHandler(devnull), StallingFileHandler(path, stall)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    root.handlers[:] = handlers
+    root.setLevel(logging.INFO)
+
+def setup_queued(path, stall, devnull, fmt, sampling):
+    log_config.setup_logging("INFO", log_file="", fmt=fmt, sampling=sampling, stream=devnull, slow_query_file="")
+    # The writer thread's file, stalling like the synchronous one
+    file_handler = StallingFileHandler(path, stall)
+    file_handler.setFormatter(log_config._listener.handlers[0].formatter)
+    log_config._listener.handlers += (file_handler,)
+
+def run(name, simulate, updates, rate):
+    loggers = (logging.getLogger("__main__"), logging.getLogger("database"), logging.getLogger("httpx"))
+    timings = []
+    start = time.perf_counter()
+    for number in range(updates):
+        delay = start + number / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        started = time.perf_counter()
+        simulate(*loggers)
+        timings.append(time.perf_counter() - started)
+    queued = log_config._listener is not None
+    log_config.stop_logging()
+    timings = sorted(t * 1_000_000 for t in timings)
+    quantiles = statistics.quantiles(timings, n=100)
+    print(f"{name}:")
+    print(f"   - o'rtacha: {statistics.fmean(timings):8.1f} µs   p50: {quantiles[49]:8.1f} µs   "
+          f"p99: {quantiles[98]:8.1f} µs   max: {timings[-1] / 1000:8.2f} ms")
+    if queued:
+        stats = log_config.logging_stats()
+        print(f"   - navbat to'lganda tashlangan: {stats['dropped']}, sampling: {stats['sampled_out']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=1000, help="yangilanishlar soni sekundiga")
+    parser.add_argument("--stall-ms", type=float, default=50, help="har 500 yozuvda diskning qotishi")
+    args = parser.parse_args()
+    stall = args.stall_ms / 1000
+
+    print("=" * 50)
+    print(f"{args.updates} ta yangilanish, {args.rate:.0f}/s, disk har 500 yozuvda {args.stall_ms:.0f} ms qotadi\n")
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w", encoding="utf-8") as devnull:
+        path = os.path.join(tmp, "bot.log")
+        scenarios = (
+            ("Eski: sinxron FileHandler, f-string", lambda: setup_sync(path, stall, devnull), update_eager),
+            ("Navbat, %-format", lambda: setup_queued(path, stall, devnull, "text", ""), update_lazy),
+            ("Navbat, %-format, JSON", lambda: setup_queued(path, stall, devnull, "json", ""), update_lazy),
+            ("Navbat, %-format, httpx=0.1", lambda: setup_queued(path, stall, devnull, "text", "httpx=0.1"), update_lazy),
+        )
+        for name, setup, simulate in scenarios:
+            setup()
+            run(name, simulate, args.updates, args.rate)
+        logging.getLogger().handlers.clear()
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Webhook va long polling uchun kechikish benchmarki.
+
+Telegram Bot API o'rniga mahalliy soxta server ishga tushiriladi. U
+yangilanishlarni (getUpdates orqali yoki webhook'ga POST qilib) beradi va
+bot javobi (sendMessage) kelguncha o'tgan vaqtni o'lchaydi.
+
+    python benchmark_webhook.py --updates 2000 --rate 200 --users 100
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import statistics
+import time
+from urllib.parse import parse_qs
+
+import httpx
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+from webhook_server import HttpServer, run_webhook
+
+TOKEN = "123456:benchmark"
+SECRET = "benchmark-secret"
+
+class FakeTelegram:
+    """Just enough of the Bot API for the benchmark: getMe, getUpdates, setWebhook, sendMessage."""
+
+    def __init__(self):
+        self.server = HttpServer("127.0.0.1", 0)
+        self.server.route("POST", f"/bot{TOKEN}/getMe", self.get_me)
+        self.server.route("POST", f"/bot{TOKEN}/getUpdates", self.get_updates)
+        self.server.route("POST", f"/bot{TOKEN}/deleteWebhook", self.ok)
+        self.server.route("POST", f"/bot{TOKEN}/setWebhook", self.set_webhook)
+        self.server.route("POST", f"/bot{TOKEN}/sendMessage", self.send_message)
+        self.pending = []
+        self.available = asyncio.Event()
+        self.webhook = None
+        self.webhook_set = False
+        self.polled = False
+        self.client = None
+        self.sent_at = {}  # update text -> time the update was produced
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.next_message_id = 1
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.port}/bot"
+
+    @staticmethod
+    def params(request):
+        return {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+
+    @staticmethod
+    def reply(result):
+        return 200, json.dumps({"ok": True, "result": result}).encode(), "application/json"
+
+    async def ok(self, request):
+        return self.reply(True)
+
+    async def get_me(self, request):
+        return self.reply({"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"})
+
+    async def set_webhook(self, request):
+        self.webhook_set = True
+        return self.reply(True)
+
+    async def get_updates(self, request):
+        self.polled = True
+        params = self.params(request)
+        offset = int(params.get("offset", 0))
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self.available.clear()
+            try:
+                await asyncio.wait_for(self.available.wait(), float(params.get("timeout", 0)) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return self.reply(self.pending[:100])
+
+    async def send_message(self, request):
+        params = self.params(request)
+        text = params["text"]
+        started = self.sent_at.pop(text, None)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+            if len(self.latencies) == self.expected:
+                self.done.set()
+        chat_id = int(params["chat_id"])
+        self.next_message_id += 1
+        return self.reply({
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        })
+
+    def make_update(self, update_id, user_id):
+        text = f"ping {update_id}"
+        self.sent_at[text] = time.perf_counter()
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+                "text": text,
+            },
+        }
+
+    async def deliver(self, update):
+        if self.webhook:
+            await self.client.post(
+                self.webhook, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+            )
+        else:
+            self.pending.append(update)
+            self.available.set()
+
+    async def wait_for_bot(self, mode):
+        """Waits until the bot polls or has set its webhook."""
+        while not (self.webhook_set if mode == "webhook" else self.polled):
+            await asyncio.sleep(0.01)
+
+async def produce(fake, updates, rate, users):
+    """Emits ``updates`` updates at ``rate`` per second from ``users`` users."""
+    start = time.perf_counter()
+    tasks = []
+    for update_id in range(1, updates + 1):
+        delay = start + update_id / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(fake.deliver(fake.make_update(update_id, 1000 + update_id % users))))
+    await asyncio.gather(*tasks)
+
+async def run_fake_telegram(mode, updates, rate, users, pipe):
+    fake = FakeTelegram()
+    fake.expected = updates
+    await fake.server.start()
+    pipe.send(fake.server.port)
+    fake.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=40))
+    try:
+        if mode == "webhook":
+            bot_port = await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+            fake.webhook = f"http://127.0.0.1:{bot_port}/telegram"
+        await fake.wait_for_bot(mode)
+        started = time.perf_counter()
+        await produce(fake, updates, rate, users)
+        await asyncio.wait_for(fake.done.wait(), 60)
+        pipe.send((fake.latencies, time.perf_counter() - started))
+        # Keep answering until the bot has shut down
+        await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+    finally:
+        # Release a long poll still waiting on the fake server
+        fake.available.set()
+        await asyncio.sleep(0)
+        await fake.client.aclose()
+        await fake.server.stop()
+
+def fake_telegram_process(mode, updates, rate, users, pipe):
+    asyncio.run(run_fake_telegram(mode, updates, rate, users, pipe))
+
+async def echo(update, context):
+    await update.message.reply_text(update.message.text)
+
+async def run_bot(mode, api_port, pipe):
+    """Runs an echo bot against the fake API until it has all the replies."""
+    application = (
+        ApplicationBuilder().token(TOKEN).base_url(f"http://127.0.0.1:{api_port}/bot").build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, echo))
+    loop = asyncio.get_running_loop()
+    result = loop.run_in_executor(None, pipe.recv)
+    if mode == "polling":
+        async with application:
+            await application.start()
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+            latencies = await result
+            await application.updater.stop()
+            await application.stop()
+    else:
+        stop = asyncio.Event()
+        server = HttpServer("127.0.0.1", 0)
+        runner = asyncio.create_task(run_webhook(
+            application, "http://127.0.0.1/telegram", secret_token=SECRET, server=server, stop=stop
+        ))
+        while server.port == 0:
+            await asyncio.sleep(0.01)
+        # The bot listens on a random port: tell the fake API where to post
+        pipe.send(server.port)
+        latencies = await result
+        stop.set()
+        await runner
+    pipe.send("stop")
+    return latencies
+
+def run_mode(mode, updates, rate, users):
+    """Runs the fake API in its own process, so it does not share the bot's event loop."""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=fake_telegram_process, args=(mode, updates, rate, users, child))
+    process.start()
+    api_port = parent.recv()
+    latencies, elapsed = asyncio.run(run_bot(mode, api_port, parent))
+    process.join()
+    return latencies, elapsed
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latency * 1000 for latency in latencies)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{name}:")
+    print(f"   - Javoblar:  {len(latencies)} ta, {len(latencies) / elapsed:8.0f} javob/s")
+    print(f"   - p50: {quantiles[49]:8.2f} ms   p95: {quantiles[94]:8.2f} ms   "
+          f"p99: {quantiles[98]:8.2f} ms   max: {latencies[-1]:8.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="yangilanishlar soni sekundiga")
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print(f"{args.updates} ta yangilanish, {args.rate:.0f}/s, {args.users} ta foydalanuvchi\n")
+    for mode in ("polling", "webhook"):
+        latencies, elapsed = run_mode(mode, args.updates, args.rate, args.users)
+        report("Long polling" if mode == "polling" else "Webhook", latencies, elapsed)
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,26 @@ import os
 import logging
 import asyncio
 import sys
+import time
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BotCommand
+from telegram import (
+    Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BotCommand,
+    InlineKeyboardButton, InlineKeyboardMarkup, Message,
+)
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    CallbackContext,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     filters,
     ConversationHandler,
     ContextTypes,
+    ExtBot,
+    TypeHandler,
 )
+from telegram.error import BadRequest
 
 # Load env early so database backend selection can use DATABASE_URL.
 load_dotenv()
@@ -19,14 +29,72 @@ load_dotenv()
 DB_BACKEND = "sqlite"
 if os.getenv("DATABASE_URL"):
     try:
-        import database_pg as database
-        DB_BACKEND = "postgres"
+        if os.getenv("DB_DRIVER", "").lower() == "asyncpg":
+            import database_asyncpg as database
+            DB_BACKEND = "postgres-asyncpg"
+        else:
+            import database_pg as database
+            DB_BACKEND = "postgres"
     except Exception:
         import database
         DB_BACKEND = "sqlite-fallback"
 else:
     import database
 
+from async_db import AsyncDatabase
+from broadcast import BroadcastEngine, estimate_duration, format_duration
+from db_session import active_session, detached
+from log_config import logging_stats, setup_logging
+import metrics
+from metrics import METRICS_PORT, REGISTRY, instrument_handlers, metrics_server
+from message_tracker import MessageTracker
+from notifications import OutboxWorker
+from persistence import DatabasePersistence
+import query_log
+from rate_limiter import PRIORITY_CLEANUP, PriorityRateLimiter
+from update_processor import KeyedUpdateProcessor
+from user_state import UserState, user_data_size
+from webhook_server import UPDATE_QUEUE_SIZE, WEBHOOK_URL, run_webhook
+
+# Every handler goes through this async facade so DB latency never blocks the event loop
+db = AsyncDatabase(database)
+# Admin notifications are written to the outbox with the report and sent from here
+outbox = OutboxWorker(db)
+broadcasts = BroadcastEngine(db)
+# user_data and conversation states survive restarts
+persistence = DatabasePersistence(db)
+
+class BotContext(CallbackContext):
+    """Callback context that exposes the DB session of the current update."""
+
+    @property
+    def db_session(self):
+        return active_session()
+
+class BotApplication(Application):
+    """Handles every update inside a lazy DB session; TrackingBot commits it before each Bot API request."""
+
+    async def process_update(self, update):
+        started = time.perf_counter()
+        try:
+            async with db.session():
+                await super().process_update(update)
+        finally:
+            metrics.UPDATE_LATENCY.observe(time.perf_counter() - started)
+
+    def create_task(self, coroutine, update=None, *, name=None):
+        # Tasks started while handling an update (block=False handlers, auto_clean_chat,
+        # error handlers) get no session: it belongs to the update's own task
+        return super().create_task(detached(coroutine), update=update, name=name)
+
+    async def update_persistence(self):
+        # PTB stages the changes into the persistence; write them out in one batch
+        await super().update_persistence()
+        if self.persistence:
+            # Idle users leave memory; PTB's drop_user_data would delete their stored data too
+            self.persistence.evict(self._user_data)
+            await self.persistence.flush()
+
 # Fix for Windows asyncio policy - Python 3.14 compatible
 if sys.platform == 'win32':
     try:
@@ -38,19 +106,58 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID_RAW = os.getenv("ADMIN_ID", "")
 ADMIN_IDS = [int(i.strip()) for i in ADMIN_ID_RAW.split(",") if i.strip()]
 
-# Enable logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+# Enable logging: records are written by a background thread, so disk stalls never block replies
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Admin paneldagi foydalanuvchilar ro'yxati sahifasi
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "10"))
+# Qidiruvda ko'rsatiladigan eng mos natijalar soni
+SEARCH_RESULTS_LIMIT = 5
+
+# Chat tozalash uchun har bir chatda eslab qolinadigan xabarlar soni
+MESSAGE_TRACKER_SIZE = int(os.getenv("MESSAGE_TRACKER_SIZE", "100"))
+MESSAGE_TRACKER_MAX_CHATS = int(os.getenv("MESSAGE_TRACKER_MAX_CHATS", "10000"))
+# Telegram deleteMessages bir chaqiruvda ko'pi bilan 100 ta xabarni o'chiradi
+DELETE_MESSAGES_BATCH = 100
+
+message_tracker = MessageTracker(MESSAGE_TRACKER_SIZE, MESSAGE_TRACKER_MAX_CHATS)
+
+# Every Bot API call is throttled here: replies first, then admin notifications, cleanup, broadcasts
+rate_limiter = PriorityRateLimiter()
+# Different users' updates run concurrently, each user's in order
+update_processor = KeyedUpdateProcessor()
+
+def message_key(update):
+    """Identifies the user's message, the same when Telegram delivers the update again."""
+    return f"{update.effective_chat.id}:{update.effective_message.message_id}"
+
+class TrackingBot(ExtBot):
+    """Bot that remembers the IDs of the messages it sends, for auto_clean_chat.
+
+    Before every request the current update's writes are committed and its
+    connection returned: a reply never confirms writes that may still fail,
+    and no lock or connection is held while waiting for Telegram.
+    """
+
+    async def _post(self, *args, **kwargs):
+        await db.commit()
+        return await super()._post(*args, **kwargs)
+
+    async def _send_message(self, *args, **kwargs):
+        result = await super()._send_message(*args, **kwargs)
+        if isinstance(result, Message):
+            message_tracker.add(result.chat_id, result.message_id)
+        return result
+
 # States for ConversationHandler
-NAME, PHONE, MENU, MUAMMO, MEDIA, LOCATION, RATING, ADMIN_MENU, FEEDBACK, USER_MANAGEMENT, USER_DELETE_CONFIRM = range(11)
+NAME, PHONE, MENU, MUAMMO, MEDIA, LOCATION, RATING, ADMIN_MENU, FEEDBACK, USER_MANAGEMENT, USER_DELETE_CONFIRM, BROADCAST_TEXT = range(12)
+# /metrics'dagi holat nomlari
+STATE_NAMES = {
+    NAME: "name", PHONE: "phone", MENU: "menu", MUAMMO: "muammo", MEDIA: "media", LOCATION: "location",
+    RATING: "rating", ADMIN_MENU: "admin_menu", FEEDBACK: "feedback", USER_MANAGEMENT: "user_management",
+    USER_DELETE_CONFIRM: "user_delete_confirm", BROADCAST_TEXT: "broadcast_text",
+}
 
 def get_main_menu_keyboard():
     """Returns the main menu keyboard."""
@@ -65,21 +172,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user for their name."""
     try:
         user_id = update.effective_user.id
-        logger.info(f"🚀 Start command received from user {user_id}")
+        logger.info("🚀 Start command received from user %s", user_id)
         
-        # Track subscriber
-        database.add_subscriber(user_id)
-        logger.debug(f"📊 Subscriber added/updated: {user_id}")
-        
-        # Foydalanuvchi allaqachon ro'yxatdan o'tganmi tekshirish
-        user_info = database.get_user_info(user_id)
-        logger.debug(f"👤 User info check for {user_id}: {user_info is not None}")
+        # Obunachini qayd etish va ro'yxatdan o'tganmi tekshirish (bitta so'rov)
+        user_info = await db.touch_user(user_id)
+        logger.debug("👤 User info check for %s: %s", user_id, user_info is not None)
         
         if user_info:
             # Agar ro'yxatdan o'tgan bo'lsa, context'ni yangilash va menyuga o'tish
             context.user_data["name"] = user_info[0]
             context.user_data["phone"] = user_info[1]
-            logger.info(f"✅ Returning user: {user_info[0]} ({user_id})")
+            logger.info("✅ Returning user: %s (%s)", user_info[0], user_id)
             
             reply_markup = get_main_menu_keyboard()
             await update.message.reply_text(
@@ -90,7 +193,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return MENU
         
         # Agar ro'yxatdan o'tmagan bo'lsa, ro'yxatdan o'tishni boshlash
-        logger.info(f"🆕 New user registration started: {user_id}")
+        logger.info("🆕 New user registration started: %s", user_id)
         await update.message.reply_text(
             "Assalomu alaykum! TozaHudud botiga xush kelibsiz.\n\n"
             "Ro'yxatdan o'tish uchun iltimos, F.I.SH (Familiya Ism)ingizni kiriting:",
@@ -106,25 +209,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return ConversationHandler.END
 
+async def track_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remembers incoming message IDs for auto_clean_chat."""
+    if update.message:
+        message_tracker.add(update.message.chat_id, update.message.message_id)
+
 async def auto_clean_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Automatically cleans the chat by deleting previous messages."""
+    """Deletes the chat's earlier messages in the background, without delaying the reply."""
     chat_id = update.effective_chat.id
-    message_id = update.message.message_id
-    
-    # So'nggi 20 ta xabarni o'chirishga harakat qilish (tezroq ishlashi uchun)
-    deleted_count = 0
-    failed_count = 0
-    
-    # Joriy xabardan boshlab orqaga qarab xabarlarni o'chirish
-    for i in range(message_id - 1, max(1, message_id - 20), -1):
+    # Faqat joriy xabardan oldingi, bizga ma'lum xabarlar o'chiriladi
+    message_ids = message_tracker.pop_older_than(chat_id, update.message.message_id)
+    if message_ids:
+        context.application.create_task(delete_messages(context.bot, chat_id, message_ids))
+
+async def delete_messages(bot, chat_id, message_ids) -> None:
+    """Bulk-deletes messages with deleteMessages, up to 100 IDs per call."""
+    for start in range(0, len(message_ids), DELETE_MESSAGES_BATCH):
+        batch = message_ids[start:start + DELETE_MESSAGES_BATCH]
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=i)
-            deleted_count += 1
-        except Exception:
-            failed_count += 1
-            # Agar ketma-ket 5 ta xabar o'chirilmasa, to'xtatish
-            if failed_count > 5:
-                break
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch, rate_limit_args=PRIORITY_CLEANUP)
+        except Exception as e:
+            logger.debug("🧹 Could not delete %s messages in chat %s: %s", len(batch), chat_id, e)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows help information."""
@@ -151,7 +256,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     # Foydalanuvchi ro'yxatdan o'tganmi tekshirish
-    user_info = database.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     if not user_info:
         await update.message.reply_text(
             "Avval ro'yxatdan o'ting: /start"
@@ -179,7 +284,7 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     
     # Foydalanuvchi ro'yxatdan o'tganmi tekshirish
-    user_info = database.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     if not user_info:
         await update.message.reply_text(
             "Avval ro'yxatdan o'ting: /start"
@@ -203,7 +308,7 @@ async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = update.effective_user.id
     
     # Foydalanuvchi ro'yxatdan o'tganmi tekshirish
-    user_info = database.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     if not user_info:
         await update.message.reply_text(
             "Avval ro'yxatdan o'ting: /start"
@@ -229,7 +334,7 @@ async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         user_name = update.message.text
         user_id = update.effective_user.id
-        logger.info(f"📝 Name received from user {user_id}: {user_name}")
+        logger.info("📝 Name received from user %s: %s", user_id, user_name)
         
         context.user_data["name"] = user_name
         
@@ -243,7 +348,7 @@ async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             "Endi, iltimos, telefon raqamingizni yuboring (pastdagi tugmani bosing):",
             reply_markup=reply_markup,
         )
-        logger.debug(f"✅ Name stored and phone request sent to user {user_id}")
+        logger.debug("✅ Name stored and phone request sent to user %s", user_id)
         return PHONE
         
     except Exception as e:
@@ -258,10 +363,10 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the phone number and shows the main menu."""
     try:
         user_id = update.effective_user.id
-        logger.info(f"📞 Phone request received from user {user_id}")
+        logger.info("📞 Phone request received from user %s", user_id)
         
         if update.message.text == "⬅️ Orqaga":
-            logger.debug(f"🔙 User {user_id} went back to name input")
+            logger.debug("🔙 User %s went back to name input", user_id)
             await update.message.reply_text(
                 "F.I.SH (Familiya Ism)ingizni qaytadan kiriting:",
                 reply_markup=ReplyKeyboardRemove(),
@@ -276,12 +381,12 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
         phone_number = contact.phone_number
         context.user_data["phone"] = phone_number
-        logger.info(f"✅ Phone number received from user {user_id}: {phone_number}")
+        logger.info("✅ Phone number received from user %s: %s", user_id, phone_number)
         
         # Save user to database
         try:
-            database.add_user(user_id, context.user_data["name"], phone_number)
-            logger.info(f"💾 User saved to database: {context.user_data['name']} ({user_id})")
+            await db.add_user(user_id, context.user_data["name"], phone_number)
+            logger.info("💾 User saved to database: %s (%s)", context.user_data['name'], user_id)
         except Exception as db_error:
             logger.error(f"❌ Database error saving user {user_id}: {db_error}")
             await update.message.reply_text(
@@ -319,7 +424,7 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             reply_markup=reply_markup,
         )
         
-        logger.info(f"🎉 User registration completed: {context.user_data['name']} ({user_id})")
+        logger.info("🎉 User registration completed: %s (%s)", context.user_data['name'], user_id)
         return MENU
         
     except Exception as e:
@@ -335,17 +440,17 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     try:
         text = update.message.text
         user_id = update.effective_user.id
-        logger.info(f"🎯 Menu button pressed by user {user_id}: {text}")
+        logger.info("🎯 Menu button pressed by user %s: %s", user_id, text)
         
         # Har qanday tugma bosilganda avtomatik chat tozalash
         try:
             await auto_clean_chat(update, context)
-            logger.debug(f"🧹 Auto chat clean completed for user {user_id}")
+            logger.debug("🧹 Auto chat clean completed for user %s", user_id)
         except Exception as clean_error:
             logger.warning(f"⚠️ Auto chat clean failed for user {user_id}: {clean_error}")
         
         if text == "🗑 Chiqindi bor":
-            logger.info(f"🗑 Problem report started by user {user_id}")
+            logger.info("🗑 Problem report started by user %s", user_id)
             # Foydalanuvchi ma'lumotlarini tekshirish
             user_name = context.user_data.get("name")
             phone_number = context.user_data.get("phone")
@@ -353,13 +458,13 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             # Agar context'da yo'q bo'lsa, database'dan olish
             if not user_name or not phone_number:
                 try:
-                    user_info = database.get_user_info(user_id)
+                    user_info = await db.get_user_info(user_id)
                     if user_info:
                         user_name = user_info[0]
                         phone_number = user_info[1]
                         context.user_data["name"] = user_name
                         context.user_data["phone"] = phone_number
-                        logger.debug(f"👤 User info loaded from database for {user_id}")
+                        logger.debug("👤 User info loaded from database for %s", user_id)
                     else:
                         logger.error(f"❌ User info not found in database for {user_id}")
                         await update.message.reply_text(
@@ -383,9 +488,9 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             return MUAMMO
             
         elif text == "🔍 Holatni tekshirish":
-            logger.info(f"🔍 Status check requested by user {user_id}")
+            logger.info("🔍 Status check requested by user %s", user_id)
             try:
-                problems = database.get_user_problems(user_id)
+                problems = await db.get_user_problems(user_id)
                 
                 if not problems:
                     await update.message.reply_text(
@@ -405,7 +510,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
                         response_text,
                         reply_markup=get_main_menu_keyboard()
                     )
-                logger.debug(f"✅ Status check completed for user {user_id}: {len(problems)} problems")
+                logger.debug("✅ Status check completed for user %s: %s problems", user_id, len(problems))
             except Exception as db_error:
                 logger.error(f"❌ Database error getting problems for user {user_id}: {db_error}")
                 await update.message.reply_text(
@@ -415,7 +520,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             return MENU
             
         elif text == "⭐ Baholash":
-            logger.info(f"⭐ Rating started by user {user_id}")
+            logger.info("⭐ Rating started by user %s", user_id)
             rating_buttons = [[KeyboardButton(text=str(i)) for i in range(1, 6)], [KeyboardButton(text="⬅️ Orqaga")]]
             reply_markup = ReplyKeyboardMarkup(rating_buttons, resize_keyboard=True)
             await update.message.reply_text(
@@ -425,7 +530,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             return RATING
             
         elif text == "💬 Fikr bildirish":
-            logger.info(f"💬 Feedback started by user {user_id}")
+            logger.info("💬 Feedback started by user %s", user_id)
             reply_markup = ReplyKeyboardMarkup([[KeyboardButton(text="⬅️ Orqaga")]], resize_keyboard=True)
             await update.message.reply_text(
                 "Iltimos, o'z fikr-mulohazalaringizni yozib qoldiring:",
@@ -434,7 +539,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             return FEEDBACK
             
         elif text == "🚪 Chiqish" and update.effective_user.id in ADMIN_IDS:
-            logger.info(f"🚪 Admin {user_id} exiting admin panel")
+            logger.info("🚪 Admin %s exiting admin panel", user_id)
             return await admin_back(update, context)
         
         logger.warning(f"⚠️ Unknown menu option selected by user {user_id}: {text}")
@@ -498,7 +603,7 @@ async def get_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     # Agar context'da yo'q bo'lsa, database'dan olish
     if not user_name or not phone_number:
-        user_info = database.get_user_info(user_id)
+        user_info = await db.get_user_info(user_id)
         if user_info:
             user_name = user_info[0]
             phone_number = user_info[1]
@@ -566,7 +671,7 @@ async def get_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     
     # Agar context'da ma'lumot yo'q bo'lsa, database'dan olish
     if not user_name or not phone_number:
-        user_info = database.get_user_info(user_id)
+        user_info = await db.get_user_info(user_id)
         if user_info:
             user_name = user_info[0]  # name
             phone_number = user_info[1]  # phone
@@ -598,11 +703,6 @@ async def get_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     lat = location.latitude
     lon = location.longitude
     
-    # Save problem to database
-    database.add_problem(user_id, muammo_text, media_type, file_id, lat, lon)
-    
-    logger.info(f"Problem reported by {user_name} ({phone_number}) at {lat}, {lon}")
-    
     admin_text = (
         f"🆕 Yangi murojaat!\n\n"
         f"👤 Ism: {user_name}\n"
@@ -612,21 +712,16 @@ async def get_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         f"📍 Lokatsiya: https://www.google.com/maps?q={lat},{lon}"
     )
     
-   # Forward to admins
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=admin_text)
-            if file_id:
-                if media_type == "Rasm":
-                    await context.bot.send_photo(chat_id=admin_id, photo=file_id)
-                elif media_type == "Video":
-                    await context.bot.send_video(chat_id=admin_id, video=file_id)
-            
-            if lat and lon:
-                await context.bot.send_location(chat_id=admin_id, latitude=lat, longitude=lon)
-        except Exception as e:
-            logger.error(f"Error forwarding report to admin {admin_id}: {e}")
-
+    # Save problem to database, with the admin notifications in the same transaction
+    await db.add_problem(
+        user_id, muammo_text, media_type, file_id, lat, lon,
+        notify_chat_ids=ADMIN_IDS,
+        notification={"kind": "report", "text": admin_text, "media_type": media_type, "file_id": file_id},
+        event_key=message_key(update),
+    )
+    
+    logger.info("Problem reported by %s (%s) at %s, %s", user_name, phone_number, lat, lon)
+    
     reply_markup = get_main_menu_keyboard()
 
     await update.message.reply_text(
@@ -639,6 +734,9 @@ async def get_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         "Tez orada biz sizni muomongizni ko'rib chiqamiz",
         reply_markup=reply_markup,
     )
+    
+    # Adminlarga xabar outbox orqali: tranzaksiya commit bo'lgach yuboriladi
+    db.after_commit(outbox.wake)
     return MENU
 
 async def get_rating(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -655,7 +753,7 @@ async def get_rating(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     if text in ["1", "2", "3", "4", "5"]:
         rating = int(text)
-        database.add_rating(update.effective_user.id, rating)
+        await db.add_rating(update.effective_user.id, rating)
         
         reply_markup = get_main_menu_keyboard()
         await update.message.reply_text(
@@ -683,28 +781,27 @@ async def get_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     user_name = context.user_data.get("name", "Noma'lum")
     phone_number = context.user_data.get("phone", "Noma'lum")
     
-    # Save to database
-    database.add_feedback(update.effective_user.id, text)
-    
-    # Forward to admins
     admin_text = (
         f"💬 Yangi fikr-mulohaza!\n\n"
         f"👤 Ism: {user_name}\n"
         f"📞 Telefon: {phone_number}\n"
         f"📝 Fikr: {text}"
     )
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=admin_text)
-        except Exception as e:
-            logger.error(f"Error forwarding feedback to admin {admin_id}: {e}")
-            
+    # Save to database; admins are notified through the outbox
+    await db.add_feedback(
+        update.effective_user.id, text,
+        notify_chat_ids=ADMIN_IDS,
+        notification={"kind": "feedback", "text": admin_text},
+        event_key=message_key(update),
+    )
     reply_markup = get_main_menu_keyboard()
     await update.message.reply_text(
         "Fikringiz uchun rahmat! Sizning fikringiz biz uchun muhim.\n\n"
         "Asosiy menyuga qaytdingiz:",
         reply_markup=reply_markup
     )
+    
+    db.after_commit(outbox.wake)
     return MENU
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -722,7 +819,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         return MENU
 
     reply_markup = ReplyKeyboardMarkup(
-        [["📊 Statistika", "📝 Xabarlar"], ["💬 Fikrlar", "👥 Foydalanuvchilar"], ["🚪 Chiqish"]], resize_keyboard=True
+        [["📊 Statistika", "📝 Xabarlar"], ["💬 Fikrlar", "👥 Foydalanuvchilar"], ["📢 E'lon", "📭 Yetkazilmagan"], ["🚪 Chiqish"]], resize_keyboard=True
     )
     await update.message.reply_text("Admin panelga xush kelibsiz:", reply_markup=reply_markup)
     return ADMIN_MENU
@@ -741,20 +838,124 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     if update.effective_user.id not in ADMIN_IDS:
         return MENU
     
-    total_problems, total_subscribers = database.get_stats()
+    total_problems, total_subscribers = await db.get_stats()
+    pool = await db.pool_stats()
+    cache = db.profile_cache.stats()
+    limiter = rate_limiter.stats()
+    updates = update_processor.stats()
+    queues = ", ".join(
+        f"{name} {c['waiting']} (o'rt. {c['avg_wait']:.2f}s, max {c['max_wait']:.1f}s)"
+        for name, c in limiter["classes"].items()
+    )
     await update.message.reply_text(
         f"📊 Statistika:\n\n"
         f"Obunachilar: {total_subscribers}\n"
-        f"Murojaatlar: {total_problems}"
+        f"Murojaatlar: {total_problems}\n\n"
+        f"🔌 DB ulanishlar: {pool['in_use']}/{pool['size']} band "
+        f"(max {pool['max_size']}, navbatda {pool['waiting']})\n"
+        f"🗂 Profil keshi: {cache['size']}/{cache['max_size']}, "
+        f"hit {cache['hit_rate']:.0%} ({cache['hits']} + {cache['negative_hits']} manfiy / {cache['misses']} miss)\n"
+        f"🚦 Telegram navbati: {queues}; 429: {limiter['flood_waits']}\n"
+        f"⚙️ Yangilanishlar: {updates['busy']}/{updates['workers']} ishlovchi band, "
+        f"{updates['waiting']} navbatda (bir foydalanuvchida max {updates['max_key_depth']})"
     )
     return ADMIN_MENU
 
+def process_rss():
+    """Resident memory of the bot process in bytes (peak RSS where /proc is missing)."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+async def admin_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows what the bot keeps in memory (/memory, admins only)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    user_data = context.application.user_data
+    users = persistence.stats()
+    cache = db.profile_cache.stats()
+    tracker = message_tracker.stats()
+    limiter = rate_limiter.stats()
+    logs = logging_stats()
+    mb = 1024 * 1024
+    await update.message.reply_text(
+        f"🧠 Xotira: {process_rss() / mb:.1f} MB\n\n"
+        f"👤 user_data: {len(user_data)} ta foydalanuvchi, ~{user_data_size(user_data) / 1024:.0f} KB "
+        f"(chegara {users['max_users']}, {persistence.ttl / 60:.0f} daqiqa faol bo'lmaganlar chiqariladi)\n"
+        f"   - Chiqarilgan: {users['evicted']}, yozilishi kutilmoqda: {users['pending']}\n"
+        f"🗂 Profil keshi: {cache['size']}/{cache['max_size']}\n"
+        f"💬 Xabar kuzatuvi: {tracker['chats']} ta chat, {tracker['messages']} ta xabar\n"
+        f"🚦 Tezlik chegarasi: {limiter['chats']} ta chat\n"
+        f"📥 Yangilanishlar navbati: {context.application.update_queue.qsize()}\n"
+        f"📜 Log navbati: {logs['queued']} (tashlangan {logs['dropped']}, sampling {logs['sampled_out']})"
+    )
+
+async def admin_queries(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Top database statements (/queries [total|avg|rows|calls|max] [N], /queries reset; admins only)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    args = context.args or []
+    if args[:1] == ["reset"]:
+        query_log.STATS.reset()
+        await update.message.reply_text("🗄 So'rovlar statistikasi tozalandi.")
+        return
+    order = args[0] if args and args[0] in query_log.QueryStats.ORDERS else "total"
+    limit = next((int(arg) for arg in args if arg.isdigit()), 10)
+    report = query_log.format_report(min(limit, 30), order)
+    # Telegram xabari 4096 belgidan oshmasligi kerak
+    await update.message.reply_text(report[:4000])
+
+async def collect_metrics(application):
+    """Copies the components' stats() into the /metrics gauges."""
+    states = {}
+    # ConversationHandler holatlarini ochiq ko'rsatmaydi; persistence ularni sanab boradi
+    for state, count in persistence.conversation_states().items():
+        name = STATE_NAMES.get(state, str(state))
+        states[name] = states.get(name, 0) + count
+    metrics.CONVERSATIONS.clear()
+    for name, count in states.items():
+        metrics.CONVERSATIONS.labels(name).set(count)
+
+    pool = await db.pool_stats()
+    metrics.DB_POOL_CONNECTIONS.labels("in_use").set(pool["in_use"])
+    metrics.DB_POOL_CONNECTIONS.labels("idle").set(pool["size"] - pool["in_use"])
+    metrics.DB_POOL_WAITING.set(pool.get("waiting", 0))
+    if "write_queue" in pool:
+        metrics.WRITE_QUEUE_BACKLOG.set(pool["write_queue"]["backlog"])
+
+    updates = update_processor.stats()
+    metrics.UPDATE_QUEUE.set(application.update_queue.qsize())
+    metrics.UPDATE_WORKERS_BUSY.set(updates["busy"])
+    metrics.UPDATES_WAITING.set(updates["waiting"])
+    for name, c in rate_limiter.stats()["classes"].items():
+        metrics.TELEGRAM_WAITING.labels(name).set(c["waiting"])
+    for result, count in outbox.stats().items():
+        metrics.OUTBOX_NOTIFICATIONS.labels(result).set(count)
+    metrics.USER_DATA_USERS.set(len(application.user_data))
+    metrics.PROFILE_CACHE_ENTRIES.set(db.profile_cache.stats()["size"])
+    logs = logging_stats()
+    metrics.LOG_QUEUE.set(logs["queued"])
+    metrics.LOG_DROPPED.labels().set(logs["dropped"])
+
 async def admin_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Shows recent problem reports."""
     if update.effective_user.id not in ADMIN_IDS:
         return MENU
     
-    problems = database.get_recent_problems(limit=5)
+    problems = await db.get_recent_problems(limit=5)
     if not problems:
         await update.message.reply_text("Hozircha murojaatlar yo'q.")
         return ADMIN_MENU
@@ -772,7 +973,7 @@ async def admin_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             f"-------------------\n"
         )
         # Update status to 'ko'rib chiqildi'
-        database.update_problem_status(p_id, "ko'rib chiqildi")
+        await db.update_problem_status(p_id, "ko'rib chiqildi")
         
     await update.message.reply_text(text)
     return ADMIN_MENU
@@ -782,7 +983,7 @@ async def admin_feedbacks(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if update.effective_user.id not in ADMIN_IDS:
         return MENU
     
-    feedbacks = database.get_recent_feedbacks(limit=5)
+    feedbacks = await db.get_recent_feedbacks(limit=5)
     if not feedbacks:
         await update.message.reply_text("Hozircha fikr-mulohazalar yo'q.")
         return ADMIN_MENU
@@ -798,6 +999,129 @@ async def admin_feedbacks(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(text)
     return ADMIN_MENU
 
+async def render_outbox():
+    """Builds the outbox summary and the retry button for dead notifications."""
+    stats = await db.outbox_stats()
+    dead = await db.get_dead_notifications(limit=10)
+    worker = outbox.stats()
+    text = (
+        f"📭 Admin xabarlari navbati:\n\n"
+        f"Kutilmoqda: {stats['pending']}\n"
+        f"Yuborilmoqda: {stats['sending']}\n"
+        f"Yetkazilmagan: {stats['dead']}\n"
+        f"Yuborildi (ishga tushgandan beri): {worker['sent']}, qayta urinish: {worker['retried']}\n"
+    )
+    if not dead:
+        return text, None
+    text += "\nOxirgi yetkazilmaganlar:\n"
+    for n_id, chat_id, kind, attempts, last_error, created_at in dead:
+        text += f"#{n_id} → {chat_id} ({kind}, {attempts} urinish, {created_at})\n   {(last_error or '')[:100]}\n"
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Qayta yuborish", callback_data="outbox:retry")]])
+    return text, reply_markup
+
+async def admin_outbox(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Shows undelivered admin notifications."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return MENU
+    
+    text, reply_markup = await render_outbox()
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    return ADMIN_MENU
+
+async def admin_outbox_retry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Puts dead-lettered notifications back in the queue."""
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("Sizda admin huquqlari yo'q.")
+        return
+    
+    requeued = await db.requeue_dead_notifications()
+    db.after_commit(outbox.wake)
+    await query.answer(f"{requeued} ta xabar qayta navbatga qo'yildi.")
+    text, reply_markup = await render_outbox()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Asks for the text of a broadcast to all subscribers."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return MENU
+    
+    await update.message.reply_text(
+        "📢 Barcha obunachilarga yuboriladigan e'lon matnini kiriting:",
+        reply_markup=ReplyKeyboardMarkup([["⬅️ Orqaga"]], resize_keyboard=True)
+    )
+    return BROADCAST_TEXT
+
+def render_broadcast(broadcast):
+    """Builds the status text and buttons of a broadcast."""
+    broadcast_id, text, _, status, _, total, sent, failed, blocked, _, _ = broadcast
+    labels = {"draft": "qoralama", "running": "yuborilmoqda", "done": "yakunlandi", "cancelled": "bekor qilindi"}
+    message = (
+        f"📢 E'lon #{broadcast_id} ({labels.get(status, status)})\n\n"
+        f"{text}\n\n"
+        f"👥 Obunachilar: {total}\n"
+    )
+    if status == "draft":
+        # Dry run: hech narsa yuborilmaydi, faqat taxminiy vaqt
+        message += f"⏱ Taxminiy vaqt: kamida {format_duration(estimate_duration(total))}"
+        buttons = [
+            InlineKeyboardButton("✅ Yuborish", callback_data=f"broadcast:start:{broadcast_id}"),
+            InlineKeyboardButton("❌ Bekor qilish", callback_data=f"broadcast:cancel:{broadcast_id}"),
+        ]
+    else:
+        remaining = max(total - sent - failed - blocked, 0)
+        message += f"✅ {sent}  ⚠️ {failed}  🚫 {blocked}\n"
+        buttons = []
+        if status == "running":
+            message += f"⏱ Qolgan vaqt: ~{format_duration(estimate_duration(remaining))}"
+            buttons = [
+                InlineKeyboardButton("🔄 Yangilash", callback_data=f"broadcast:status:{broadcast_id}"),
+                InlineKeyboardButton("⏹ To'xtatish", callback_data=f"broadcast:cancel:{broadcast_id}"),
+            ]
+    return message, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def handle_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Saves the broadcast as a draft and shows the dry-run estimate."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return MENU
+    
+    if update.message.text == "⬅️ Orqaga":
+        return await admin_panel(update, context)
+    
+    broadcast_id = await db.create_broadcast(update.message.text, update.effective_user.id)
+    text, reply_markup = render_broadcast(await db.get_broadcast(broadcast_id))
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    return await admin_panel(update, context)
+
+async def admin_broadcast_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles the start/cancel/refresh buttons of a broadcast."""
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("Sizda admin huquqlari yo'q.")
+        return
+    
+    _, action, broadcast_id = query.data.split(":")
+    broadcast_id = int(broadcast_id)
+    if action == "start":
+        started = await broadcasts.launch(broadcast_id)
+        await query.answer("📢 Yuborish boshlandi." if started else "E'lon allaqachon boshlangan yoki bekor qilingan.")
+        if started:
+            logger.info("Admin %s started broadcast %s", query.from_user.id, broadcast_id)
+    elif action == "cancel":
+        cancelled = await broadcasts.cancel(broadcast_id)
+        await query.answer("❌ E'lon bekor qilindi." if cancelled else "E'lon allaqachon yakunlangan.")
+    else:
+        await query.answer()
+    
+    broadcast = await db.get_broadcast(broadcast_id)
+    if broadcast:
+        text, reply_markup = render_broadcast(broadcast)
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup)
+        except BadRequest:
+            # Holat o'zgarmagan bo'lsa, Telegram "message is not modified" qaytaradi
+            pass
+
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Shows user management options."""
     if update.effective_user.id not in ADMIN_IDS:
@@ -813,18 +1137,15 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     )
     return USER_MANAGEMENT
 
-async def admin_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Shows all users with management options."""
-    if update.effective_user.id not in ADMIN_IDS:
-        return MENU
-    
-    users = database.get_all_users()
+async def render_users_page(after=None, before=None):
+    """Builds the text and next/prev buttons for one page of the user list."""
+    users, has_more = await db.get_users_page(USERS_PAGE_SIZE, after=after, before=before)
     if not users:
-        await update.message.reply_text("Hozircha foydalanuvchilar yo'q.")
-        return USER_MANAGEMENT
+        return None, None
+    total = await db.get_user_count()
     
-    text = "👥 Barcha foydalanuvchilar:\n\n"
-    for user_id, name, phone, created_at, problems, feedbacks, ratings in users[:10]:  # Faqat birinchi 10 ta
+    text = f"👥 Barcha foydalanuvchilar (jami: {total}):\n\n"
+    for user_id, name, phone, created_at, problems, feedbacks, ratings in users:
         text += (
             f"🆔 ID: {user_id}\n"
             f"👤 Ism: {name}\n"
@@ -833,15 +1154,52 @@ async def admin_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             f"📊 Statistika: {problems} murojaat, {feedbacks} fikr, {ratings} reyting\n"
             f"-------------------\n"
         )
+    text += "\n💡 Foydalanuvchini o'chirish uchun ID raqamini yuboring"
     
-    if len(users) > 10:
-        text += f"\n... va yana {len(users) - 10} ta foydalanuvchi\n"
+    # Sahifa chegarasi (created_at, user_id) tugma ichida saqlanadi
+    first, last = users[0], users[-1]
+    has_prev = after is not None or (before is not None and has_more)
+    has_next = before is not None or has_more
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Oldingi", callback_data=f"users:prev:{first[0]}:{first[3]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Keyingi ➡️", callback_data=f"users:next:{last[0]}:{last[3]}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def admin_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Shows the first page of users with management options."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return MENU
     
-    text += "\n💡 Foydalanuvchini o'chirish uchun ID raqamini yuboring"
+    text, reply_markup = await render_users_page()
+    if not text:
+        await update.message.reply_text("Hozircha foydalanuvchilar yo'q.")
+        return USER_MANAGEMENT
     
-    await update.message.reply_text(text)
+    await update.message.reply_text(text, reply_markup=reply_markup)
     return USER_MANAGEMENT
 
+async def admin_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles the next/prev buttons of the user list."""
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("Sizda admin huquqlari yo'q.")
+        return
+    
+    _, direction, user_id, created_at = query.data.split(":", 3)
+    cursor = (created_at, int(user_id))
+    if direction == "next":
+        text, reply_markup = await render_users_page(after=cursor)
+    else:
+        text, reply_markup = await render_users_page(before=cursor)
+    
+    await query.answer()
+    if not text:
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
 async def admin_search_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles user search."""
     if update.effective_user.id not in ADMIN_IDS:
@@ -872,7 +1230,7 @@ async def handle_user_management(update: Update, context: ContextTypes.DEFAULT_T
         if text.isdigit():
             user_id = int(text)
             # Check if user exists
-            user_info = database.get_user_info(user_id)
+            user_info = await db.get_user_info(user_id)
             if user_info:
                 name, phone = user_info
                 context.user_data['delete_user_id'] = user_id
@@ -896,13 +1254,13 @@ async def handle_user_management(update: Update, context: ContextTypes.DEFAULT_T
                 return USER_MANAGEMENT
         else:
             # Search users
-            users = database.search_users(text)
+            users = await db.search_users(text, limit=SEARCH_RESULTS_LIMIT)
             if not users:
                 await update.message.reply_text("❌ Hech kim topilmadi.")
                 return USER_MANAGEMENT
             
             search_text = f"🔍 Qidiruv natijalari '{text}' uchun:\n\n"
-            for user_id, name, phone, created_at, problems, feedbacks, ratings in users[:5]:
+            for user_id, name, phone, created_at, problems, feedbacks, ratings in users:
                 search_text += (
                     f"🆔 ID: {user_id}\n"
                     f"👤 Ism: {name}\n"
@@ -928,10 +1286,16 @@ async def handle_user_delete_confirm(update: Update, context: ContextTypes.DEFAU
         user_name = context.user_data.get('delete_user_name')
         
         if user_id:
-            success, message = database.delete_user_completely(user_id)
+            try:
+                success, message = await db.delete_user_completely(user_id)
+            except Exception as e:
+                # Hech narsa o'chirilmadi: tranzaksiya bekor qilingan
+                success, message = False, f"Xatolik: {e}"
             if success:
+                # Saqlangan user_data ham o'chiriladi
+                context.application.drop_user_data(user_id)
                 await update.message.reply_text(f"✅ {message}")
-                logger.info(f"Admin {update.effective_user.id} deleted user {user_id} ({user_name})")
+                logger.info("Admin %s deleted user %s (%s)", update.effective_user.id, user_id, user_name)
             else:
                 await update.message.reply_text(f"❌ {message}")
         
@@ -957,7 +1321,7 @@ async def fallback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user_id = update.effective_user.id
     
     # Foydalanuvchi ro'yxatdan o'tganmi tekshirish
-    user_info = database.get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     if user_info:
         # Agar ro'yxatdan o'tgan bo'lsa, menyuni ko'rsatish
         reply_markup = get_main_menu_keyboard()
@@ -993,9 +1357,6 @@ def main():
         logger.error("BOT_TOKEN not found in .env file!")
         return
 
-    # Initialize database
-    database.init_db()
-
     # Python 3.14 uchun event loop yaratish
     try:
         loop = asyncio.get_event_loop()
@@ -1003,7 +1364,17 @@ def main():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
 
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .bot(TrackingBot(BOT_TOKEN, rate_limiter=rate_limiter))
+        .application_class(BotApplication)
+        .context_types(ContextTypes(context=BotContext, user_data=UserState))
+        # Bounded, so a flood of updates pushes back on Telegram instead of filling memory
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+        .build()
+    )
 
     # Add conversation handler
     conv_handler = ConversationHandler(
@@ -1045,6 +1416,8 @@ def main():
                 MessageHandler(filters.Regex("^📝 Xabarlar$") & filters.Chat(ADMIN_IDS), admin_messages),
                 MessageHandler(filters.Regex("^💬 Fikrlar$") & filters.Chat(ADMIN_IDS), admin_feedbacks),
                 MessageHandler(filters.Regex("^👥 Foydalanuvchilar$") & filters.Chat(ADMIN_IDS), admin_users),
+                MessageHandler(filters.Regex("^📭 Yetkazilmagan$") & filters.Chat(ADMIN_IDS), admin_outbox),
+                MessageHandler(filters.Regex("^📢 E'lon$") & filters.Chat(ADMIN_IDS), admin_broadcast),
                 MessageHandler(filters.Regex("^🚪 Chiqish$") & filters.Chat(ADMIN_IDS), admin_back),
             ],
             USER_MANAGEMENT: [
@@ -1053,27 +1426,67 @@ def main():
             USER_DELETE_CONFIRM: [
                 MessageHandler(filters.TEXT & filters.Chat(ADMIN_IDS) & ~filters.COMMAND, handle_user_delete_confirm),
             ],
+            BROADCAST_TEXT: [
+                MessageHandler(filters.TEXT & filters.Chat(ADMIN_IDS) & ~filters.COMMAND, handle_broadcast_text),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         allow_reentry=True,
+        name="main",
+        persistent=True,
     )
 
+    # Kiruvchi xabarlar ID'larini chat tozalash uchun eslab qolish
+    application.add_handler(TypeHandler(Update, track_message), group=-1)
     application.add_handler(conv_handler)
     
     # Add separate command handlers
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("memory", admin_memory, filters=filters.Chat(ADMIN_IDS)))
+    application.add_handler(CommandHandler("queries", admin_queries, filters=filters.Chat(ADMIN_IDS)))
+    application.add_handler(CallbackQueryHandler(admin_users_page, pattern="^users:"))
+    application.add_handler(CallbackQueryHandler(admin_outbox_retry, pattern="^outbox:retry$"))
+    application.add_handler(CallbackQueryHandler(admin_broadcast_action, pattern="^broadcast:"))
     
     # Add fallback handler for messages outside conversation
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_handler))
+    instrument_handlers(application)
+    REGISTRY.on_scrape(lambda: collect_metrics(application))
 
-    logger.info(f"Bot started using {DB_BACKEND} backend...")
+    logger.info("Bot started using %s backend...", DB_BACKEND)
     
-    # Set bot commands after starting
+    # Initialize database and set bot commands after starting
     async def post_init(application):
+        await db.init_db()
+        pool = await db.pool_stats()
+        if update_processor.workers > pool["max_size"]:
+            logger.warning(
+                f"⚠️ UPDATE_WORKERS={update_processor.workers} is larger than the DB pool ({pool['max_size']}): "
+                f"updates will wait for connections"
+            )
         await set_bot_commands(application)
+        outbox.start(application.bot)
+        await broadcasts.start(application.bot)
+        if METRICS_PORT:
+            server = metrics_server()
+            await server.start()
+            application.bot_data["metrics"] = server
+    
+    async def post_shutdown(application):
+        if "metrics" in application.bot_data:
+            await application.bot_data.pop("metrics").stop()
+        await broadcasts.stop()
+        await outbox.stop()
+        await db.close()
     
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
+    
+    if WEBHOOK_URL:
+        logger.info("Running in webhook mode...")
+        loop.run_until_complete(run_webhook(application, WEBHOOK_URL))
+        return
     
     # Start the bot
     try:
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+
+from telegram.error import BadRequest, Forbidden
+
+from db_session import detached
+from rate_limiter import PRIORITY_ADMIN, PRIORITY_BROADCAST, TELEGRAM_GLOBAL_RATE
+
+logger = logging.getLogger(__name__)
+
+# Subscribers claimed from the database at a time
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+# Sends in flight at once; the rate limiter decides the actual pace
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+
+def estimate_duration(recipients, rate=TELEGRAM_GLOBAL_RATE):
+    """Dry run: seconds a broadcast takes at full speed.
+
+    It is a lower bound, since replies and admin notifications are served
+    before broadcast messages.
+    """
+    return recipients / rate if rate > 0 else 0.0
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} soniya"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes} daqiqa"
+    return f"{minutes // 60} soat {minutes % 60} daqiqa"
+
+def _is_gone(error):
+    """True when the recipient can never receive messages (blocked the bot, deleted account)."""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+class BroadcastEngine:
+    """Sends broadcasts to every subscriber in the background.
+
+    Subscribers are streamed in ID order, BROADCAST_CHUNK_SIZE at a time.
+    Each chunk is logged as 'pending' before anything is sent, and its
+    results are written back when it is done; users who blocked the bot
+    are unsubscribed in the same bulk update.
+
+    On shutdown the chunk's recipients that were not tried yet are given
+    back, so the broadcast picks them up again after the restart. After a
+    crash, or for sends cut off mid-request, recipients still 'pending'
+    are marked 'unknown' and skipped: they may have the message already,
+    and nobody gets it twice.
+    """
+
+    def __init__(self, db, chunk_size=BROADCAST_CHUNK_SIZE, concurrency=BROADCAST_CONCURRENCY):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.bot = None
+        self._tasks = {}  # broadcast_id -> task
+
+    async def start(self, bot):
+        """Resumes the broadcasts that were running when the bot stopped."""
+        self.bot = bot
+        for broadcast_id in await self.db.get_running_broadcasts():
+            skipped = await self.db.recover_broadcast(broadcast_id)
+            logger.info(f"📢 Resuming broadcast {broadcast_id} ({skipped} in-flight recipients skipped)")
+            self._spawn(broadcast_id)
+
+    async def launch(self, broadcast_id):
+        """Starts a draft broadcast; returns False if it was already started or cancelled."""
+        if not await self.db.set_broadcast_status(broadcast_id, "running", "draft"):
+            return False
+        self._spawn(broadcast_id)
+        return True
+
+    async def cancel(self, broadcast_id):
+        """Stops a draft or running broadcast after its current chunk."""
+        return (
+            await self.db.set_broadcast_status(broadcast_id, "cancelled", "draft")
+            or await self.db.set_broadcast_status(broadcast_id, "cancelled", "running")
+        )
+
+    def is_running(self, broadcast_id):
+        return broadcast_id in self._tasks
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id):
+        # Launched from an admin's update; the broadcast must not use its DB session
+        task = asyncio.create_task(detached(self._run(broadcast_id)), name=f"broadcast-{broadcast_id}")
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id):
+        try:
+            broadcast = await self.db.get_broadcast(broadcast_id)
+            text, created_by = broadcast[1], broadcast[2]
+            while True:
+                user_ids = await self.db.claim_broadcast_chunk(broadcast_id, self.chunk_size)
+                if not user_ids:
+                    break
+                sent, failed, blocked, attempted = [], [], [], set()
+                try:
+                    await self._send_chunk(text, user_ids, sent, failed, blocked, attempted)
+                finally:
+                    # Also on shutdown, so finished sends are not reported as 'unknown'
+                    await self.db.record_broadcast_results(broadcast_id, sent, failed, blocked)
+                    untried = [user_id for user_id in user_ids if user_id not in attempted]
+                    if untried:
+                        await self.db.release_broadcast_recipients(broadcast_id, untried)
+            if await self.db.set_broadcast_status(broadcast_id, "done", "running"):
+                await self._report(broadcast_id, created_by)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Broadcast {broadcast_id} stopped: {e}")
+
+    async def _send_chunk(self, text, user_ids, sent, failed, blocked, attempted):
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def send(user_id):
+            async with semaphore:
+                attempted.add(user_id)
+                try:
+                    await self.bot.send_message(chat_id=user_id, text=text, rate_limit_args=PRIORITY_BROADCAST)
+                except Exception as e:
+                    if _is_gone(e):
+                        blocked.append(user_id)
+                    else:
+                        logger.debug(f"📢 Broadcast to {user_id} failed: {e}")
+                        failed.append(user_id)
+                else:
+                    sent.append(user_id)
+
+        await asyncio.gather(*(send(user_id) for user_id in user_ids))
+
+    async def _report(self, broadcast_id, created_by):
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        _, _, _, _, _, total, sent, failed, blocked, _, _ = broadcast
+        logger.info(f"📢 Broadcast {broadcast_id} done: {sent} sent, {failed} failed, {blocked} blocked")
+        if not created_by:
+            return
+        try:
+            await self.bot.send_message(
+                chat_id=created_by,
+                text=(
+                    f"📢 E'lon #{broadcast_id} yuborildi.\n\n"
+                    f"✅ Yetkazildi: {sent}\n"
+                    f"⚠️ Xatolik: {failed}\n"
+                    f"🚫 Botni bloklagan (obunadan chiqarildi): {blocked}"
+                ),
+                rate_limit_args=PRIORITY_ADMIN,
+            )
+        except Exception as e:
+            logger.error(f"❌ Could not report broadcast {broadcast_id} to {created_by}: {e}")
@@ -2,18 +2,284 @@ import sqlite3
 import logging
 import json
 import os
+import threading
+import time
+import uuid
+import atexit
+from contextlib import contextmanager
 from datetime import datetime
+from queue import LifoQueue, Empty
+
+import query_log
+from db_session import Session, active_session
+from search_utils import exact_user_id, normalize_phone, parse_search_query
+from write_queue import WriteQueue
 
 logger = logging.getLogger(__name__)
 
 DB_NAME = "tozahudud.db"
 STATS_FILE = "stats.json"
 
-def init_db():
-    """Initializes the database and creates tables if they don't exist."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
+# Connection tuning (can be overridden from environment)
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Seconds to wait for a free pooled connection before giving up
+SQLITE_POOL_TIMEOUT = float(os.getenv("SQLITE_POOL_TIMEOUT", "5"))
+SQLITE_STATEMENT_CACHE = 256
+
+# stats.json is rewritten at most once per this many seconds
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "2"))
+
+# Write-behind queue for ratings, feedbacks and subscribers
+WRITE_QUEUE_BATCH_SIZE = int(os.getenv("WRITE_QUEUE_BATCH_SIZE", "200"))
+WRITE_QUEUE_MAX_DELAY_MS = int(os.getenv("WRITE_QUEUE_MAX_DELAY_MS", "50"))
+WRITE_QUEUE_MAX_BACKLOG = int(os.getenv("WRITE_QUEUE_MAX_BACKLOG", "10000"))
+# "async": return once queued; "sync": wait for the group commit
+WRITE_QUEUE_DURABILITY = os.getenv("WRITE_QUEUE_DURABILITY", "async")
+# Queued writes that keep failing are kept here and queued again on the next start
+WRITE_QUEUE_DEAD_LETTER_FILE = os.getenv("WRITE_QUEUE_DEAD_LETTER_FILE", "write_queue_dead.jsonl")
+
+# (users column, table) pairs: per-user activity counts kept up to date by triggers
+USER_ACTIVITY_COLUMNS = (("problems_count", "problems"), ("feedbacks_count", "feedbacks"), ("ratings_count", "ratings"))
+# Counters kept up to date by triggers: (counter name, table)
+COUNTED_TABLES = (
+    ("problems", "problems"),
+    ("subscribers", "subscribers"),
+    ("users", "users"),
+)
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free within SQLITE_POOL_TIMEOUT."""
+
+class ConnectionManager:
+    """Keeps a small set of long-lived, tuned SQLite connections.
+
+    Connections are opened lazily in WAL mode, so readers never block the
+    writer, and are handed out one caller at a time. Each connection keeps
+    its own prepared statement cache between calls.
+    """
+
+    def __init__(self, db_name, size=SQLITE_POOL_SIZE, timeout=SQLITE_POOL_TIMEOUT):
+        self.db_name = db_name
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle = LifoQueue()
+        self._opened = []
+        self._writer = None
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=SQLITE_STATEMENT_CACHE,
+            factory=query_log.SqliteConnection if query_log.QUERY_STATS else sqlite3.Connection,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self):
+        """Returns an idle connection, opening a new one if the pool is not full.
+
+        Waits at most ``timeout`` seconds for one to be released.
+        """
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if len(self._opened) < self.size:
+                conn = self._open()
+                self._opened.append(conn)
+                return conn
+            self._waiting += 1
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Empty:
+            raise PoolTimeout(f"No SQLite connection available within {self.timeout}s (size={self.size})") from None
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self, conn):
+        """Returns a connection to the pool, discarding any open transaction."""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def stats(self):
+        """Returns pool usage counters."""
+        with self._lock:
+            idle = self._idle.qsize()
+            return {
+                "size": len(self._opened),
+                "idle": idle,
+                "in_use": len(self._opened) - idle,
+                "waiting": self._waiting,
+                "max_size": self.size,
+            }
+
+    def writer(self):
+        """The write queue's own connection, outside the pool.
+
+        The writer never waits behind sessions for a pooled connection, so
+        a session waiting for queued writes (flush_writes) cannot deadlock it.
+        """
+        with self._lock:
+            if self._writer is None:
+                self._writer = self._open()
+            return self._writer
+
+    def close_all(self):
+        """Closes every connection opened by this manager."""
+        with self._lock:
+            if self._writer is not None:
+                self._opened.append(self._writer)
+                self._writer = None
+            for conn in self._opened:
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logger.warning(f"Error closing SQLite connection: {e}")
+            self._opened.clear()
+            self._idle = LifoQueue()
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def _get_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ConnectionManager(DB_NAME, SQLITE_POOL_SIZE)
+    return _manager
+
+@contextmanager
+def connection():
+    """Borrows a pooled connection; commits on success and rolls back on error.
+
+    Inside a per-update session the session's connection is reused and the
+    commit is left to the session.
+    """
+    session = active_session()
+    if session is None:
+        with _pooled_connection() as conn:
+            yield conn
+        return
+    conn = session.connection()
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+
+def open_session():
+    """Returns a lazy per-update session (see db_session.Session)."""
+    return Session(
+        lambda: _get_manager().acquire(),
+        lambda conn: _get_manager().release(conn),
+        lambda statements: _get_write_queue().submit(statements),
+    )
+
+@contextmanager
+def _committing(conn):
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+@contextmanager
+def _pooled_connection():
+    manager = _get_manager()
+    conn = manager.acquire()
+    try:
+        with _committing(conn):
+            yield conn
+    finally:
+        manager.release(conn)
+
+def _writer_connection():
+    return _committing(_get_manager().writer())
+
+_write_queue = None
+
+def _get_write_queue():
+    global _write_queue
+    if _write_queue is None:
+        with _manager_lock:
+            if _write_queue is None:
+                _write_queue = WriteQueue(
+                    _writer_connection,
+                    batch_size=WRITE_QUEUE_BATCH_SIZE,
+                    max_delay=WRITE_QUEUE_MAX_DELAY_MS / 1000,
+                    max_backlog=WRITE_QUEUE_MAX_BACKLOG,
+                    durability=WRITE_QUEUE_DURABILITY,
+                    on_commit=_schedule_stats_flush,
+                    dead_letter_path=WRITE_QUEUE_DEAD_LETTER_FILE,
+                )
+                _write_queue.start()
+    return _write_queue
+
+def _enqueue(*statements):
+    """Hands statements to the writer thread (group commit).
+
+    Inside a session they are handed over when the session commits, so
+    they are dropped with the rest of a failed update.
+    """
+    session = active_session()
+    if session is not None:
+        session.queue_writes(list(statements))
+        return
+    _get_write_queue().submit(list(statements))
+
+def flush_writes():
+    """Waits until queued writes are committed, so the next read sees them."""
+    session = active_session()
+    if session is not None and session.in_transaction():
+        # The writer thread would wait for our own write lock
+        return
+    if _write_queue is not None:
+        _write_queue.barrier()
+
+def pool_stats():
+    """Returns connection pool and write queue statistics."""
+    stats = _get_manager().stats()
+    if _write_queue is not None:
+        stats["write_queue"] = _write_queue.stats()
+    return stats
+
+def close_connections():
+    """Flushes queued writes and closes all pooled connections (call on shutdown)."""
+    global _manager, _write_queue
+    if _write_queue is not None:
+        _write_queue.close()
+        _write_queue = None
+    flush_stats()
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close_all()
+            _manager = None
+
+# Scripts that never call close_connections() still get their queued writes
+atexit.register(close_connections)
+
+def _migration_base_schema(cursor):
+    """Original tables (IF NOT EXISTS, so pre-migration databases are adopted as-is)."""
     # Create users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -23,7 +289,7 @@ def init_db():
             created_at TIMESTAMP
         )
     ''')
-    
+
     # Create problems table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS problems (
@@ -39,13 +305,13 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
     ''')
-    
+
     # Check if status column exists (for existing databases)
     cursor.execute("PRAGMA table_info(problems)")
     columns = [column[1] for column in cursor.fetchall()]
     if 'status' not in columns:
         cursor.execute("ALTER TABLE problems ADD COLUMN status TEXT DEFAULT 'Kutilmoqda'")
-    
+
     # Create subscribers table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS subscribers (
@@ -53,7 +319,7 @@ def init_db():
             created_at TIMESTAMP
         )
     ''')
-    
+
     # Create ratings table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS ratings (
@@ -64,7 +330,7 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
     ''')
-    
+
     # Create feedbacks table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS feedbacks (
@@ -75,98 +341,349 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
     ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized.")
+
+def _migration_counters(cursor):
+    """Row counters, maintained by triggers so stats never need COUNT(*)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for counter, table in COUNTED_TABLES:
+        cursor.execute(f"INSERT OR IGNORE INTO counters (name, value) SELECT '{counter}', COUNT(*) FROM {table}")
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table}
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = '{counter}';
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table}
+            BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = '{counter}';
+            END
+        ''')
+
+def _migration_indexes(cursor):
+    """Indexes for per-user history, recent listings and the per-user joins."""
+    # get_user_problems: WHERE user_id ORDER BY created_at, answered from the index alone
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_problems_user_created
+        ON problems (user_id, created_at, status, description)
+    ''')
+    # get_recent_problems / get_recent_feedbacks: ORDER BY created_at DESC LIMIT n
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_problems_created ON problems (created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_feedbacks_created ON feedbacks (created_at)')
+    # get_all_users / search_users joins
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_feedbacks_user ON feedbacks (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_user ON ratings (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)')
+
+def _backfill_user_activity(cursor):
+    """Recomputes every user's activity counts from the tables."""
+    assignments = ",\n".join(
+        f"{column} = (SELECT COUNT(*) FROM {table} t WHERE t.user_id = users.user_id)"
+        for column, table in USER_ACTIVITY_COLUMNS
+    )
+    cursor.execute(f'UPDATE users SET {assignments}')
+    return cursor.rowcount
+
+def _migration_user_activity(cursor):
+    """Per-user problem/feedback/rating counts on the users row, so listings need no joins."""
+    for column, table in USER_ACTIVITY_COLUMNS:
+        cursor.execute(f'ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_user_count_insert AFTER INSERT ON {table}
+            BEGIN
+                UPDATE users SET {column} = {column} + 1 WHERE user_id = NEW.user_id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_user_count_delete AFTER DELETE ON {table}
+            BEGIN
+                UPDATE users SET {column} = {column} - 1 WHERE user_id = OLD.user_id;
+            END
+        ''')
+    _backfill_user_activity(cursor)
+
+def _migration_user_search(cursor):
+    """Normalized phone digits plus an FTS5 trigram index over name and phone."""
+    cursor.execute('ALTER TABLE users ADD COLUMN phone_digits TEXT')
+    cursor.executemany(
+        'UPDATE users SET phone_digits = ? WHERE user_id = ?',
+        [(normalize_phone(phone), user_id) for user_id, phone in cursor.execute('SELECT user_id, phone FROM users').fetchall()]
+    )
+    # External-content index: the text lives in users, the FTS table only holds the trigrams
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            name, phone_digits, content='users', content_rowid='user_id', tokenize='trigram'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, name, phone_digits) VALUES (NEW.user_id, NEW.name, NEW.phone_digits);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, name, phone_digits) VALUES ('delete', OLD.user_id, OLD.name, OLD.phone_digits);
+        END
+    ''')
+    # Only name/phone edits touch the index, not the activity counter updates
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF name, phone_digits ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, name, phone_digits) VALUES ('delete', OLD.user_id, OLD.name, OLD.phone_digits);
+            INSERT INTO users_fts (rowid, name, phone_digits) VALUES (NEW.user_id, NEW.name, NEW.phone_digits);
+        END
+    ''')
+    cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+def _migration_outbox(cursor):
+    """Outbox of admin notifications, written in the same transaction as the report."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT NOT NULL UNIQUE,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)')
+
+def _migration_broadcasts(cursor):
+    """Broadcast jobs and their per-recipient delivery log."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            status TEXT NOT NULL DEFAULT 'draft',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_persistence(cursor):
+    """user_data and ConversationHandler states kept across restarts."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    ''')
+
+# Schema migrations, applied in order; the applied version is kept in PRAGMA user_version
+MIGRATIONS = (
+    (1, "base schema", _migration_base_schema),
+    (2, "row counters", _migration_counters),
+    (3, "indexes", _migration_indexes),
+    (4, "per-user activity counters", _migration_user_activity),
+    (5, "user search index", _migration_user_search),
+    (6, "notification outbox", _migration_outbox),
+    (7, "broadcasts", _migration_broadcasts),
+    (8, "conversation persistence", _migration_persistence),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def init_db():
+    """Brings the schema up to date; does no DDL at all when it already is."""
+    with connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            logger.info("Database schema is up to date (v%s).", version)
+        else:
+            for number, description, migrate in MIGRATIONS:
+                if number <= version:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                # Another process may have migrated while we waited for the lock
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+                    conn.rollback()
+                    continue
+                migrate(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+                logger.info("Applied migration %s: %s", number, description)
+            logger.info("Database initialized.")
     update_stats_json()
 
-def add_feedback(user_id, text):
-    """Adds a new feedback."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def _outbox_statements(event_key, chat_ids, notification):
+    """INSERTs for one notification per chat; the dedupe key makes a repeated event a no-op."""
+    if not notification:
+        return []
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute('''
+    payload = json.dumps(notification, ensure_ascii=False)
+    return [('''
+        INSERT OR IGNORE INTO outbox (dedupe_key, chat_id, kind, payload, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (f"{event_key}:{chat_id}", chat_id, notification["kind"], payload, time.time(), now))
+        for chat_id in chat_ids]
+
+def add_feedback(user_id, text, notify_chat_ids=(), notification=None, event_key=None):
+    """Adds a new feedback (through the write-behind queue).
+
+    ``notification`` is queued in the outbox for every chat in
+    ``notify_chat_ids``, in the same transaction as the feedback.
+    ``event_key`` names the Telegram message it came from, so a redelivered
+    update queues no second notification.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _enqueue(('''
         INSERT INTO feedbacks (user_id, text, created_at)
         VALUES (?, ?, ?)
-    ''', (user_id, text, now))
-    conn.commit()
-    conn.close()
+    ''', (user_id, text, now)), *_outbox_statements(f"feedback:{event_key or uuid.uuid4().hex}", notify_chat_ids, notification))
+
+def get_counters():
+    """Returns the trigger-maintained row counters as a dict."""
+    flush_writes()
+    with connection() as conn:
+        return dict(conn.execute('SELECT name, value FROM counters').fetchall())
 
 def update_stats_json():
-    """Queries the database and updates the stats.json file."""
+    """Writes the current counters to stats.json (atomically, via rename)."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM problems')
-        total_problems = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM subscribers')
-        total_subscribers = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        counters = get_counters()
         stats = {
-            "total_problems": total_problems,
-            "total_subscribers": total_subscribers
+            "total_problems": counters.get("problems", 0),
+            "total_subscribers": counters.get("subscribers", 0)
         }
         
-        with open(STATS_FILE, 'w') as f:
+        tmp_file = f"{STATS_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(stats, f)
+        os.replace(tmp_file, STATS_FILE)
         
-        logger.info(f"Stats updated in {STATS_FILE}: {stats}")
+        logger.debug("Stats updated in %s: %s", STATS_FILE, stats)
     except Exception as e:
         logger.error(f"Error updating stats JSON: {e}")
 
+_stats_timer = None
+_stats_lock = threading.Lock()
+
+def _schedule_stats_flush():
+    """Coalesces stats.json rewrites: many writes in a burst cause one file write."""
+    session = active_session()
+    if session is not None:
+        session.after_commit(_schedule_stats_flush)
+        return
+    global _stats_timer
+    with _stats_lock:
+        if _stats_timer is None:
+            _stats_timer = threading.Timer(STATS_FLUSH_INTERVAL, flush_stats)
+            _stats_timer.daemon = True
+            _stats_timer.start()
+
+def flush_stats():
+    """Writes stats.json now if a rewrite is pending."""
+    global _stats_timer
+    with _stats_lock:
+        if _stats_timer is None:
+            return
+        _stats_timer.cancel()
+        _stats_timer = None
+    update_stats_json()
+
 def add_subscriber(user_id):
-    """Adds a new subscriber if they don't exist."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    """Adds a new subscriber if they don't exist (through the write-behind queue)."""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute('''
+    _enqueue(('''
         INSERT OR IGNORE INTO subscribers (user_id, created_at)
         VALUES (?, ?)
-    ''', (user_id, now))
-    conn.commit()
-    conn.close()
-    update_stats_json()
+    ''', (user_id, now)))
+
+def touch_user(user_id):
+    """Records the subscriber and returns their (name, phone), in one transaction."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with connection() as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO subscribers (user_id, created_at)
+            VALUES (?, ?)
+        ''', (user_id, now))
+        inserted = cursor.rowcount > 0
+        user_info = conn.execute('SELECT name, phone FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    if inserted:
+        _schedule_stats_flush()
+    return user_info
 
 def add_user(user_id, name, phone):
     """Adds a new user or updates an existing one."""
     try:
-        logger.info(f"💾 Adding/updating user: {name} ({user_id})")
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        logger.info("💾 Adding/updating user: %s (%s)", name, user_id)
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, name, phone, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, name, phone, now))
-        conn.commit()
-        conn.close()
-        update_stats_json()
-        logger.debug(f"✅ User saved successfully: {name} ({user_id})")
+        with connection() as conn:
+            # A new row starts with counts for anything sent before registering
+            conn.execute('''
+                INSERT INTO users (user_id, name, phone, phone_digits, created_at,
+                                   problems_count, feedbacks_count, ratings_count)
+                VALUES (?, ?, ?, ?, ?,
+                        (SELECT COUNT(*) FROM problems WHERE user_id = ?),
+                        (SELECT COUNT(*) FROM feedbacks WHERE user_id = ?),
+                        (SELECT COUNT(*) FROM ratings WHERE user_id = ?))
+                ON CONFLICT (user_id) DO UPDATE SET
+                name = excluded.name,
+                phone = excluded.phone,
+                phone_digits = excluded.phone_digits
+            ''', (user_id, name, phone, normalize_phone(phone), now, user_id, user_id, user_id))
+        _schedule_stats_flush()
+        logger.debug("✅ User saved successfully: %s (%s)", name, user_id)
     except Exception as e:
         logger.error(f"❌ Error adding user {user_id}: {e}")
         raise
 
-def add_problem(user_id, description, media_type, file_id=None, latitude=None, longitude=None):
-    """Adds a new problem report."""
+def add_problem(user_id, description, media_type, file_id=None, latitude=None, longitude=None,
+                notify_chat_ids=(), notification=None, event_key=None):
+    """Adds a new problem report, plus its admin notifications in the same transaction.
+
+    ``event_key`` names the Telegram message it came from, so a redelivered
+    update queues no second notification.
+    """
     try:
-        logger.info(f"📝 Adding problem report from user {user_id}: {description[:50]}...")
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        logger.info("📝 Adding problem report from user %s: %s...", user_id, description[:50])
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('''
-            INSERT INTO problems (user_id, description, media_type, file_id, latitude, longitude, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, description, media_type, file_id, latitude, longitude, 'Kutilmoqda', now))
-        problem_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        update_stats_json()
-        logger.debug(f"✅ Problem report saved successfully: ID {problem_id}")
+        with connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO problems (user_id, description, media_type, file_id, latitude, longitude, status, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, description, media_type, file_id, latitude, longitude, 'Kutilmoqda', now))
+            problem_id = cursor.lastrowid
+            for sql, params in _outbox_statements(f"problem:{event_key or problem_id}", notify_chat_ids, notification):
+                conn.execute(sql, params)
+        _schedule_stats_flush()
+        logger.debug("✅ Problem report saved successfully: ID %s", problem_id)
         return problem_id
     except Exception as e:
         logger.error(f"❌ Error adding problem for user {user_id}: {e}")
@@ -174,121 +691,77 @@ def add_problem(user_id, description, media_type, file_id=None, latitude=None, l
 
 def update_problem_status(problem_id, status):
     """Updates the status of a problem."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE problems SET status = ? WHERE id = ?
-    ''', (status, problem_id))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        conn.execute('''
+            UPDATE problems SET status = ? WHERE id = ?
+        ''', (status, problem_id))
 
 def add_rating(user_id, rating):
-    """Adds a new rating."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    """Adds a new rating (through the write-behind queue)."""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute('''
+    _enqueue(('''
         INSERT INTO ratings (user_id, rating, created_at)
         VALUES (?, ?, ?)
-    ''', (user_id, rating, now))
-    conn.commit()
-    conn.close()
+    ''', (user_id, rating, now)))
 
 def get_stats():
-    """Returns total number of users and problems from JSON file."""
-    if not os.path.exists(STATS_FILE):
-        update_stats_json()
-    
-    try:
-        with open(STATS_FILE, 'r') as f:
-            stats = json.load(f)
-        return (
-            stats.get("total_problems", 0),
-            stats.get("total_subscribers", 0)
-        )
-    except Exception as e:
-        logger.error(f"Error reading stats JSON: {e}")
-        # Fallback to database if JSON fails
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM problems')
-        total_problems = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM subscribers')
-        total_subscribers = cursor.fetchone()[0]
-        conn.close()
-        return total_problems, total_subscribers
+    """Returns total number of problems and subscribers from the counters table."""
+    counters = get_counters()
+    return counters.get("problems", 0), counters.get("subscribers", 0)
 
 def get_recent_problems(limit=10):
     """Returns the most recent problem reports with user details."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT p.description, p.media_type, u.name, u.phone, p.created_at, p.latitude, p.longitude, p.status, p.id
-        FROM problems p
-        JOIN users u ON p.user_id = u.user_id
-        ORDER BY p.created_at DESC
-        LIMIT ?
-    ''', (limit,))
-    
-    problems = cursor.fetchall()
-    conn.close()
-    return problems
+    with connection() as conn:
+        cursor = conn.execute('''
+            SELECT p.description, p.media_type, u.name, u.phone, p.created_at, p.latitude, p.longitude, p.status, p.id
+            FROM problems p
+            JOIN users u ON p.user_id = u.user_id
+            ORDER BY p.created_at DESC
+            LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
 
 def get_user_problems(user_id, limit=5):
     """Returns the most recent problem reports for a specific user."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT description, status, created_at
-        FROM problems
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        LIMIT ?
-    ''', (user_id, limit))
-    
-    problems = cursor.fetchall()
-    conn.close()
-    return problems
+    with connection() as conn:
+        cursor = conn.execute('''
+            SELECT description, status, created_at
+            FROM problems
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        return cursor.fetchall()
 
 def get_recent_feedbacks(limit=10):
     """Returns the most recent feedbacks with user details."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT f.text, u.name, u.phone, f.created_at
-        FROM feedbacks f
-        JOIN users u ON f.user_id = u.user_id
-        ORDER BY f.created_at DESC
-        LIMIT ?
-    ''', (limit,))
-    
-    feedbacks = cursor.fetchall()
-    conn.close()
-    return feedbacks
+    flush_writes()
+    with connection() as conn:
+        cursor = conn.execute('''
+            SELECT f.text, u.name, u.phone, f.created_at
+            FROM feedbacks f
+            JOIN users u ON f.user_id = u.user_id
+            ORDER BY f.created_at DESC
+            LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
 
 def get_user_info(user_id):
     """Returns user information by user_id."""
     try:
-        logger.debug(f"🔍 Getting user info for {user_id}")
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT name, phone
-            FROM users
-            WHERE user_id = ?
-        ''', (user_id,))
-        
-        user_info = cursor.fetchone()
-        conn.close()
+        logger.debug("🔍 Getting user info for %s", user_id)
+        with connection() as conn:
+            cursor = conn.execute('''
+                SELECT name, phone
+                FROM users
+                WHERE user_id = ?
+            ''', (user_id,))
+            user_info = cursor.fetchone()
         
         if user_info:
-            logger.debug(f"✅ User info found for {user_id}: {user_info[0]}")
+            logger.debug("✅ User info found for %s: %s", user_id, user_info[0])
         else:
-            logger.debug(f"❌ No user info found for {user_id}")
+            logger.debug("❌ No user info found for %s", user_id)
             
         return user_info
     except Exception as e:
@@ -297,89 +770,373 @@ def get_user_info(user_id):
 
 def get_all_users():
     """Returns all users with their statistics."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    flush_writes()
+    with connection() as conn:
+        cursor = conn.execute('''
+            SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+            FROM users
+            ORDER BY created_at DESC
+        ''')
+        return cursor.fetchall()
+
+def backfill_counters():
+    """Recomputes per-user activity counts and the global row counters from the tables."""
+    flush_writes()
+    with connection() as conn:
+        cursor = conn.cursor()
+        updated = _backfill_user_activity(cursor)
+        for counter, table in COUNTED_TABLES:
+            cursor.execute(f"UPDATE counters SET value = (SELECT COUNT(*) FROM {table}) WHERE name = '{counter}'")
+    _schedule_stats_flush()
+    return updated
+
+def get_user_count():
+    """Returns the number of registered users from the counters table."""
+    return get_counters().get("users", 0)
+
+def get_users_page(limit=10, after=None, before=None):
+    """Returns one page of users, newest first, plus whether more pages exist.
+
+    Keyset pagination on (created_at, user_id): ``after`` is the cursor of
+    the last row on the current page (next page), ``before`` the cursor of
+    the first row (previous page). Only the rows of the page are touched,
+    so the cost does not grow with the number of users.
+    """
+    flush_writes()
+    if before is not None:
+        where, order, params = 'WHERE (created_at, user_id) > (?, ?)', 'ASC', tuple(before)
+    elif after is not None:
+        where, order, params = 'WHERE (created_at, user_id) < (?, ?)', 'DESC', tuple(after)
+    else:
+        where, order, params = '', 'DESC', ()
     
-    cursor.execute('''
-        SELECT u.user_id, u.name, u.phone, u.created_at,
-               COUNT(DISTINCT p.id) as problems_count,
-               COUNT(DISTINCT f.id) as feedbacks_count,
-               COUNT(DISTINCT r.id) as ratings_count
-        FROM users u
-        LEFT JOIN problems p ON u.user_id = p.user_id
-        LEFT JOIN feedbacks f ON u.user_id = f.user_id
-        LEFT JOIN ratings r ON u.user_id = r.user_id
-        GROUP BY u.user_id, u.name, u.phone, u.created_at
-        ORDER BY u.created_at DESC
-    ''')
+    with connection() as conn:
+        cursor = conn.execute(f'''
+            SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+            FROM users
+            {where}
+            ORDER BY created_at {order}, user_id {order}
+            LIMIT ?
+        ''', params + (limit + 1,))
+        users = cursor.fetchall()
     
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    has_more = len(users) > limit
+    users = users[:limit]
+    if before is not None:
+        users.reverse()
+    return users, has_more
 
 def delete_user_completely(user_id):
-    """Completely deletes a user and all their data."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
+    """Completely deletes a user and all their data.
+
+    Runs in one transaction (the update's session, if any); an error is
+    logged and raised, and nothing is deleted.
+    """
+    flush_writes()
     try:
-        # Get user info first
-        cursor.execute('SELECT name, phone FROM users WHERE user_id = ?', (user_id,))
-        user_info = cursor.fetchone()
-        
-        if not user_info:
-            return False, "Foydalanuvchi topilmadi"
-        
-        name, phone = user_info
-        
-        # Delete all related data
-        cursor.execute('DELETE FROM problems WHERE user_id = ?', (user_id,))
-        problems_deleted = cursor.rowcount
-        
-        cursor.execute('DELETE FROM feedbacks WHERE user_id = ?', (user_id,))
-        feedbacks_deleted = cursor.rowcount
-        
-        cursor.execute('DELETE FROM ratings WHERE user_id = ?', (user_id,))
-        ratings_deleted = cursor.rowcount
-        
-        cursor.execute('DELETE FROM subscribers WHERE user_id = ?', (user_id,))
-        subscribers_deleted = cursor.rowcount
-        
-        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        user_deleted = cursor.rowcount
-        
-        conn.commit()
-        
-        # Update stats
-        update_stats_json()
-        
-        return True, f"{name} to'liq o'chirildi (Murojaatlar: {problems_deleted}, Fikrlar: {feedbacks_deleted}, Reytinglar: {ratings_deleted})"
-        
+        with connection() as conn:
+            user_info = conn.execute('SELECT name, phone FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if not user_info:
+                return False, "Foydalanuvchi topilmadi"
+            name, phone = user_info
+            
+            # Delete all related data
+            problems_deleted = conn.execute('DELETE FROM problems WHERE user_id = ?', (user_id,)).rowcount
+            feedbacks_deleted = conn.execute('DELETE FROM feedbacks WHERE user_id = ?', (user_id,)).rowcount
+            ratings_deleted = conn.execute('DELETE FROM ratings WHERE user_id = ?', (user_id,)).rowcount
+            conn.execute('DELETE FROM subscribers WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
     except Exception as e:
-        conn.rollback()
-        return False, f"Xatolik: {str(e)}"
-    finally:
-        conn.close()
-
-def search_users(query):
-    """Search users by name or phone."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+        logger.error(f"❌ Error deleting user {user_id}: {e}")
+        raise
     
-    cursor.execute('''
-        SELECT u.user_id, u.name, u.phone, u.created_at,
-               COUNT(DISTINCT p.id) as problems_count,
-               COUNT(DISTINCT f.id) as feedbacks_count,
-               COUNT(DISTINCT r.id) as ratings_count
-        FROM users u
-        LEFT JOIN problems p ON u.user_id = p.user_id
-        LEFT JOIN feedbacks f ON u.user_id = f.user_id
-        LEFT JOIN ratings r ON u.user_id = r.user_id
-        WHERE u.name LIKE ? OR u.phone LIKE ? OR u.user_id LIKE ?
-        GROUP BY u.user_id, u.name, u.phone, u.created_at
-        ORDER BY u.created_at DESC
-    ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
+    # Update stats
+    _schedule_stats_flush()
     
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    return True, f"{name} to'liq o'chirildi (Murojaatlar: {problems_deleted}, Fikrlar: {feedbacks_deleted}, Reytinglar: {ratings_deleted})"
+
+def search_users(query, limit=10):
+    """Searches users by name, phone or ID, best matches first.
+
+    Uses the users_fts trigram index; queries shorter than a trigram fall
+    back to a LIKE scan. An exact user ID always ranks first.
+    """
+    flush_writes()
+    digits, text = parse_search_query(query)
+    term = digits or text
+    if not term:
+        return []
+    
+    columns = 'u.user_id, u.name, u.phone, u.created_at, u.problems_count, u.feedbacks_count, u.ratings_count'
+    with connection() as conn:
+        if len(term) >= 3:
+            column = 'phone_digits' if digits else 'name'
+            phrase = '"' + term.replace('"', '""') + '"'
+            cursor = conn.execute(f'''
+                SELECT {columns}
+                FROM users_fts
+                JOIN users u ON u.user_id = users_fts.rowid
+                WHERE users_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (f'{column} : {phrase}', limit))
+        else:
+            column = 'u.phone_digits' if digits else 'u.name'
+            cursor = conn.execute(f'''
+                SELECT {columns}
+                FROM users u
+                WHERE {column} LIKE ?
+                ORDER BY u.created_at DESC
+                LIMIT ?
+            ''', (f'%{term}%', limit))
+        users = cursor.fetchall()
+        
+        # Raqam foydalanuvchi ID'si bo'lsa, u birinchi o'rinda turadi
+        if exact_user_id(digits) is not None:
+            exact = conn.execute(f'SELECT {columns} FROM users u WHERE u.user_id = ?', (exact_user_id(digits),)).fetchone()
+            if exact:
+                users = [exact] + [user for user in users if user[0] != exact[0]][:limit - 1]
+        return users
+
+# Admin notification outbox
+def claim_notifications(limit=20, lease=60):
+    """Claims due notifications for sending: [(id, chat_id, payload, attempts)].
+
+    A claim that was not finished within ``lease`` seconds (e.g. the
+    process died mid-send) becomes claimable again.
+    """
+    now = time.time()
+    with connection() as conn:
+        rows = conn.execute('''
+            UPDATE outbox SET status = 'sending', claimed_at = ?, attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND claimed_at <= ?)
+                ORDER BY next_attempt_at
+                LIMIT ?
+            )
+            RETURNING id, chat_id, payload, attempts
+        ''', (now, now, now - lease, limit)).fetchall()
+    return [(notification_id, chat_id, json.loads(payload), attempts) for notification_id, chat_id, payload, attempts in rows]
+
+def mark_notification_sent(notification_id):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with connection() as conn:
+        conn.execute(
+            "UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+            (now, notification_id)
+        )
+
+def update_notification_payload(notification_id, payload):
+    """Stores the payload with its delivery progress (see notifications.send_report)."""
+    with connection() as conn:
+        conn.execute(
+            "UPDATE outbox SET payload = ? WHERE id = ?",
+            (json.dumps(payload, ensure_ascii=False), notification_id)
+        )
+
+def retry_notification(notification_id, delay, error):
+    """Puts a notification back in the queue, due again in ``delay`` seconds."""
+    with connection() as conn:
+        conn.execute(
+            "UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (time.time() + delay, error, notification_id)
+        )
+
+def dead_letter_notification(notification_id, error):
+    """Gives up on a notification; it stays visible in the admin panel."""
+    with connection() as conn:
+        conn.execute(
+            "UPDATE outbox SET status = 'dead', last_error = ? WHERE id = ?",
+            (error, notification_id)
+        )
+
+def requeue_dead_notifications():
+    """Moves every dead notification back to the queue; returns how many."""
+    with connection() as conn:
+        cursor = conn.execute(
+            "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'",
+            (time.time(),)
+        )
+        return cursor.rowcount
+
+def get_dead_notifications(limit=10):
+    """Returns the latest dead notifications: (id, chat_id, kind, attempts, last_error, created_at)."""
+    with connection() as conn:
+        return conn.execute('''
+            SELECT id, chat_id, kind, attempts, last_error, created_at
+            FROM outbox
+            WHERE status = 'dead'
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (limit,)).fetchall()
+
+def outbox_stats():
+    """Returns the number of notifications per status."""
+    with connection() as conn:
+        rows = conn.execute('''
+            SELECT status, COUNT(*) FROM outbox
+            WHERE status != 'sent'
+            GROUP BY status
+        ''').fetchall()
+    stats = {"pending": 0, "sending": 0, "dead": 0}
+    stats.update(dict(rows))
+    return stats
+
+def prune_notifications(older_than_days=7):
+    """Deletes sent notifications older than the retention period."""
+    cutoff = datetime.fromtimestamp(time.time() - older_than_days * 86400).strftime("%Y-%m-%d %H:%M:%S")
+    with connection() as conn:
+        return conn.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,)
+        ).rowcount
+
+# Broadcasts
+BROADCAST_COLUMNS = 'id, text, created_by, status, last_user_id, total, sent, failed, blocked, created_at, finished_at'
+
+def create_broadcast(text, created_by):
+    """Creates a draft broadcast to every current subscriber; returns its id."""
+    flush_writes()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with connection() as conn:
+        cursor = conn.execute('''
+            INSERT INTO broadcasts (text, created_by, total, created_at)
+            VALUES (?, ?, (SELECT value FROM counters WHERE name = 'subscribers'), ?)
+        ''', (text, created_by, now))
+        return cursor.lastrowid
+
+def get_broadcast(broadcast_id):
+    """Returns (id, text, created_by, status, last_user_id, total, sent, failed, blocked, created_at, finished_at)."""
+    with connection() as conn:
+        return conn.execute(f'SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+
+def set_broadcast_status(broadcast_id, status, from_status):
+    """Moves a broadcast from ``from_status`` to ``status``; returns False if it was not in it."""
+    finished_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S") if status in ('done', 'cancelled') else None
+    with connection() as conn:
+        cursor = conn.execute(
+            'UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = ?',
+            (status, finished_at, broadcast_id, from_status)
+        )
+        return cursor.rowcount > 0
+
+def get_running_broadcasts():
+    """Returns the ids of broadcasts to resume after a restart."""
+    with connection() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")]
+
+def recover_broadcast(broadcast_id):
+    """Marks recipients that were in flight when the process died as 'unknown'.
+
+    They may already have the message, so they are not sent to again.
+    """
+    with connection() as conn:
+        return conn.execute(
+            "UPDATE broadcast_deliveries SET status = 'unknown' WHERE broadcast_id = ? AND status = 'pending'",
+            (broadcast_id,)
+        ).rowcount
+
+def release_broadcast_recipients(broadcast_id, user_ids):
+    """Gives back claimed recipients that were never sent to (shutdown mid-chunk).
+
+    Their 'pending' rows are dropped and the cursor moved back before
+    them, so the next claim picks them up again.
+    """
+    if not user_ids:
+        return
+    with connection() as conn:
+        conn.executemany(
+            "DELETE FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id = ? AND status = 'pending'",
+            [(broadcast_id, user_id) for user_id in user_ids]
+        )
+        conn.execute(
+            'UPDATE broadcasts SET last_user_id = MIN(last_user_id, ?) WHERE id = ?', (min(user_ids) - 1, broadcast_id)
+        )
+
+def claim_broadcast_chunk(broadcast_id, limit=500):
+    """Takes the next ``limit`` subscribers after the broadcast's cursor.
+
+    The recipients are logged as 'pending' and the cursor advanced in one
+    transaction, so every subscriber is claimed at most once; users who
+    already have a delivery row are skipped (see release_broadcast_recipients).
+    """
+    flush_writes()
+    with connection() as conn:
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(
+            "SELECT last_user_id FROM broadcasts WHERE id = ? AND status = 'running'", (broadcast_id,)
+        ).fetchone()
+        if row is None:
+            return []
+        user_ids = [user_id for (user_id,) in conn.execute(
+            'SELECT user_id FROM subscribers s WHERE user_id > ? AND NOT EXISTS '
+            '(SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = ? AND d.user_id = s.user_id) '
+            'ORDER BY user_id LIMIT ?',
+            (row[0], broadcast_id, limit)
+        )]
+        if user_ids:
+            conn.executemany(
+                'INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id) VALUES (?, ?)',
+                [(broadcast_id, user_id) for user_id in user_ids]
+            )
+            conn.execute('UPDATE broadcasts SET last_user_id = ? WHERE id = ?', (user_ids[-1], broadcast_id))
+    return user_ids
+
+def record_broadcast_results(broadcast_id, sent_ids, failed_ids, blocked_ids):
+    """Stores a chunk's outcome and unsubscribes the users who blocked the bot."""
+    with connection() as conn:
+        for status, user_ids in (('sent', sent_ids), ('failed', failed_ids), ('blocked', blocked_ids)):
+            conn.executemany(
+                'UPDATE broadcast_deliveries SET status = ? WHERE broadcast_id = ? AND user_id = ?',
+                [(status, broadcast_id, user_id) for user_id in user_ids]
+            )
+        conn.execute(
+            'UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE id = ?',
+            (len(sent_ids), len(failed_ids), len(blocked_ids), broadcast_id)
+        )
+        if blocked_ids:
+            placeholders = ','.join('?' * len(blocked_ids))
+            conn.execute(f'DELETE FROM subscribers WHERE user_id IN ({placeholders})', list(blocked_ids))
+    if blocked_ids:
+        _schedule_stats_flush()
+
+def load_user_data(user_id):
+    """Returns the stored user_data of a user, or None if there is none."""
+    with connection() as conn:
+        row = conn.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_user_data(items):
+    """Writes a batch of (user_id, data_json) in one transaction; None deletes the entry."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with connection() as conn:
+        conn.executemany(
+            'INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+            [(user_id, data, now) for user_id, data in items if data is not None]
+        )
+        conn.executemany(
+            'DELETE FROM user_data WHERE user_id = ?',
+            [(user_id,) for user_id, data in items if data is None]
+        )
+
+def load_conversations(name):
+    """Returns [(key_json, state)] of a persistent ConversationHandler."""
+    with connection() as conn:
+        return conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+
+def save_conversations(name, items):
+    """Writes a batch of (key_json, state) in one transaction; None ends the conversation."""
+    with connection() as conn:
+        conn.executemany(
+            'INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) '
+            'ON CONFLICT (name, key) DO UPDATE SET state = excluded.state',
+            [(name, key, state) for key, state in items if state is not None]
+        )
+        conn.executemany(
+            'DELETE FROM conversations WHERE name = ? AND key = ?',
+            [(name, key) for key, state in items if state is None]
+        )
@@ -0,0 +1,735 @@
+import asyncio
+import asyncpg
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from db_session import AsyncSession, active_session
+from pg_migrations import (
+    BACKFILL_USER_ACTIVITY,
+    COUNTED_TABLES,
+    CREATE_MIGRATIONS_TABLE,
+    CURRENT_VERSION_QUERY,
+    MIGRATION_LOCK_ID,
+    MIGRATIONS,
+    MIGRATIONS_TABLE,
+    SCHEMA_VERSION,
+)
+from search_utils import exact_user_id, parse_search_query
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL connection from environment variable
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Pool settings are shared with database_pg so both drivers size the same way
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "5"))
+# asyncpg closes connections idle for this long; it has no maximum
+# connection age, so PG_POOL_MAX_LIFETIME only applies to database_pg
+PG_POOL_MAX_IDLE = float(os.getenv("PG_POOL_MAX_IDLE", "300"))
+# Server-side prepared statements kept per connection
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "256"))
+
+_pool = None
+_pool_lock = asyncio.Lock()
+_checkouts = 0
+_checkout_time_total = 0.0
+_checkout_time_max = 0.0
+
+async def get_pool():
+    """Returns the shared asyncpg pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    DATABASE_URL,
+                    min_size=PG_POOL_MIN_SIZE,
+                    max_size=PG_POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=PG_POOL_MAX_IDLE,
+                    statement_cache_size=PG_STATEMENT_CACHE_SIZE,
+                )
+    return _pool
+
+async def _acquire():
+    global _checkouts, _checkout_time_total, _checkout_time_max
+    pool = await get_pool()
+    started = time.monotonic()
+    conn = await pool.acquire(timeout=PG_POOL_TIMEOUT)
+    elapsed = time.monotonic() - started
+    _checkouts += 1
+    _checkout_time_total += elapsed
+    _checkout_time_max = max(_checkout_time_max, elapsed)
+    return conn
+
+async def _release(conn):
+    await (await get_pool()).release(conn)
+
+@asynccontextmanager
+async def connection():
+    """Borrows a pooled connection (``async with connection() as conn``).
+
+    Inside a per-update session the session's connection and transaction
+    are reused; the commit is left to the session. Each call runs in a
+    savepoint, so a failing statement undoes only that call.
+    """
+    session = active_session()
+    if session is not None:
+        conn = await session.connection()
+        async with conn.transaction():
+            yield conn
+        return
+    conn = await _acquire()
+    try:
+        yield conn
+    finally:
+        await _release(conn)
+
+def open_session():
+    """Returns a lazy per-update session (see db_session.AsyncSession)."""
+    return AsyncSession(_acquire, _release)
+
+def _rowcount(status):
+    """Extracts the row count from a command status such as 'DELETE 3'."""
+    return int(status.split()[-1])
+
+async def pool_stats():
+    """Returns connection pool statistics (in-use, checkout latency)."""
+    pool = await get_pool()
+    size = pool.get_size()
+    idle = pool.get_idle_size()
+    return {
+        "size": size,
+        "idle": idle,
+        "in_use": size - idle,
+        "waiting": 0,
+        "max_size": pool.get_max_size(),
+        "checkouts": _checkouts,
+        "timeouts": 0,
+        "avg_checkout_ms": round(_checkout_time_total / _checkouts * 1000, 2) if _checkouts else 0.0,
+        "max_checkout_ms": round(_checkout_time_max * 1000, 2),
+    }
+
+async def init_db():
+    """Brings the schema up to date; does no DDL at all when it already is.
+
+    Each migration commits together with its version row, so a failure
+    keeps the ones before it. The error is raised: the bot must not start
+    on a half-migrated schema.
+    """
+    async with connection() as conn:
+        try:
+            version = await conn.fetchval(CURRENT_VERSION_QUERY)
+            if version >= SCHEMA_VERSION:
+                logger.info("PostgreSQL schema is up to date (v%s).", version)
+                return
+            
+            for number, description, statements in MIGRATIONS:
+                if number <= version:
+                    continue
+                async with conn.transaction():
+                    await conn.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK_ID)
+                    await conn.execute(CREATE_MIGRATIONS_TABLE)
+                    # Another process may have migrated while we waited for the lock
+                    if await conn.fetchval(CURRENT_VERSION_QUERY) >= number:
+                        continue
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute(
+                        f'INSERT INTO {MIGRATIONS_TABLE} (version, description) VALUES ($1, $2)',
+                        number, description
+                    )
+                logger.info("Applied migration %s: %s", number, description)
+            logger.info("PostgreSQL (asyncpg) database initialized.")
+        except Exception as e:
+            logger.error(f"Error initializing database: {e}")
+            raise
+
+async def add_subscriber(user_id):
+    """Adds a new subscriber if they don't exist."""
+    try:
+        async with connection() as conn:
+            await conn.execute('''
+                INSERT INTO telegram_subscribers (user_id)
+                VALUES ($1)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', user_id)
+    except Exception as e:
+        logger.error(f"Error adding subscriber: {e}")
+
+async def touch_user(user_id):
+    """Records the subscriber and returns their (name, phone) in a single statement."""
+    async with connection() as conn:
+        row = await conn.fetchrow('''
+            WITH subscriber AS (
+                INSERT INTO telegram_subscribers (user_id)
+                VALUES ($1)
+                ON CONFLICT (user_id) DO NOTHING
+            )
+            SELECT name, phone FROM telegram_users WHERE user_id = $1
+        ''', user_id)
+    return tuple(row) if row else None
+
+async def add_user(user_id, name, phone):
+    """Adds a new user or updates an existing one."""
+    try:
+        logger.info("💾 Adding/updating user: %s (%s)", name, user_id)
+        async with connection() as conn:
+            # A new row starts with counts for anything sent before registering
+            await conn.execute('''
+                INSERT INTO telegram_users (user_id, name, phone, problems_count, feedbacks_count, ratings_count)
+                VALUES ($1, $2, $3,
+                        (SELECT COUNT(*) FROM telegram_problems WHERE user_id = $1),
+                        (SELECT COUNT(*) FROM telegram_feedbacks WHERE user_id = $1),
+                        (SELECT COUNT(*) FROM telegram_ratings WHERE user_id = $1))
+                ON CONFLICT (user_id) DO UPDATE SET
+                name = EXCLUDED.name,
+                phone = EXCLUDED.phone
+            ''', user_id, name, phone)
+        logger.debug("✅ User saved successfully: %s (%s)", name, user_id)
+    except Exception as e:
+        logger.error(f"❌ Error adding user {user_id}: {e}")
+        raise
+
+async def _queue_notifications(conn, event_key, chat_ids, notification):
+    """Queues one outbox row per chat; the dedupe key makes a repeated event a no-op."""
+    if not notification:
+        return
+    payload = json.dumps(notification, ensure_ascii=False)
+    await conn.executemany('''
+        INSERT INTO telegram_outbox (dedupe_key, chat_id, kind, payload)
+        VALUES ($1, $2, $3, $4::jsonb)
+        ON CONFLICT (dedupe_key) DO NOTHING
+    ''', [(f"{event_key}:{chat_id}", chat_id, notification["kind"], payload) for chat_id in chat_ids])
+
+async def add_problem(user_id, description, media_type, file_id=None, latitude=None, longitude=None,
+                      notify_chat_ids=(), notification=None, event_key=None):
+    """Adds a new problem report, plus its admin notifications in the same transaction.
+
+    ``event_key`` names the Telegram message it came from, so a redelivered
+    update queues no second notification.
+    """
+    try:
+        logger.info("📝 Adding problem report from user %s: %s...", user_id, description[:50])
+        async with connection() as conn, conn.transaction():
+            problem_id = await conn.fetchval('''
+                INSERT INTO telegram_problems (user_id, description, media_type, file_id, latitude, longitude, status)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                RETURNING id
+            ''', user_id, description, media_type, file_id, latitude, longitude, 'Kutilmoqda')
+            await _queue_notifications(conn, f"problem:{event_key or problem_id}", notify_chat_ids, notification)
+        logger.debug("✅ Problem report saved successfully: ID %s", problem_id)
+        return problem_id
+    except Exception as e:
+        logger.error(f"❌ Error adding problem for user {user_id}: {e}")
+        raise
+
+async def update_problem_status(problem_id, status):
+    """Updates the status of a problem."""
+    try:
+        async with connection() as conn:
+            await conn.execute('''
+                UPDATE telegram_problems SET status = $1 WHERE id = $2
+            ''', status, problem_id)
+    except Exception as e:
+        logger.error(f"Error updating problem status: {e}")
+
+async def add_rating(user_id, rating):
+    """Adds a new rating."""
+    try:
+        async with connection() as conn:
+            await conn.execute('''
+                INSERT INTO telegram_ratings (user_id, rating)
+                VALUES ($1, $2)
+            ''', user_id, rating)
+    except Exception as e:
+        logger.error(f"Error adding rating: {e}")
+
+async def add_feedback(user_id, text, notify_chat_ids=(), notification=None, event_key=None):
+    """Adds a new feedback, plus its admin notifications in the same transaction.
+
+    ``event_key`` names the Telegram message it came from, so a redelivered
+    update queues no second notification.
+    """
+    try:
+        async with connection() as conn, conn.transaction():
+            await conn.execute('''
+                INSERT INTO telegram_feedbacks (user_id, text)
+                VALUES ($1, $2)
+            ''', user_id, text)
+            await _queue_notifications(conn, f"feedback:{event_key or uuid.uuid4().hex}", notify_chat_ids, notification)
+    except Exception as e:
+        logger.error(f"Error adding feedback: {e}")
+
+async def get_counters():
+    """Returns the trigger-maintained row counters as a dict."""
+    try:
+        async with connection() as conn:
+            rows = await conn.fetch('SELECT name, value FROM telegram_counters')
+        return {row['name']: row['value'] for row in rows}
+    except Exception as e:
+        logger.error(f"Error getting counters: {e}")
+        return {}
+
+async def get_stats():
+    """Returns total number of problems and subscribers from the counters table."""
+    counters = await get_counters()
+    return counters.get("problems", 0), counters.get("subscribers", 0)
+
+async def get_recent_problems(limit=10):
+    """Returns the most recent problem reports with user details."""
+    try:
+        async with connection() as conn:
+            rows = await conn.fetch('''
+                SELECT p.description, p.media_type, u.name, u.phone, p.created_at,
+                       p.latitude, p.longitude, p.status, p.id
+                FROM telegram_problems p
+                JOIN telegram_users u ON p.user_id = u.user_id
+                ORDER BY p.created_at DESC
+                LIMIT $1
+            ''', limit)
+        return [tuple(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting recent problems: {e}")
+        return []
+
+async def get_user_problems(user_id, limit=5):
+    """Returns the most recent problem reports for a specific user."""
+    try:
+        async with connection() as conn:
+            rows = await conn.fetch('''
+                SELECT description, status, created_at
+                FROM telegram_problems
+                WHERE user_id = $1
+                ORDER BY created_at DESC
+                LIMIT $2
+            ''', user_id, limit)
+        return [tuple(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting user problems: {e}")
+        return []
+
+async def get_recent_feedbacks(limit=10):
+    """Returns the most recent feedbacks with user details."""
+    try:
+        async with connection() as conn:
+            rows = await conn.fetch('''
+                SELECT f.text, u.name, u.phone, f.created_at
+                FROM telegram_feedbacks f
+                JOIN telegram_users u ON f.user_id = u.user_id
+                ORDER BY f.created_at DESC
+                LIMIT $1
+            ''', limit)
+        return [tuple(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting recent feedbacks: {e}")
+        return []
+
+async def get_user_info(user_id):
+    """Returns user information by user_id."""
+    try:
+        logger.debug("🔍 Getting user info for %s", user_id)
+        async with connection() as conn:
+            row = await conn.fetchrow('''
+                SELECT name, phone
+                FROM telegram_users
+                WHERE user_id = $1
+            ''', user_id)
+        if row:
+            logger.debug("✅ User info found for %s: %s", user_id, row[0])
+            return tuple(row)
+        logger.debug("❌ No user info found for %s", user_id)
+        return None
+    except Exception as e:
+        logger.error(f"❌ Error getting user info for {user_id}: {e}")
+        return None
+
+async def get_all_users():
+    """Returns all users with their statistics."""
+    try:
+        async with connection() as conn:
+            rows = await conn.fetch('''
+                SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                FROM telegram_users
+                ORDER BY created_at DESC
+            ''')
+        return [tuple(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting all users: {e}")
+        return []
+
+async def backfill_counters():
+    """Recomputes per-user activity counts and the global row counters from the tables."""
+    async with connection() as conn:
+        async with conn.transaction():
+            status = await conn.execute(BACKFILL_USER_ACTIVITY)
+            for counter, table in COUNTED_TABLES:
+                await conn.execute(
+                    f'UPDATE telegram_counters SET value = (SELECT COUNT(*) FROM {table}) WHERE name = $1',
+                    counter
+                )
+    return _rowcount(status)
+
+async def get_user_count():
+    """Returns the number of registered users from the counters table."""
+    return (await get_counters()).get("users", 0)
+
+def _keyset(cursor):
+    """Cursors travel through callback data as text; asyncpg wants a datetime."""
+    created_at, user_id = cursor
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    return created_at, int(user_id)
+
+async def get_users_page(limit=10, after=None, before=None):
+    """Returns one page of users, newest first, plus whether more pages exist.
+
+    Keyset pagination on (created_at, user_id); see database.get_users_page.
+    """
+    if before is not None:
+        where, order, params = 'WHERE (created_at, user_id) > ($1, $2)', 'ASC', _keyset(before)
+    elif after is not None:
+        where, order, params = 'WHERE (created_at, user_id) < ($1, $2)', 'DESC', _keyset(after)
+    else:
+        where, order, params = '', 'DESC', ()
+    
+    try:
+        async with connection() as conn:
+            rows = await conn.fetch(f'''
+                SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                FROM telegram_users
+                {where}
+                ORDER BY created_at {order}, user_id {order}
+                LIMIT ${len(params) + 1}
+            ''', *params, limit + 1)
+    except Exception as e:
+        logger.error(f"Error getting users page: {e}")
+        return [], False
+    
+    users = [tuple(row) for row in rows[:limit]]
+    if before is not None:
+        users.reverse()
+    return users, len(rows) > limit
+
+async def delete_user_completely(user_id):
+    """Completely deletes a user and all their data."""
+    try:
+        async with connection() as conn:
+            async with conn.transaction():
+                user_info = await conn.fetchrow('SELECT name, phone FROM telegram_users WHERE user_id = $1', user_id)
+
+                if not user_info:
+                    return False, "Foydalanuvchi topilmadi"
+
+                name, phone = user_info
+
+                problems_deleted = _rowcount(await conn.execute('DELETE FROM telegram_problems WHERE user_id = $1', user_id))
+                feedbacks_deleted = _rowcount(await conn.execute('DELETE FROM telegram_feedbacks WHERE user_id = $1', user_id))
+                ratings_deleted = _rowcount(await conn.execute('DELETE FROM telegram_ratings WHERE user_id = $1', user_id))
+                await conn.execute('DELETE FROM telegram_subscribers WHERE user_id = $1', user_id)
+                await conn.execute('DELETE FROM telegram_user_data WHERE user_id = $1', user_id)
+                await conn.execute('DELETE FROM telegram_users WHERE user_id = $1', user_id)
+
+        return True, f"{name} to'liq o'chirildi (Murojaatlar: {problems_deleted}, Fikrlar: {feedbacks_deleted}, Reytinglar: {ratings_deleted})"
+    except Exception as e:
+        logger.error(f"❌ Error deleting user {user_id}: {e}")
+        raise
+
+async def search_users(query, limit=10):
+    """Searches users by name, phone or ID, best matches first (pg_trgm indexes)."""
+    digits, text = parse_search_query(query)
+    if not (digits or text):
+        return []
+    
+    try:
+        async with connection() as conn:
+            if digits:
+                # Raqam foydalanuvchi ID'si bo'lsa, u birinchi o'rinda turadi
+                rows = await conn.fetch('''
+                    SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                    FROM telegram_users
+                    WHERE phone_digits LIKE $1 OR user_id = $3
+                    ORDER BY user_id = $3 DESC, similarity(phone_digits, $2) DESC, created_at DESC
+                    LIMIT $4
+                ''', f"%{digits}%", digits, exact_user_id(digits), limit)
+            else:
+                rows = await conn.fetch('''
+                    SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                    FROM telegram_users
+                    WHERE name ILIKE $1
+                    ORDER BY similarity(name, $2) DESC, created_at DESC
+                    LIMIT $3
+                ''', f"%{text}%", text, limit)
+        return [tuple(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error searching users: {e}")
+        return []
+
+# Admin notification outbox
+async def claim_notifications(limit=20, lease=60):
+    """Claims due notifications for sending: [(id, chat_id, payload, attempts)].
+
+    SKIP LOCKED lets several workers drain the outbox without sending a
+    row twice; an unfinished claim becomes claimable after ``lease`` seconds.
+    """
+    async with connection() as conn:
+        rows = await conn.fetch('''
+            UPDATE telegram_outbox SET status = 'sending', claimed_at = now(), attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM telegram_outbox
+                WHERE (status = 'pending' AND next_attempt_at <= now())
+                   OR (status = 'sending' AND claimed_at <= now() - make_interval(secs => $1))
+                ORDER BY next_attempt_at
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, payload, attempts
+        ''', float(lease), limit)
+    return [(row["id"], row["chat_id"], json.loads(row["payload"]), row["attempts"]) for row in rows]
+
+async def mark_notification_sent(notification_id):
+    async with connection() as conn:
+        await conn.execute(
+            "UPDATE telegram_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = $1",
+            notification_id
+        )
+
+async def update_notification_payload(notification_id, payload):
+    """Stores the payload with its delivery progress (see notifications.send_report)."""
+    async with connection() as conn:
+        await conn.execute(
+            "UPDATE telegram_outbox SET payload = $1::jsonb WHERE id = $2",
+            json.dumps(payload, ensure_ascii=False), notification_id
+        )
+
+async def retry_notification(notification_id, delay, error):
+    """Puts a notification back in the queue, due again in ``delay`` seconds."""
+    async with connection() as conn:
+        await conn.execute('''
+            UPDATE telegram_outbox
+            SET status = 'pending', next_attempt_at = now() + make_interval(secs => $1), last_error = $2
+            WHERE id = $3
+        ''', float(delay), error, notification_id)
+
+async def dead_letter_notification(notification_id, error):
+    """Gives up on a notification; it stays visible in the admin panel."""
+    async with connection() as conn:
+        await conn.execute(
+            "UPDATE telegram_outbox SET status = 'dead', last_error = $1 WHERE id = $2",
+            error, notification_id
+        )
+
+async def requeue_dead_notifications():
+    """Moves every dead notification back to the queue; returns how many."""
+    async with connection() as conn:
+        status = await conn.execute(
+            "UPDATE telegram_outbox SET status = 'pending', attempts = 0, next_attempt_at = now() WHERE status = 'dead'"
+        )
+    return _rowcount(status)
+
+async def get_dead_notifications(limit=10):
+    """Returns the latest dead notifications: (id, chat_id, kind, attempts, last_error, created_at)."""
+    async with connection() as conn:
+        rows = await conn.fetch('''
+            SELECT id, chat_id, kind, attempts, last_error, created_at
+            FROM telegram_outbox
+            WHERE status = 'dead'
+            ORDER BY id DESC
+            LIMIT $1
+        ''', limit)
+    return [tuple(row) for row in rows]
+
+async def outbox_stats():
+    """Returns the number of notifications per status."""
+    async with connection() as conn:
+        rows = await conn.fetch('''
+            SELECT status, COUNT(*) FROM telegram_outbox
+            WHERE status != 'sent'
+            GROUP BY status
+        ''')
+    stats = {"pending": 0, "sending": 0, "dead": 0}
+    stats.update({row[0]: row[1] for row in rows})
+    return stats
+
+async def prune_notifications(older_than_days=7):
+    """Deletes sent notifications older than the retention period."""
+    async with connection() as conn:
+        status = await conn.execute('''
+            DELETE FROM telegram_outbox
+            WHERE status = 'sent' AND sent_at < CURRENT_TIMESTAMP - make_interval(days => $1)
+        ''', older_than_days)
+    return _rowcount(status)
+
+# Broadcasts
+BROADCAST_COLUMNS = 'id, text, created_by, status, last_user_id, total, sent, failed, blocked, created_at, finished_at'
+
+async def create_broadcast(text, created_by):
+    """Creates a draft broadcast to every current subscriber; returns its id."""
+    async with connection() as conn:
+        return await conn.fetchval('''
+            INSERT INTO telegram_broadcasts (text, created_by, total)
+            VALUES ($1, $2, (SELECT value FROM telegram_counters WHERE name = 'subscribers'))
+            RETURNING id
+        ''', text, created_by)
+
+async def get_broadcast(broadcast_id):
+    """Returns (id, text, created_by, status, last_user_id, total, sent, failed, blocked, created_at, finished_at)."""
+    async with connection() as conn:
+        row = await conn.fetchrow(f'SELECT {BROADCAST_COLUMNS} FROM telegram_broadcasts WHERE id = $1', broadcast_id)
+    return tuple(row) if row else None
+
+async def set_broadcast_status(broadcast_id, status, from_status):
+    """Moves a broadcast from ``from_status`` to ``status``; returns False if it was not in it."""
+    async with connection() as conn:
+        result = await conn.execute('''
+            UPDATE telegram_broadcasts
+            SET status = $1,
+                finished_at = CASE WHEN $1 IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END
+            WHERE id = $2 AND status = $3
+        ''', status, broadcast_id, from_status)
+    return _rowcount(result) > 0
+
+async def get_running_broadcasts():
+    """Returns the ids of broadcasts to resume after a restart."""
+    async with connection() as conn:
+        rows = await conn.fetch("SELECT id FROM telegram_broadcasts WHERE status = 'running' ORDER BY id")
+    return [row["id"] for row in rows]
+
+async def recover_broadcast(broadcast_id):
+    """Marks recipients that were in flight when the process died as 'unknown'.
+
+    They may already have the message, so they are not sent to again.
+    """
+    async with connection() as conn:
+        status = await conn.execute(
+            "UPDATE telegram_broadcast_deliveries SET status = 'unknown' WHERE broadcast_id = $1 AND status = 'pending'",
+            broadcast_id
+        )
+    return _rowcount(status)
+
+async def release_broadcast_recipients(broadcast_id, user_ids):
+    """Gives back claimed recipients that were never sent to (shutdown mid-chunk).
+
+    Their 'pending' rows are dropped and the cursor moved back before
+    them, so the next claim picks them up again.
+    """
+    if not user_ids:
+        return
+    async with connection() as conn, conn.transaction():
+        await conn.execute(
+            "DELETE FROM telegram_broadcast_deliveries "
+            "WHERE broadcast_id = $1 AND user_id = ANY($2::bigint[]) AND status = 'pending'",
+            broadcast_id, list(user_ids)
+        )
+        await conn.execute(
+            'UPDATE telegram_broadcasts SET last_user_id = LEAST(last_user_id, $1) WHERE id = $2',
+            min(user_ids) - 1, broadcast_id
+        )
+
+async def claim_broadcast_chunk(broadcast_id, limit=500):
+    """Takes the next ``limit`` subscribers after the broadcast's cursor.
+
+    The recipients are logged as 'pending' and the cursor advanced in one
+    transaction (the broadcast row is locked), so every subscriber is
+    claimed at most once; users who already have a delivery row are
+    skipped (see release_broadcast_recipients).
+    """
+    async with connection() as conn, conn.transaction():
+        last_user_id = await conn.fetchval(
+            "SELECT last_user_id FROM telegram_broadcasts WHERE id = $1 AND status = 'running' FOR UPDATE",
+            broadcast_id
+        )
+        if last_user_id is None:
+            return []
+        rows = await conn.fetch(
+            'SELECT user_id FROM telegram_subscribers s WHERE user_id > $1 AND NOT EXISTS '
+            '(SELECT 1 FROM telegram_broadcast_deliveries d WHERE d.broadcast_id = $2 AND d.user_id = s.user_id) '
+            'ORDER BY user_id LIMIT $3',
+            last_user_id, broadcast_id, limit
+        )
+        user_ids = [row["user_id"] for row in rows]
+        if user_ids:
+            await conn.execute('''
+                INSERT INTO telegram_broadcast_deliveries (broadcast_id, user_id)
+                SELECT $1, unnest($2::bigint[])
+                ON CONFLICT DO NOTHING
+            ''', broadcast_id, user_ids)
+            await conn.execute(
+                'UPDATE telegram_broadcasts SET last_user_id = $1 WHERE id = $2', user_ids[-1], broadcast_id
+            )
+    return user_ids
+
+async def record_broadcast_results(broadcast_id, sent_ids, failed_ids, blocked_ids):
+    """Stores a chunk's outcome and unsubscribes the users who blocked the bot."""
+    async with connection() as conn, conn.transaction():
+        for status, user_ids in (('sent', sent_ids), ('failed', failed_ids), ('blocked', blocked_ids)):
+            if user_ids:
+                await conn.execute('''
+                    UPDATE telegram_broadcast_deliveries SET status = $1
+                    WHERE broadcast_id = $2 AND user_id = ANY($3::bigint[])
+                ''', status, broadcast_id, list(user_ids))
+        await conn.execute('''
+            UPDATE telegram_broadcasts SET sent = sent + $1, failed = failed + $2, blocked = blocked + $3
+            WHERE id = $4
+        ''', len(sent_ids), len(failed_ids), len(blocked_ids), broadcast_id)
+        if blocked_ids:
+            await conn.execute('DELETE FROM telegram_subscribers WHERE user_id = ANY($1::bigint[])', list(blocked_ids))
+
+async def load_user_data(user_id):
+    """Returns the stored user_data of a user, or None if there is none."""
+    async with connection() as conn:
+        data = await conn.fetchval('SELECT data FROM telegram_user_data WHERE user_id = $1', user_id)
+    return json.loads(data) if data is not None else None
+
+async def save_user_data(items):
+    """Writes a batch of (user_id, data_json) in one transaction; None deletes the entry."""
+    saved = [(user_id, data) for user_id, data in items if data is not None]
+    deleted = [user_id for user_id, data in items if data is None]
+    async with connection() as conn, conn.transaction():
+        if saved:
+            await conn.executemany('''
+                INSERT INTO telegram_user_data (user_id, data, updated_at)
+                VALUES ($1, $2::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+            ''', saved)
+        if deleted:
+            await conn.execute('DELETE FROM telegram_user_data WHERE user_id = ANY($1::bigint[])', deleted)
+
+async def load_conversations(name):
+    """Returns [(key_json, state)] of a persistent ConversationHandler."""
+    async with connection() as conn:
+        rows = await conn.fetch('SELECT key, state FROM telegram_conversations WHERE name = $1', name)
+    return [(row["key"], row["state"]) for row in rows]
+
+async def save_conversations(name, items):
+    """Writes a batch of (key_json, state) in one transaction; None ends the conversation."""
+    saved = [(name, key, state) for key, state in items if state is not None]
+    deleted = [key for key, state in items if state is None]
+    async with connection() as conn, conn.transaction():
+        if saved:
+            await conn.executemany('''
+                INSERT INTO telegram_conversations (name, key, state) VALUES ($1, $2, $3)
+                ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state
+            ''', saved)
+        if deleted:
+            await conn.execute(
+                'DELETE FROM telegram_conversations WHERE name = $1 AND key = ANY($2::text[])', name, deleted
+            )
+
+# Backward compatibility - stats.json uchun
+def update_stats_json():
+    """Dummy function for backward compatibility"""
+    pass
+
+async def close_connections():
+    """Closes the connection pool (call on shutdown)."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
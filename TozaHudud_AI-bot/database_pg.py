@@ -2,391 +2,787 @@ import psycopg2
 import logging
 import json
 import os
+import threading
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from psycopg2.extras import Json, RealDictCursor
+
+from db_session import Session, active_session
+from pg_migrations import (
+    BACKFILL_USER_ACTIVITY,
+    COUNTED_TABLES,
+    CREATE_MIGRATIONS_TABLE,
+    CURRENT_VERSION_QUERY,
+    MIGRATION_LOCK_ID,
+    MIGRATIONS,
+    MIGRATIONS_TABLE,
+    SCHEMA_VERSION,
+)
+from pg_pool import PG_CONNECTION_FACTORY, ConnectionPool
+from search_utils import exact_user_id, parse_search_query
 
 logger = logging.getLogger(__name__)
 
 # PostgreSQL connection from environment variable
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool settings (can be overridden from environment)
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "5"))
+PG_POOL_MAX_LIFETIME = float(os.getenv("PG_POOL_MAX_LIFETIME", "1800"))
+PG_POOL_IDLE_CHECK = float(os.getenv("PG_POOL_IDLE_CHECK", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the shared connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=PG_POOL_MIN_SIZE,
+                    max_size=PG_POOL_MAX_SIZE,
+                    timeout=PG_POOL_TIMEOUT,
+                    max_lifetime=PG_POOL_MAX_LIFETIME,
+                    idle_check=PG_POOL_IDLE_CHECK,
+                )
+    return _pool
+
 def get_connection():
-    """Get PostgreSQL connection"""
-    return psycopg2.connect(DATABASE_URL)
+    """Get a raw PostgreSQL connection (outside the pool, for scripts)"""
+    return psycopg2.connect(DATABASE_URL, connection_factory=PG_CONNECTION_FACTORY)
+
+@contextmanager
+def connection():
+    """Borrows a pooled connection; commits on success and rolls back on error.
+
+    Inside a per-update session the session's connection is reused and the
+    commit is left to the session. Each call runs in a savepoint, so a
+    failing statement undoes only that call, not the update's other writes.
+    """
+    session = active_session()
+    if session is not None:
+        conn = session.connection()
+        conn.savepoint()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            conn.release_savepoint()
+            raise
+        # A read that caught its own error leaves the transaction aborted
+        if conn.info.transaction_status == TRANSACTION_STATUS_INERROR:
+            conn.rollback()
+        conn.release_savepoint()
+        return
+    with get_pool().connection() as conn:
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+def open_session():
+    """Returns a lazy per-update session (see db_session.Session)."""
+    return Session(lambda: get_pool().getconn(), lambda conn: get_pool().putconn(conn))
+
+def pool_stats():
+    """Returns connection pool statistics (in-use, waiting, checkout latency)."""
+    return get_pool().stats()
 
 def init_db():
-    """Initializes the database and creates tables if they don't exist."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    try:
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS telegram_users (
-                user_id BIGINT PRIMARY KEY,
-                name TEXT,
-                phone TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create problems table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS telegram_problems (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES telegram_users(user_id),
-                description TEXT,
-                media_type TEXT,
-                file_id TEXT,
-                latitude REAL,
-                longitude REAL,
-                status TEXT DEFAULT 'Kutilmoqda',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create subscribers table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS telegram_subscribers (
-                user_id BIGINT PRIMARY KEY,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create ratings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS telegram_ratings (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES telegram_users(user_id),
-                rating INTEGER CHECK (rating >= 1 AND rating <= 5),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create feedbacks table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS telegram_feedbacks (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES telegram_users(user_id),
-                text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        logger.info("PostgreSQL database initialized.")
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    """Brings the schema up to date; does no DDL at all when it already is.
+
+    Each migration commits together with its version row, so a failure
+    keeps the ones before it. The error is raised: the bot must not start
+    on a half-migrated schema.
+    """
+    get_pool().open()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(CURRENT_VERSION_QUERY)
+            version = cursor.fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                logger.info("PostgreSQL schema is up to date (v%s).", version)
+                return
+            
+            for number, description, statements in MIGRATIONS:
+                if number <= version:
+                    continue
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+                cursor.execute(CREATE_MIGRATIONS_TABLE)
+                # Another process may have migrated while we waited for the lock
+                cursor.execute(CURRENT_VERSION_QUERY)
+                if cursor.fetchone()[0] >= number:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    f'INSERT INTO {MIGRATIONS_TABLE} (version, description) VALUES (%s, %s)',
+                    (number, description)
+                )
+                conn.commit()
+                logger.info("Applied migration %s: %s", number, description)
+            logger.info("PostgreSQL database initialized.")
+        except Exception as e:
+            logger.error(f"Error initializing database: {e}")
+            raise
+        finally:
+            cursor.close()
 
 def add_subscriber(user_id):
     """Adds a new subscriber if they don't exist."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO telegram_subscribers (user_id)
-            VALUES (%s)
-            ON CONFLICT (user_id) DO NOTHING
-        ''', (user_id,))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error adding subscriber: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO telegram_subscribers (user_id)
+                VALUES (%s)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', (user_id,))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error adding subscriber: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def touch_user(user_id):
+    """Records the subscriber and returns their (name, phone) in a single statement."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                WITH subscriber AS (
+                    INSERT INTO telegram_subscribers (user_id)
+                    VALUES (%(user_id)s)
+                    ON CONFLICT (user_id) DO NOTHING
+                )
+                SELECT name, phone FROM telegram_users WHERE user_id = %(user_id)s
+            ''', {"user_id": user_id})
+            return cursor.fetchone()
+        finally:
+            cursor.close()
 
 def add_user(user_id, name, phone):
     """Adds a new user or updates an existing one."""
     try:
-        logger.info(f"💾 Adding/updating user: {name} ({user_id})")
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO telegram_users (user_id, name, phone)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET
-            name = EXCLUDED.name,
-            phone = EXCLUDED.phone
-        ''', (user_id, name, phone))
-        conn.commit()
-        logger.debug(f"✅ User saved successfully: {name} ({user_id})")
+        logger.info("💾 Adding/updating user: %s (%s)", name, user_id)
+        with connection() as conn, conn.cursor() as cursor:
+            # A new row starts with counts for anything sent before registering
+            cursor.execute('''
+                INSERT INTO telegram_users (user_id, name, phone, problems_count, feedbacks_count, ratings_count)
+                VALUES (%(user_id)s, %(name)s, %(phone)s,
+                        (SELECT COUNT(*) FROM telegram_problems WHERE user_id = %(user_id)s),
+                        (SELECT COUNT(*) FROM telegram_feedbacks WHERE user_id = %(user_id)s),
+                        (SELECT COUNT(*) FROM telegram_ratings WHERE user_id = %(user_id)s))
+                ON CONFLICT (user_id) DO UPDATE SET
+                name = EXCLUDED.name,
+                phone = EXCLUDED.phone
+            ''', {"user_id": user_id, "name": name, "phone": phone})
+        logger.debug("✅ User saved successfully: %s (%s)", name, user_id)
     except Exception as e:
         logger.error(f"❌ Error adding user {user_id}: {e}")
-        conn.rollback()
         raise
-    finally:
-        cursor.close()
-        conn.close()
 
-def add_problem(user_id, description, media_type, file_id=None, latitude=None, longitude=None):
-    """Adds a new problem report."""
-    try:
-        logger.info(f"📝 Adding problem report from user {user_id}: {description[:50]}...")
-        conn = get_connection()
-        cursor = conn.cursor()
+def _queue_notifications(cursor, event_key, chat_ids, notification):
+    """Queues one outbox row per chat; the dedupe key makes a repeated event a no-op."""
+    if not notification:
+        return
+    for chat_id in chat_ids:
         cursor.execute('''
-            INSERT INTO telegram_problems (user_id, description, media_type, file_id, latitude, longitude, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (user_id, description, media_type, file_id, latitude, longitude, 'Kutilmoqda'))
-        problem_id = cursor.fetchone()[0]
-        conn.commit()
-        logger.debug(f"✅ Problem report saved successfully: ID {problem_id}")
+            INSERT INTO telegram_outbox (dedupe_key, chat_id, kind, payload)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (dedupe_key) DO NOTHING
+        ''', (f"{event_key}:{chat_id}", chat_id, notification["kind"], Json(notification)))
+
+def add_problem(user_id, description, media_type, file_id=None, latitude=None, longitude=None,
+                notify_chat_ids=(), notification=None, event_key=None):
+    """Adds a new problem report, plus its admin notifications in the same transaction.
+
+    ``event_key`` names the Telegram message it came from, so a redelivered
+    update queues no second notification.
+    """
+    try:
+        logger.info("📝 Adding problem report from user %s: %s...", user_id, description[:50])
+        with connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO telegram_problems (user_id, description, media_type, file_id, latitude, longitude, status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (user_id, description, media_type, file_id, latitude, longitude, 'Kutilmoqda'))
+            problem_id = cursor.fetchone()[0]
+            _queue_notifications(cursor, f"problem:{event_key or problem_id}", notify_chat_ids, notification)
+        logger.debug("✅ Problem report saved successfully: ID %s", problem_id)
         return problem_id
     except Exception as e:
         logger.error(f"❌ Error adding problem for user {user_id}: {e}")
-        conn.rollback()
         raise
-    finally:
-        cursor.close()
-        conn.close()
 
 def update_problem_status(problem_id, status):
     """Updates the status of a problem."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            UPDATE telegram_problems SET status = %s WHERE id = %s
-        ''', (status, problem_id))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error updating problem status: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                UPDATE telegram_problems SET status = %s WHERE id = %s
+            ''', (status, problem_id))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error updating problem status: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
 
 def add_rating(user_id, rating):
     """Adds a new rating."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO telegram_ratings (user_id, rating)
-            VALUES (%s, %s)
-        ''', (user_id, rating))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error adding rating: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
-
-def add_feedback(user_id, text):
-    """Adds a new feedback."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO telegram_feedbacks (user_id, text)
-            VALUES (%s, %s)
-        ''', (user_id, text))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error adding feedback: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO telegram_ratings (user_id, rating)
+                VALUES (%s, %s)
+            ''', (user_id, rating))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error adding rating: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def add_feedback(user_id, text, notify_chat_ids=(), notification=None, event_key=None):
+    """Adds a new feedback, plus its admin notifications in the same transaction.
+
+    ``event_key`` names the Telegram message it came from, so a redelivered
+    update queues no second notification.
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO telegram_feedbacks (user_id, text)
+                VALUES (%s, %s)
+            ''', (user_id, text))
+            _queue_notifications(cursor, f"feedback:{event_key or uuid.uuid4().hex}", notify_chat_ids, notification)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error adding feedback: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+def get_counters():
+    """Returns the trigger-maintained row counters as a dict."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT name, value FROM telegram_counters')
+            return dict(cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Error getting counters: {e}")
+            return {}
+        finally:
+            cursor.close()
 
 def get_stats():
-    """Returns total number of users and problems."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('SELECT COUNT(*) FROM telegram_problems')
-        total_problems = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM telegram_subscribers')
-        total_subscribers = cursor.fetchone()[0]
-        return total_problems, total_subscribers
-    except Exception as e:
-        logger.error(f"Error getting stats: {e}")
-        return 0, 0
-    finally:
-        cursor.close()
-        conn.close()
+    """Returns total number of problems and subscribers from the counters table."""
+    counters = get_counters()
+    return counters.get("problems", 0), counters.get("subscribers", 0)
 
 def get_recent_problems(limit=10):
     """Returns the most recent problem reports with user details."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            SELECT p.description, p.media_type, u.name, u.phone, p.created_at, 
-                   p.latitude, p.longitude, p.status, p.id
-            FROM telegram_problems p
-            JOIN telegram_users u ON p.user_id = u.user_id
-            ORDER BY p.created_at DESC
-            LIMIT %s
-        ''', (limit,))
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"Error getting recent problems: {e}")
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT p.description, p.media_type, u.name, u.phone, p.created_at, 
+                       p.latitude, p.longitude, p.status, p.id
+                FROM telegram_problems p
+                JOIN telegram_users u ON p.user_id = u.user_id
+                ORDER BY p.created_at DESC
+                LIMIT %s
+            ''', (limit,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting recent problems: {e}")
+            return []
+        finally:
+            cursor.close()
 
 def get_user_problems(user_id, limit=5):
     """Returns the most recent problem reports for a specific user."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            SELECT description, status, created_at
-            FROM telegram_problems
-            WHERE user_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s
-        ''', (user_id, limit))
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"Error getting user problems: {e}")
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT description, status, created_at
+                FROM telegram_problems
+                WHERE user_id = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            ''', (user_id, limit))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting user problems: {e}")
+            return []
+        finally:
+            cursor.close()
 
 def get_recent_feedbacks(limit=10):
     """Returns the most recent feedbacks with user details."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            SELECT f.text, u.name, u.phone, f.created_at
-            FROM telegram_feedbacks f
-            JOIN telegram_users u ON f.user_id = u.user_id
-            ORDER BY f.created_at DESC
-            LIMIT %s
-        ''', (limit,))
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"Error getting recent feedbacks: {e}")
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT f.text, u.name, u.phone, f.created_at
+                FROM telegram_feedbacks f
+                JOIN telegram_users u ON f.user_id = u.user_id
+                ORDER BY f.created_at DESC
+                LIMIT %s
+            ''', (limit,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting recent feedbacks: {e}")
+            return []
+        finally:
+            cursor.close()
 
 def get_user_info(user_id):
     """Returns user information by user_id."""
     try:
-        logger.debug(f"🔍 Getting user info for {user_id}")
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT name, phone
-            FROM telegram_users
-            WHERE user_id = %s
-        ''', (user_id,))
-        user_info = cursor.fetchone()
+        logger.debug("🔍 Getting user info for %s", user_id)
+        with connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT name, phone
+                FROM telegram_users
+                WHERE user_id = %s
+            ''', (user_id,))
+            user_info = cursor.fetchone()
         if user_info:
-            logger.debug(f"✅ User info found for {user_id}: {user_info[0]}")
+            logger.debug("✅ User info found for %s: %s", user_id, user_info[0])
         else:
-            logger.debug(f"❌ No user info found for {user_id}")
+            logger.debug("❌ No user info found for %s", user_id)
         return user_info
     except Exception as e:
         logger.error(f"❌ Error getting user info for {user_id}: {e}")
         return None
-    finally:
-        cursor.close()
-        conn.close()
 
 def get_all_users():
     """Returns all users with their statistics."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            SELECT u.user_id, u.name, u.phone, u.created_at,
-                   COUNT(DISTINCT p.id) as problems_count,
-                   COUNT(DISTINCT f.id) as feedbacks_count,
-                   COUNT(DISTINCT r.id) as ratings_count
-            FROM telegram_users u
-            LEFT JOIN telegram_problems p ON u.user_id = p.user_id
-            LEFT JOIN telegram_feedbacks f ON u.user_id = f.user_id
-            LEFT JOIN telegram_ratings r ON u.user_id = r.user_id
-            GROUP BY u.user_id, u.name, u.phone, u.created_at
-            ORDER BY u.created_at DESC
-        ''')
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"Error getting all users: {e}")
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                FROM telegram_users
+                ORDER BY created_at DESC
+            ''')
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting all users: {e}")
+            return []
+        finally:
+            cursor.close()
+
+def backfill_counters():
+    """Recomputes per-user activity counts and the global row counters from the tables."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(BACKFILL_USER_ACTIVITY)
+            updated = cursor.rowcount
+            for counter, table in COUNTED_TABLES:
+                cursor.execute(
+                    f'UPDATE telegram_counters SET value = (SELECT COUNT(*) FROM {table}) WHERE name = %s',
+                    (counter,)
+                )
+            return updated
+        finally:
+            cursor.close()
+
+def get_user_count():
+    """Returns the number of registered users from the counters table."""
+    return get_counters().get("users", 0)
+
+def get_users_page(limit=10, after=None, before=None):
+    """Returns one page of users, newest first, plus whether more pages exist.
+
+    Keyset pagination on (created_at, user_id); see database.get_users_page.
+    """
+    if before is not None:
+        where, order, params = 'WHERE (created_at, user_id) > (%s, %s)', 'ASC', tuple(before)
+    elif after is not None:
+        where, order, params = 'WHERE (created_at, user_id) < (%s, %s)', 'DESC', tuple(after)
+    else:
+        where, order, params = '', 'DESC', ()
+    
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'''
+                SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                FROM telegram_users
+                {where}
+                ORDER BY created_at {order}, user_id {order}
+                LIMIT %s
+            ''', params + (limit + 1,))
+            users = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting users page: {e}")
+            return [], False
+        finally:
+            cursor.close()
+    
+    has_more = len(users) > limit
+    users = users[:limit]
+    if before is not None:
+        users.reverse()
+    return users, has_more
 
 def delete_user_completely(user_id):
     """Completely deletes a user and all their data."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('SELECT name, phone FROM telegram_users WHERE user_id = %s', (user_id,))
-        user_info = cursor.fetchone()
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT name, phone FROM telegram_users WHERE user_id = %s', (user_id,))
+            user_info = cursor.fetchone()
         
-        if not user_info:
-            return False, "Foydalanuvchi topilmadi"
+            if not user_info:
+                return False, "Foydalanuvchi topilmadi"
         
-        name, phone = user_info
+            name, phone = user_info
         
-        cursor.execute('DELETE FROM telegram_problems WHERE user_id = %s', (user_id,))
-        problems_deleted = cursor.rowcount
+            cursor.execute('DELETE FROM telegram_problems WHERE user_id = %s', (user_id,))
+            problems_deleted = cursor.rowcount
         
-        cursor.execute('DELETE FROM telegram_feedbacks WHERE user_id = %s', (user_id,))
-        feedbacks_deleted = cursor.rowcount
+            cursor.execute('DELETE FROM telegram_feedbacks WHERE user_id = %s', (user_id,))
+            feedbacks_deleted = cursor.rowcount
         
-        cursor.execute('DELETE FROM telegram_ratings WHERE user_id = %s', (user_id,))
-        ratings_deleted = cursor.rowcount
+            cursor.execute('DELETE FROM telegram_ratings WHERE user_id = %s', (user_id,))
+            ratings_deleted = cursor.rowcount
         
-        cursor.execute('DELETE FROM telegram_subscribers WHERE user_id = %s', (user_id,))
+            cursor.execute('DELETE FROM telegram_subscribers WHERE user_id = %s', (user_id,))
         
-        cursor.execute('DELETE FROM telegram_users WHERE user_id = %s', (user_id,))
+            cursor.execute('DELETE FROM telegram_user_data WHERE user_id = %s', (user_id,))
         
-        conn.commit()
+            cursor.execute('DELETE FROM telegram_users WHERE user_id = %s', (user_id,))
         
-        return True, f"{name} to'liq o'chirildi (Murojaatlar: {problems_deleted}, Fikrlar: {feedbacks_deleted}, Reytinglar: {ratings_deleted})"
+            return True, f"{name} to'liq o'chirildi (Murojaatlar: {problems_deleted}, Fikrlar: {feedbacks_deleted}, Reytinglar: {ratings_deleted})"
         
-    except Exception as e:
-        conn.rollback()
-        return False, f"Xatolik: {str(e)}"
-    finally:
-        cursor.close()
-        conn.close()
-
-def search_users(query):
-    """Search users by name or phone."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
+        except Exception as e:
+            logger.error(f"❌ Error deleting user {user_id}: {e}")
+            raise
+        finally:
+            cursor.close()
+
+def search_users(query, limit=10):
+    """Searches users by name, phone or ID, best matches first (pg_trgm indexes)."""
+    digits, text = parse_search_query(query)
+    if not (digits or text):
+        return []
+    
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if digits:
+                # Raqam foydalanuvchi ID'si bo'lsa, u birinchi o'rinda turadi
+                cursor.execute('''
+                    SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                    FROM telegram_users
+                    WHERE phone_digits LIKE %(pattern)s OR user_id = %(user_id)s
+                    ORDER BY user_id = %(user_id)s DESC, similarity(phone_digits, %(term)s) DESC, created_at DESC
+                    LIMIT %(limit)s
+                ''', {"pattern": f"%{digits}%", "term": digits, "user_id": exact_user_id(digits), "limit": limit})
+            else:
+                cursor.execute('''
+                    SELECT user_id, name, phone, created_at, problems_count, feedbacks_count, ratings_count
+                    FROM telegram_users
+                    WHERE name ILIKE %(pattern)s
+                    ORDER BY similarity(name, %(term)s) DESC, created_at DESC
+                    LIMIT %(limit)s
+                ''', {"pattern": f"%{text}%", "term": text, "limit": limit})
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error searching users: {e}")
+            return []
+        finally:
+            cursor.close()
+
+# Admin notification outbox
+def claim_notifications(limit=20, lease=60):
+    """Claims due notifications for sending: [(id, chat_id, payload, attempts)].
+
+    SKIP LOCKED lets several workers drain the outbox without sending a
+    row twice; an unfinished claim becomes claimable after ``lease`` seconds.
+    """
+    with connection() as conn, conn.cursor() as cursor:
         cursor.execute('''
-            SELECT u.user_id, u.name, u.phone, u.created_at,
-                   COUNT(DISTINCT p.id) as problems_count,
-                   COUNT(DISTINCT f.id) as feedbacks_count,
-                   COUNT(DISTINCT r.id) as ratings_count
-            FROM telegram_users u
-            LEFT JOIN telegram_problems p ON u.user_id = p.user_id
-            LEFT JOIN telegram_feedbacks f ON u.user_id = f.user_id
-            LEFT JOIN telegram_ratings r ON u.user_id = r.user_id
-            WHERE u.name LIKE %s OR u.phone LIKE %s OR CAST(u.user_id AS TEXT) LIKE %s
-            GROUP BY u.user_id, u.name, u.phone, u.created_at
-            ORDER BY u.created_at DESC
-        ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
+            UPDATE telegram_outbox SET status = 'sending', claimed_at = now(), attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM telegram_outbox
+                WHERE (status = 'pending' AND next_attempt_at <= now())
+                   OR (status = 'sending' AND claimed_at <= now() - make_interval(secs => %s))
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, payload, attempts
+        ''', (lease, limit))
         return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"Error searching users: {e}")
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+
+def mark_notification_sent(notification_id):
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE telegram_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = %s",
+            (notification_id,)
+        )
+
+def update_notification_payload(notification_id, payload):
+    """Stores the payload with its delivery progress (see notifications.send_report)."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE telegram_outbox SET payload = %s WHERE id = %s",
+            (Json(payload), notification_id)
+        )
+
+def retry_notification(notification_id, delay, error):
+    """Puts a notification back in the queue, due again in ``delay`` seconds."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            UPDATE telegram_outbox
+            SET status = 'pending', next_attempt_at = now() + make_interval(secs => %s), last_error = %s
+            WHERE id = %s
+        ''', (delay, error, notification_id))
+
+def dead_letter_notification(notification_id, error):
+    """Gives up on a notification; it stays visible in the admin panel."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE telegram_outbox SET status = 'dead', last_error = %s WHERE id = %s",
+            (error, notification_id)
+        )
+
+def requeue_dead_notifications():
+    """Moves every dead notification back to the queue; returns how many."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE telegram_outbox SET status = 'pending', attempts = 0, next_attempt_at = now() WHERE status = 'dead'"
+        )
+        return cursor.rowcount
+
+def get_dead_notifications(limit=10):
+    """Returns the latest dead notifications: (id, chat_id, kind, attempts, last_error, created_at)."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            SELECT id, chat_id, kind, attempts, last_error, created_at
+            FROM telegram_outbox
+            WHERE status = 'dead'
+            ORDER BY id DESC
+            LIMIT %s
+        ''', (limit,))
+        return cursor.fetchall()
+
+def outbox_stats():
+    """Returns the number of notifications per status."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            SELECT status, COUNT(*) FROM telegram_outbox
+            WHERE status != 'sent'
+            GROUP BY status
+        ''')
+        rows = cursor.fetchall()
+    stats = {"pending": 0, "sending": 0, "dead": 0}
+    stats.update(dict(rows))
+    return stats
+
+def prune_notifications(older_than_days=7):
+    """Deletes sent notifications older than the retention period."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            DELETE FROM telegram_outbox
+            WHERE status = 'sent' AND sent_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+        ''', (older_than_days,))
+        return cursor.rowcount
+
+# Broadcasts
+BROADCAST_COLUMNS = 'id, text, created_by, status, last_user_id, total, sent, failed, blocked, created_at, finished_at'
+
+def create_broadcast(text, created_by):
+    """Creates a draft broadcast to every current subscriber; returns its id."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO telegram_broadcasts (text, created_by, total)
+            VALUES (%s, %s, (SELECT value FROM telegram_counters WHERE name = 'subscribers'))
+            RETURNING id
+        ''', (text, created_by))
+        return cursor.fetchone()[0]
+
+def get_broadcast(broadcast_id):
+    """Returns (id, text, created_by, status, last_user_id, total, sent, failed, blocked, created_at, finished_at)."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f'SELECT {BROADCAST_COLUMNS} FROM telegram_broadcasts WHERE id = %s', (broadcast_id,))
+        return cursor.fetchone()
+
+def set_broadcast_status(broadcast_id, status, from_status):
+    """Moves a broadcast from ``from_status`` to ``status``; returns False if it was not in it."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            UPDATE telegram_broadcasts
+            SET status = %(status)s,
+                finished_at = CASE WHEN %(status)s IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END
+            WHERE id = %(id)s AND status = %(from_status)s
+        ''', {"status": status, "id": broadcast_id, "from_status": from_status})
+        return cursor.rowcount > 0
+
+def get_running_broadcasts():
+    """Returns the ids of broadcasts to resume after a restart."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT id FROM telegram_broadcasts WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in cursor.fetchall()]
+
+def recover_broadcast(broadcast_id):
+    """Marks recipients that were in flight when the process died as 'unknown'.
+
+    They may already have the message, so they are not sent to again.
+    """
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "UPDATE telegram_broadcast_deliveries SET status = 'unknown' WHERE broadcast_id = %s AND status = 'pending'",
+            (broadcast_id,)
+        )
+        return cursor.rowcount
+
+def release_broadcast_recipients(broadcast_id, user_ids):
+    """Gives back claimed recipients that were never sent to (shutdown mid-chunk).
+
+    Their 'pending' rows are dropped and the cursor moved back before
+    them, so the next claim picks them up again.
+    """
+    if not user_ids:
+        return
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM telegram_broadcast_deliveries "
+            "WHERE broadcast_id = %s AND user_id = ANY(%s::bigint[]) AND status = 'pending'",
+            (broadcast_id, list(user_ids))
+        )
+        cursor.execute(
+            'UPDATE telegram_broadcasts SET last_user_id = LEAST(last_user_id, %s) WHERE id = %s',
+            (min(user_ids) - 1, broadcast_id)
+        )
+
+def claim_broadcast_chunk(broadcast_id, limit=500):
+    """Takes the next ``limit`` subscribers after the broadcast's cursor.
+
+    The recipients are logged as 'pending' and the cursor advanced in one
+    transaction (the broadcast row is locked), so every subscriber is
+    claimed at most once; users who already have a delivery row are
+    skipped (see release_broadcast_recipients).
+    """
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT last_user_id FROM telegram_broadcasts WHERE id = %s AND status = 'running' FOR UPDATE",
+            (broadcast_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return []
+        cursor.execute(
+            'SELECT user_id FROM telegram_subscribers s WHERE user_id > %s AND NOT EXISTS '
+            '(SELECT 1 FROM telegram_broadcast_deliveries d WHERE d.broadcast_id = %s AND d.user_id = s.user_id) '
+            'ORDER BY user_id LIMIT %s',
+            (row[0], broadcast_id, limit)
+        )
+        user_ids = [user_id for (user_id,) in cursor.fetchall()]
+        if user_ids:
+            cursor.execute('''
+                INSERT INTO telegram_broadcast_deliveries (broadcast_id, user_id)
+                SELECT %s, unnest(%s::bigint[])
+                ON CONFLICT DO NOTHING
+            ''', (broadcast_id, user_ids))
+            cursor.execute(
+                'UPDATE telegram_broadcasts SET last_user_id = %s WHERE id = %s', (user_ids[-1], broadcast_id)
+            )
+        return user_ids
+
+def record_broadcast_results(broadcast_id, sent_ids, failed_ids, blocked_ids):
+    """Stores a chunk's outcome and unsubscribes the users who blocked the bot."""
+    with connection() as conn, conn.cursor() as cursor:
+        for status, user_ids in (('sent', sent_ids), ('failed', failed_ids), ('blocked', blocked_ids)):
+            if user_ids:
+                cursor.execute('''
+                    UPDATE telegram_broadcast_deliveries SET status = %s
+                    WHERE broadcast_id = %s AND user_id = ANY(%s::bigint[])
+                ''', (status, broadcast_id, list(user_ids)))
+        cursor.execute('''
+            UPDATE telegram_broadcasts SET sent = sent + %s, failed = failed + %s, blocked = blocked + %s
+            WHERE id = %s
+        ''', (len(sent_ids), len(failed_ids), len(blocked_ids), broadcast_id))
+        if blocked_ids:
+            cursor.execute(
+                'DELETE FROM telegram_subscribers WHERE user_id = ANY(%s::bigint[])', (list(blocked_ids),)
+            )
+
+def load_user_data(user_id):
+    """Returns the stored user_data of a user, or None if there is none."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT data FROM telegram_user_data WHERE user_id = %s', (user_id,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def save_user_data(items):
+    """Writes a batch of (user_id, data_json) in one transaction; None deletes the entry."""
+    saved = [(user_id, data) for user_id, data in items if data is not None]
+    deleted = [user_id for user_id, data in items if data is None]
+    with connection() as conn, conn.cursor() as cursor:
+        if saved:
+            cursor.executemany('''
+                INSERT INTO telegram_user_data (user_id, data, updated_at)
+                VALUES (%s, %s::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+            ''', saved)
+        if deleted:
+            cursor.execute('DELETE FROM telegram_user_data WHERE user_id = ANY(%s::bigint[])', (deleted,))
+
+def load_conversations(name):
+    """Returns [(key_json, state)] of a persistent ConversationHandler."""
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT key, state FROM telegram_conversations WHERE name = %s', (name,))
+        return cursor.fetchall()
+
+def save_conversations(name, items):
+    """Writes a batch of (key_json, state) in one transaction; None ends the conversation."""
+    saved = [(name, key, state) for key, state in items if state is not None]
+    deleted = [key for key, state in items if state is None]
+    with connection() as conn, conn.cursor() as cursor:
+        if saved:
+            cursor.executemany('''
+                INSERT INTO telegram_conversations (name, key, state) VALUES (%s, %s, %s)
+                ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state
+            ''', saved)
+        if deleted:
+            cursor.execute(
+                'DELETE FROM telegram_conversations WHERE name = %s AND key = ANY(%s)', (name, deleted)
+            )
 
 # Backward compatibility - stats.json uchun
 def update_stats_json():
     """Dummy function for backward compatibility"""
     pass
+
+def close_connections():
+    """Closes the connection pool (call on shutdown)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
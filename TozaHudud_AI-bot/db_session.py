@@ -0,0 +1,253 @@
+import asyncio
+import logging
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# The session of the update being processed; database backends read it in connection()
+current_session = ContextVar("db_session", default=None)
+
+def active_session():
+    """Returns the open session of the current update, if any.
+
+    Tasks spawned while handling an update inherit the context variable but
+    may outlive the session; once it is closed they get None and fall back
+    to ordinary per-call connections.
+    """
+    session = current_session.get()
+    if session is None or session.closed:
+        return None
+    return session
+
+def detached(coroutine):
+    """Wraps ``coroutine`` to run outside the current update's session.
+
+    For tasks started while handling an update: through the context
+    variable they would share the update's session, and their Bot API
+    requests would commit it while the handler is still using it.
+    """
+    async def run():
+        current_session.set(None)
+        return await coroutine
+    return run()
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # A worker thread; AsyncDatabase checks the owner before handing calls over
+        return None
+
+class _OwnedSession:
+    """Remembers the task that opened the session; no other task may use it."""
+
+    def _set_owner(self):
+        self.owner = _current_task()
+
+    def check_owner(self):
+        task = _current_task()
+        if task is not None and task is not self.owner:
+            owner = self.owner.get_name() if self.owner is not None else "no task"
+            raise RuntimeError(f"DB session of {owner} used from task {task.get_name()}")
+
+class SessionConnection:
+    """Connection handed out inside a session.
+
+    Backend functions keep calling commit()/rollback() as they always did:
+    commit is deferred to the session's commit, and a rollback marks the
+    session as failed so nothing written since its last commit is kept.
+
+    A backend may wrap each call in a savepoint (savepoint() and
+    release_savepoint()); a rollback then undoes only that call and the
+    session carries on.
+    """
+
+    def __init__(self, session, conn):
+        self._session = session
+        self._conn = conn
+        self._savepoints = 0
+
+    def _execute(self, statement):
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+
+    def savepoint(self):
+        self._execute("SAVEPOINT backend_call")
+        self._savepoints += 1
+
+    def release_savepoint(self):
+        self._savepoints -= 1
+        self._execute("RELEASE SAVEPOINT backend_call")
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if self._savepoints:
+            self._execute("ROLLBACK TO SAVEPOINT backend_call")
+            return
+        self._session.failed = True
+        self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class Session(_OwnedSession):
+    """Unit of work for one Telegram update, for blocking backends.
+
+    The connection is checked out lazily on first use and shared by every
+    database call made while handling the update. commit() ends the
+    transaction and returns the connection to the pool; the bot calls it
+    before every Bot API request, so nothing is held while talking to
+    Telegram and no reply goes out before its writes are committed. A
+    later call checks out a connection again; close() commits the rest.
+
+    Statements for the write-behind queue (``queue_writes``) are handed to
+    ``submit`` once the session commits. Only the task that opened the
+    session may use it.
+    """
+
+    def __init__(self, acquire, release, submit=None):
+        self._set_owner()
+        self._acquire = acquire
+        self._release = release
+        self._submit = submit
+        self._conn = None
+        self._queued = []
+        self._after_commit = []
+        self.failed = False
+        self.closed = False
+
+    @property
+    def used(self):
+        """True when commit() has work to do off the event loop."""
+        return self._conn is not None or bool(self._queued)
+
+    def connection(self):
+        self.check_owner()
+        if self._conn is None:
+            self._conn = SessionConnection(self, self._acquire())
+        return self._conn
+
+    def in_transaction(self):
+        """True when this session holds uncommitted writes."""
+        return self._conn is not None and bool(getattr(self._conn._conn, "in_transaction", False))
+
+    def queue_writes(self, statements):
+        self._queued.append(statements)
+
+    def after_commit(self, callback):
+        """Runs ``callback`` (on the event loop) once the session has committed."""
+        self._after_commit.append(callback)
+
+    def commit(self):
+        """Commits (or rolls back after a failure) and returns the connection.
+
+        Returns the after-commit callbacks to run, empty if nothing was
+        committed. Raises when the commit itself fails; the writes are
+        rolled back.
+        """
+        self.check_owner()
+        conn = self._conn._conn if self._conn is not None else None
+        self._conn = None
+        queued, self._queued = self._queued, []
+        callbacks, self._after_commit = self._after_commit, []
+        failed, self.failed = self.failed, False
+        if conn is not None:
+            try:
+                if failed:
+                    conn.rollback()
+                else:
+                    conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                self._release(conn)
+        if failed:
+            return []
+        for statements in queued:
+            self._submit(statements)
+        return callbacks
+
+    def close(self):
+        """Commits what is left; a failure is logged, as there is no caller to tell."""
+        self.closed = True
+        try:
+            return self.commit()
+        except Exception as e:
+            logger.error(f"❌ Error committing DB session: {e}")
+            return []
+
+class AsyncSession(_OwnedSession):
+    """Unit of work for one Telegram update, for the asyncpg backend.
+
+    Same contract as Session; the connection is acquired from the pool and
+    a transaction opened on first use.
+    """
+
+    def __init__(self, acquire, release):
+        self._set_owner()
+        self._acquire = acquire
+        self._release = release
+        self._conn = None
+        self._transaction = None
+        self._after_commit = []
+        self.failed = False
+        self.closed = False
+
+    @property
+    def used(self):
+        return self._conn is not None
+
+    async def connection(self):
+        self.check_owner()
+        if self._conn is None:
+            conn = await self._acquire()
+            try:
+                self._transaction = conn.transaction()
+                await self._transaction.start()
+            except BaseException:
+                await self._release(conn)
+                raise
+            self._conn = conn
+        return self._conn
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    async def commit(self):
+        self.check_owner()
+        conn, transaction = self._conn, self._transaction
+        self._conn = self._transaction = None
+        callbacks, self._after_commit = self._after_commit, []
+        failed, self.failed = self.failed, False
+        if conn is not None:
+            try:
+                if failed:
+                    await transaction.rollback()
+                else:
+                    await transaction.commit()
+            except Exception:
+                try:
+                    await transaction.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                await self._release(conn)
+        return [] if failed else callbacks
+
+    async def close(self):
+        self.closed = True
+        try:
+            return await self.commit()
+        except Exception as e:
+            logger.error(f"❌ Error committing DB session: {e}")
+            return []
@@ -0,0 +1,178 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from datetime import datetime
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Empty: console only
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+# "text" or "json" (one JSON object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# The file is rotated by size, or by time when LOG_ROTATE_WHEN is set ("midnight", "H", ...)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Share of DEBUG/INFO records kept per logger (and its children), e.g. "httpx=0.1,__main__=0.5".
+# httpx logs every Bot API request at INFO
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "httpx=0.1")
+# Records waiting for the writer thread; when full, DEBUG/INFO records are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# query_log's slow queries (with their plans) are also written here; empty: main log only
+SLOW_QUERY_LOG_FILE = os.getenv("SLOW_QUERY_LOG_FILE", "slow_queries.log")
+SLOW_QUERY_LOGGER = "slow_queries"
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+def parse_sampling(spec):
+    """Parses "name=rate,name=rate" into {name: rate}."""
+    rates = {}
+    for item in spec.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a share of the DEBUG/INFO records of some loggers; warnings always pass."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._resolved = {}  # logger name -> rate of it or its nearest configured parent
+        self.sampled_out = 0
+
+    def _rate(self, name):
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate, probe = 1.0, name
+            while probe:
+                if probe in self.rates:
+                    rate = self.rates[probe]
+                    break
+                probe = probe.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1 or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are.
+
+    The stock QueueHandler formats the message in the calling thread;
+    here ``msg % args`` and tracebacks are only rendered by the writer,
+    so logging costs the event loop little more than a queue put. (Args
+    are therefore rendered a moment later; log values, not objects that
+    are about to change.)
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            # Never lose warnings and errors
+            self.queue.put(record)
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full: wait for the writer instead of failing
+        self.queue.put(self._sentinel)
+
+_listener = None
+_queue_handler = None
+_sampling = None
+
+def _file_handler(path):
+    if LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+
+def setup_logging(
+    level=LOG_LEVEL, log_file=LOG_FILE, fmt=LOG_FORMAT, sampling=LOG_SAMPLING, stream=None, queue_size=LOG_QUEUE_SIZE,
+    slow_query_file=SLOW_QUERY_LOG_FILE,
+):
+    """Sends every log record through a queue to a writer thread (console + rotating files)."""
+    global _listener, _queue_handler, _sampling
+    stop_logging()
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(stream)]
+    if log_file:
+        handlers.append(_file_handler(log_file))
+    if slow_query_file:
+        slow_queries = _file_handler(slow_query_file)
+        slow_queries.addFilter(logging.Filter(SLOW_QUERY_LOGGER))
+        handlers.append(slow_queries)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _queue_handler = AsyncQueueHandler(queue.Queue(queue_size))
+    rates = parse_sampling(sampling) if sampling else {}
+    _sampling = SamplingFilter(rates) if rates else None
+    if _sampling:
+        _queue_handler.addFilter(_sampling)
+    root = logging.getLogger()
+    for handler in root.handlers:
+        handler.close()
+    root.setLevel(level)
+    root.handlers[:] = [_queue_handler]
+    _listener = _QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def stop_logging():
+    """Writes out the queued records and stops the writer thread.
+
+    Later records are written directly, so nothing logged during
+    interpreter shutdown is lost.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().handlers[:] = list(_listener.handlers)
+    _listener = None
+
+def logging_stats():
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped": _queue_handler.dropped if _queue_handler else 0,
+        "sampled_out": _sampling.sampled_out if _sampling else 0,
+    }
+
+atexit.register(stop_logging)
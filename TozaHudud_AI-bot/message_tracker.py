@@ -0,0 +1,73 @@
+from array import array
+from collections import OrderedDict
+
+class MessageRing:
+    """Fixed-size ring of message IDs for one chat (8 bytes per slot)."""
+
+    __slots__ = ("_ids", "_start", "_count")
+
+    def __init__(self, size):
+        self._ids = array("q", bytes(8 * size))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, message_id):
+        size = len(self._ids)
+        if self._count < size:
+            self._ids[(self._start + self._count) % size] = message_id
+            self._count += 1
+        else:
+            # Full: the oldest ID is overwritten
+            self._ids[self._start] = message_id
+            self._start = (self._start + 1) % size
+
+    def pop_older_than(self, message_id):
+        """Removes and returns every tracked ID below ``message_id``."""
+        size = len(self._ids)
+        ids = [self._ids[(self._start + i) % size] for i in range(self._count)]
+        older = [i for i in ids if i < message_id]
+        if older:
+            self._start = 0
+            self._count = 0
+            for i in ids:
+                if i >= message_id:
+                    self.add(i)
+        return older
+
+class MessageTracker:
+    """Remembers the last message IDs sent and received in each chat.
+
+    Both the number of IDs per chat and the number of chats are bounded;
+    the least recently active chat is forgotten first.
+    """
+
+    def __init__(self, per_chat=100, max_chats=10000):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> MessageRing
+
+    def add(self, chat_id, message_id):
+        ring = self._chats.get(chat_id)
+        if ring is None:
+            ring = self._chats[chat_id] = MessageRing(self.per_chat)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        ring.add(message_id)
+
+    def pop_older_than(self, chat_id, message_id):
+        """Removes and returns the chat's tracked IDs that precede ``message_id``."""
+        ring = self._chats.get(chat_id)
+        if ring is None:
+            return []
+        return ring.pop_older_than(message_id)
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "messages": sum(len(ring) for ring in self._chats.values()),
+        }
@@ -0,0 +1,234 @@
+import functools
+import logging
+import math
+import os
+import time
+
+from webhook_server import HttpServer
+
+logger = logging.getLogger(__name__)
+
+# /metrics is served on this address; set METRICS_PORT=0 to turn it off
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Seconds; fine enough at the low end for p99 reply-time alerts
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # label values -> child
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def clear(self):
+        """Forgets all label sets (for gauges rebuilt on every scrape)."""
+        self._children.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    """Monotonic total; ``labels(...).set`` copies in a total kept elsewhere."""
+
+    kind = "counter"
+
+    _new_child = _Value
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+class _Buckets:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _Buckets(len(self.buckets))
+
+    def observe(self, value, *values):
+        child = self.labels(*values)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                child.counts[index] += 1
+                break
+        child.sum += value
+        child.count += 1
+
+    def _render_child(self, values, child):
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = _labels(self.labelnames, values, (("le", _number(bound)),))
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_number(child.sum)}"
+        yield f"{self.name}_count{labels} {child.count}"
+
+class Registry:
+    """Metrics rendered in the Prometheus text format.
+
+    All metrics are updated from the event loop thread, so they need no
+    locks. Gauges copied from other components' stats() are refreshed by
+    the ``on_scrape`` callbacks right before rendering.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._on_scrape = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def on_scrape(self, callback):
+        self._on_scrape.append(callback)
+        return callback
+
+    async def render(self):
+        for callback in self._on_scrape:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"❌ Metrics collection failed: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+UPDATE_LATENCY = Histogram(
+    "tozahudud_update_duration_seconds", "Time from the start of handling an update to its end (reply included)."
+)
+HANDLER_LATENCY = Histogram("tozahudud_handler_duration_seconds", "Handler callback run time.", ("handler",))
+HANDLER_ERRORS = Counter("tozahudud_handler_errors_total", "Handler callbacks that raised.", ("handler",))
+DB_LATENCY = Histogram(
+    "tozahudud_db_call_duration_seconds", "Database function run time, executor wait included.", ("backend", "function")
+)
+DB_ERRORS = Counter("tozahudud_db_call_errors_total", "Database functions that raised.", ("backend", "function"))
+TELEGRAM_REQUESTS = Counter(
+    "tozahudud_telegram_requests_total", "Bot API calls by method and result (ok, error, retry_after).",
+    ("method", "result"),
+)
+TELEGRAM_LATENCY = Histogram(
+    "tozahudud_telegram_request_duration_seconds", "Bot API call time, rate-limiter wait excluded.", ("method",)
+)
+
+def timed_handler(callback, name=None):
+    """Wraps a handler callback to record its run time and errors."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+def instrument_handlers(application):
+    """Times every handler callback registered on the application, conversation states included."""
+    pending = [handler for handlers in application.handlers.values() for handler in handlers]
+    while pending:
+        handler = pending.pop()
+        # ConversationHandler: its entry points, states and fallbacks
+        if hasattr(handler, "entry_points"):
+            pending.extend(handler.entry_points)
+            pending.extend(handler.fallbacks)
+            for handlers in handler.states.values():
+                pending.extend(handlers)
+            continue
+        callback = getattr(handler, "callback", None)
+        if callback is not None and not hasattr(callback, "__wrapped__"):
+            handler.callback = timed_handler(callback)
+
+def metrics_server(host=METRICS_LISTEN, port=METRICS_PORT, registry=REGISTRY):
+    """An HttpServer serving GET /metrics."""
+    server = HttpServer(host, port)
+
+    async def handle(request):
+        body = await registry.render()
+        return 200, body.encode(), "text/plain; version=0.0.4; charset=utf-8"
+
+    server.route("GET", "/metrics", handle)
+    return server
+
+# Copied from the components' stats() on every scrape
+CONVERSATIONS = Gauge("tozahudud_conversations", "Users in each ConversationHandler state.", ("state",))
+DB_POOL_CONNECTIONS = Gauge("tozahudud_db_pool_connections", "Database pool connections by state.", ("state",))
+DB_POOL_WAITING = Gauge("tozahudud_db_pool_waiting", "Callers waiting for a database connection.")
+WRITE_QUEUE_BACKLOG = Gauge("tozahudud_write_queue_backlog", "Writes waiting for the SQLite group commit.")
+UPDATE_QUEUE = Gauge("tozahudud_update_queue", "Updates received but not yet picked up.")
+UPDATE_WORKERS_BUSY = Gauge("tozahudud_update_workers_busy", "Update workers processing a user's updates.")
+UPDATES_WAITING = Gauge("tozahudud_updates_waiting", "Updates queued behind the same user's current one.")
+TELEGRAM_WAITING = Gauge("tozahudud_telegram_waiting", "Bot API calls waiting in the rate limiter.", ("priority",))
+OUTBOX_NOTIFICATIONS = Counter(
+    "tozahudud_outbox_notifications_total", "Admin notifications by outcome (sent, retried, dead).", ("result",)
+)
+USER_DATA_USERS = Gauge("tozahudud_user_data_users", "Users whose user_data is in memory.")
+PROFILE_CACHE_ENTRIES = Gauge("tozahudud_profile_cache_entries", "Profiles in the get_user_info cache.")
+LOG_QUEUE = Gauge("tozahudud_log_queue", "Log records waiting for the writer thread.")
+LOG_DROPPED = Counter("tozahudud_log_dropped_total", "DEBUG/INFO log records dropped because the queue was full.")
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from rate_limiter import PRIORITY_ADMIN
+
+logger = logging.getLogger(__name__)
+
+# How many admin chats are sent to at the same time
+ADMIN_FANOUT_CONCURRENCY = int(os.getenv("ADMIN_FANOUT_CONCURRENCY", "5"))
+# Telegram limit for media captions
+CAPTION_LIMIT = 1024
+
+# Outbox worker settings
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BASE_DELAY = float(os.getenv("OUTBOX_BASE_DELAY", "2"))
+OUTBOX_MAX_DELAY = float(os.getenv("OUTBOX_MAX_DELAY", "600"))
+# A claim older than this is assumed lost (crash mid-send) and retried
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+async def send_report(bot, chat_id, text, media_type=None, file_id=None, rate_limit_args=None,
+                      text_sent=False, on_text_sent=None):
+    """Sends a report as one message: the media with the text as its caption.
+
+    Falls back to a text message (plus the bare media) when there is no
+    media or the text does not fit in a caption. In that case
+    ``on_text_sent`` is awaited once the text is out, and a retry with
+    ``text_sent=True`` sends only the media, so the text is not repeated.
+    """
+    if file_id and media_type in ("Rasm", "Video"):
+        send_media = bot.send_photo if media_type == "Rasm" else bot.send_video
+        field = "photo" if media_type == "Rasm" else "video"
+        if len(text) <= CAPTION_LIMIT:
+            await send_media(chat_id=chat_id, caption=text, rate_limit_args=rate_limit_args, **{field: file_id})
+            return
+        if not text_sent:
+            await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=rate_limit_args)
+            if on_text_sent:
+                await on_text_sent()
+        await send_media(chat_id=chat_id, rate_limit_args=rate_limit_args, **{field: file_id})
+        return
+    await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=rate_limit_args)
+
+def _seconds(retry_after):
+    """RetryAfter.retry_after is an int or a timedelta depending on the PTB version."""
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class OutboxWorker:
+    """Background task that drains the notification outbox.
+
+    - due rows are claimed in batches and sent concurrently, at most
+      ADMIN_FANOUT_CONCURRENCY at a time
+    - transient errors are retried with exponential backoff; Telegram's
+      RetryAfter delay is honoured as given
+    - rows that keep failing, or fail permanently (bot blocked, chat not
+      found), are dead-lettered for the admin panel
+    - claims are exclusive, so a row is sent once even with several
+      workers; only a crash between sending and marking it sent can
+      repeat a message
+    """
+
+    def __init__(self, db, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.bot = None
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self._wake = asyncio.Event()
+        self._task = None
+        self._last_prune = 0.0
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run(), name="outbox-worker")
+
+    def wake(self):
+        """Tells the worker new rows were committed."""
+        self._wake.set()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                claimed = await self.drain_once()
+                await self._prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Outbox worker error: {e}")
+                claimed = 0
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    async def drain_once(self):
+        """Sends one batch of due notifications; returns how many were claimed."""
+        rows = await self.db.claim_notifications(self.batch_size, OUTBOX_LEASE)
+        semaphore = asyncio.Semaphore(max(1, ADMIN_FANOUT_CONCURRENCY))
+
+        async def deliver(row):
+            async with semaphore:
+                await self._deliver(*row)
+
+        await asyncio.gather(*(deliver(row) for row in rows))
+        return len(rows)
+
+    async def _deliver(self, notification_id, chat_id, payload, attempts):
+        async def text_sent():
+            # A retry after the media failed must not post the text again
+            await self.db.update_notification_payload(notification_id, {**payload, "text_sent": True})
+
+        try:
+            await send_report(
+                self.bot, chat_id, payload["text"], payload.get("media_type"), payload.get("file_id"),
+                rate_limit_args=PRIORITY_ADMIN, text_sent=payload.get("text_sent", False), on_text_sent=text_sent,
+            )
+        except RetryAfter as e:
+            self.retried += 1
+            await self.db.retry_notification(notification_id, _seconds(e.retry_after), str(e))
+        except (Forbidden, BadRequest) as e:
+            self.dead += 1
+            logger.error(f"❌ Notification {notification_id} to {chat_id} failed permanently: {e}")
+            await self.db.dead_letter_notification(notification_id, str(e))
+        except Exception as e:
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.dead += 1
+                logger.error(f"❌ Notification {notification_id} to {chat_id} gave up after {attempts} attempts: {e}")
+                await self.db.dead_letter_notification(notification_id, str(e))
+            else:
+                self.retried += 1
+                delay = min(OUTBOX_BASE_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_DELAY)
+                logger.warning(f"⚠️ Notification {notification_id} to {chat_id} failed ({e}), retrying in {delay:.0f}s")
+                await self.db.retry_notification(notification_id, delay, str(e))
+        else:
+            self.sent += 1
+            await self.db.mark_notification_sent(notification_id)
+
+    async def _prune(self):
+        """Drops old sent rows, at most once an hour."""
+        if time.monotonic() - self._last_prune < 3600:
+            return
+        self._last_prune = time.monotonic()
+        pruned = await self.db.prune_notifications(OUTBOX_RETENTION_DAYS)
+        if pruned:
+            logger.info(f"🧹 Pruned {pruned} sent notifications")
+
+    def stats(self):
+        return {"sent": self.sent, "retried": self.retried, "dead": self.dead}
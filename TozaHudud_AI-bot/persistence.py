@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Changed user_data and conversation states are written at most this often (seconds)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "10"))
+# Users whose user_data is kept in memory; the least recently active are evicted first
+USER_DATA_MAX_USERS = int(os.getenv("USER_DATA_MAX_USERS", "5000"))
+# Users idle this long (seconds) are evicted; their data is read back when they return
+USER_DATA_TTL = float(os.getenv("USER_DATA_TTL", "3600"))
+# Above the cap, users active more recently than this are kept (a handler may still use their data)
+USER_DATA_MIN_IDLE = 60
+
+def _encode(data):
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+
+class DatabasePersistence(BasePersistence):
+    """Keeps user_data and ConversationHandler states in the bot's database.
+
+    - a user's user_data is read the first time one of their updates is
+      handled, not at startup
+    - PTB hands over the data of every user seen since the last run; only
+      entries that changed since they were last written are staged, and a
+      conversation only when its state changed
+    - staged changes are written in one batch per table every
+      PERSISTENCE_INTERVAL seconds, and on shutdown
+    - idle users are dropped from memory (see evict) and read back,
+      profile included, when they return
+
+    Conversation states are a few bytes per active user, so they are read
+    at startup, as ConversationHandler requires. PTB loads them in
+    Application.initialize(), before post_init, so the first read brings
+    the schema up to date itself.
+    """
+
+    def __init__(
+        self, db, update_interval=PERSISTENCE_INTERVAL, max_users=USER_DATA_MAX_USERS, ttl=USER_DATA_TTL
+    ):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self._schema_ready = False
+        self.max_users = max_users
+        self.ttl = ttl
+        self._loaded = OrderedDict()  # user_id -> last seen, least recent first
+        self._loading = set()
+        self._written = {}  # user_id -> hash of the data as last written
+        self._dirty_users = {}  # user_id -> data JSON, None to delete
+        self._dirty_conversations = {}  # name -> {key JSON: state, None when ended}
+        self._states = {}  # (name, key JSON) -> state of every active conversation
+        self._state_counts = {}  # state -> active conversations in it
+        self.flushes = 0
+        self.writes = 0
+        self.evicted = 0
+
+    async def _ensure_schema(self):
+        if not self._schema_ready:
+            await self.db.init_db()
+            self._schema_ready = True
+
+    # user_data
+    async def get_user_data(self):
+        # Loaded per user in refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        now = time.monotonic()
+        if user_id in self._loaded:
+            self._loaded[user_id] = now
+            self._loaded.move_to_end(user_id)
+            return
+        self._loading.add(user_id)
+        try:
+            await self._ensure_schema()
+            if user_id in self._dirty_users:
+                # Evicted before its last change was written
+                encoded = self._dirty_users[user_id]
+                stored = json.loads(encoded) if encoded else None
+            else:
+                stored = await self.db.load_user_data(user_id)
+            # name and phone come from the profile when they were not stored
+            profile = None if stored and "name" in stored else await self.db.get_user_info(user_id)
+        except Exception as e:
+            logger.error(f"❌ Could not load user_data of {user_id}: {e}")
+            return
+        finally:
+            self._loading.discard(user_id)
+        self._loaded[user_id] = now
+        for key, value in (stored or {}).items():
+            user_data.setdefault(key, value)
+        self._written[user_id] = hash(_encode(stored or {}))
+        if profile:
+            user_data.setdefault("name", profile[0])
+            user_data.setdefault("phone", profile[1])
+
+    async def update_user_data(self, user_id, data):
+        if user_id not in self._loaded:
+            # Not read yet (no handler ran for the user) or evicted: writing would clobber the stored data
+            return
+        self._stage(user_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._loaded.pop(user_id, None)
+        self._written.pop(user_id, None)
+        self._dirty_users[user_id] = None
+
+    def _stage(self, user_id, data):
+        encoded = _encode(dict(data))
+        digest = hash(encoded)
+        if self._written.get(user_id) == digest:
+            return
+        self._written[user_id] = digest
+        self._dirty_users[user_id] = encoded if data else None
+
+    def evict(self, user_data):
+        """Drops idle users from ``user_data`` (the application's dict); their data stays stored.
+
+        Users idle longer than the TTL go, then the least recently active
+        while above the cap. Unsaved changes are staged first.
+        """
+        now = time.monotonic()
+        # Entries PTB made for users who never reached a handler hold nothing
+        for user_id in [user_id for user_id in user_data if user_id not in self._loaded]:
+            if user_id not in self._loading:
+                del user_data[user_id]
+        over = len(self._loaded) - self.max_users
+        expired = []
+        for user_id, seen in self._loaded.items():
+            idle = now - seen
+            if not (idle >= self.ttl or (over > 0 and idle >= USER_DATA_MIN_IDLE)):
+                break
+            expired.append(user_id)
+            over -= 1
+        for user_id in expired:
+            data = user_data.pop(user_id, None)
+            if data is not None:
+                self._stage(user_id, data)
+            del self._loaded[user_id]
+            self._written.pop(user_id, None)
+        self.evicted += len(expired)
+        return len(expired)
+
+    # Conversations
+    async def get_conversations(self, name):
+        await self._ensure_schema()
+        rows = await self.db.load_conversations(name)
+        for key, state in rows:
+            self._track_state(name, key, state)
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        encoded = json.dumps(key)
+        self._dirty_conversations.setdefault(name, {})[encoded] = new_state
+        self._track_state(name, encoded, new_state)
+
+    def _track_state(self, name, key, state):
+        old = self._states.pop((name, key), None)
+        if old is not None:
+            self._state_counts[old] -= 1
+            if not self._state_counts[old]:
+                del self._state_counts[old]
+        if state is not None:
+            self._states[(name, key)] = state
+            self._state_counts[state] = self._state_counts.get(state, 0) + 1
+
+    def conversation_states(self):
+        """Active conversations per state, as of PTB's last update_persistence."""
+        return dict(self._state_counts)
+
+    async def flush(self):
+        """Writes the staged changes; on failure they are kept for the next run."""
+        if not (self._dirty_users or self._dirty_conversations):
+            return
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        count = len(users) + sum(len(states) for states in conversations.values())
+        try:
+            if users:
+                await self.db.save_user_data(list(users.items()))
+                users = {}
+            for name, states in list(conversations.items()):
+                await self.db.save_conversations(name, list(states.items()))
+                del conversations[name]
+        except Exception as e:
+            logger.error(f"❌ Could not save user_data and conversations: {e}")
+            # Changes staged meanwhile are newer
+            for user_id, encoded in users.items():
+                self._dirty_users.setdefault(user_id, encoded)
+            for name, states in conversations.items():
+                staged = self._dirty_conversations.setdefault(name, {})
+                for key, state in states.items():
+                    staged.setdefault(key, state)
+            return
+        self.flushes += 1
+        self.writes += count
+
+    def stats(self):
+        return {
+            "loaded": len(self._loaded),
+            "max_users": self.max_users,
+            "evicted": self.evicted,
+            "pending": len(self._dirty_users) + sum(len(states) for states in self._dirty_conversations.values()),
+            "flushes": self.flushes,
+            "writes": self.writes,
+        }
+
+    # Not stored
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
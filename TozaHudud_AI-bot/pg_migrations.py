@@ -0,0 +1,257 @@
+# PostgreSQL schema migrations, shared by database_pg and database_asyncpg.
+# Each entry is (version, description, statements); applied versions are
+# recorded in telegram_schema_migrations.
+
+MIGRATIONS_TABLE = "telegram_schema_migrations"
+
+CREATE_MIGRATIONS_TABLE = f'''
+    CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+# Read-only check used at startup: no DDL when the schema is current
+CURRENT_VERSION_QUERY = f'''
+    SELECT CASE WHEN to_regclass('{MIGRATIONS_TABLE}') IS NULL THEN 0
+                ELSE (SELECT COALESCE(MAX(version), 0) FROM {MIGRATIONS_TABLE})
+           END
+'''
+
+# (counter name, table) pairs kept up to date by triggers
+COUNTED_TABLES = (
+    ("problems", "telegram_problems"),
+    ("subscribers", "telegram_subscribers"),
+    ("users", "telegram_users"),
+)
+
+# (telegram_users column, table) pairs: per-user activity counts kept up to date by triggers
+USER_ACTIVITY_COLUMNS = (
+    ("problems_count", "telegram_problems"),
+    ("feedbacks_count", "telegram_feedbacks"),
+    ("ratings_count", "telegram_ratings"),
+)
+
+# Recomputes every user's activity counts; run by migration 4 and backfill_counters()
+BACKFILL_USER_ACTIVITY = "UPDATE telegram_users u SET " + ", ".join(
+    f"{column} = (SELECT COUNT(*) FROM {table} t WHERE t.user_id = u.user_id)"
+    for column, table in USER_ACTIVITY_COLUMNS
+)
+
+# Serializes concurrent migrators (e.g. two replicas starting at once)
+MIGRATION_LOCK_ID = 7_351_001
+
+MIGRATIONS = (
+    (1, "base schema", (
+        # Users table
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_users (
+            user_id BIGINT PRIMARY KEY,
+            name TEXT,
+            phone TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Problems table
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_problems (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES telegram_users(user_id),
+            description TEXT,
+            media_type TEXT,
+            file_id TEXT,
+            latitude REAL,
+            longitude REAL,
+            status TEXT DEFAULT 'Kutilmoqda',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Subscribers table
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_subscribers (
+            user_id BIGINT PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Ratings table
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_ratings (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES telegram_users(user_id),
+            rating INTEGER CHECK (rating >= 1 AND rating <= 5),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Feedbacks table
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_feedbacks (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES telegram_users(user_id),
+            text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    )),
+    (2, "indexes", (
+        # get_user_problems: WHERE user_id ORDER BY created_at DESC, index-only
+        '''
+        CREATE INDEX IF NOT EXISTS idx_telegram_problems_user_created
+        ON telegram_problems (user_id, created_at DESC) INCLUDE (description, status)
+        ''',
+        # get_recent_problems / get_recent_feedbacks: ORDER BY created_at DESC LIMIT n
+        'CREATE INDEX IF NOT EXISTS idx_telegram_problems_created ON telegram_problems (created_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_telegram_feedbacks_created ON telegram_feedbacks (created_at DESC)',
+        # get_all_users / search_users joins
+        'CREATE INDEX IF NOT EXISTS idx_telegram_feedbacks_user ON telegram_feedbacks (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_telegram_ratings_user ON telegram_ratings (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_telegram_users_created ON telegram_users (created_at DESC)',
+    )),
+    (3, "row counters", (
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_counters (
+            name TEXT PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION telegram_count_rows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE telegram_counters SET value = value + 1 WHERE name = TG_ARGV[0];
+            ELSE
+                UPDATE telegram_counters SET value = value - 1 WHERE name = TG_ARGV[0];
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Triggers first: CREATE TRIGGER locks out writers, so the seed count below is exact
+        *(
+            statement
+            for counter, table in COUNTED_TABLES
+            for statement in (
+                f'DROP TRIGGER IF EXISTS {table}_count ON {table}',
+                f'''
+                CREATE TRIGGER {table}_count AFTER INSERT OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION telegram_count_rows('{counter}')
+                ''',
+                f'''
+                INSERT INTO telegram_counters (name, value)
+                SELECT '{counter}', COUNT(*) FROM {table}
+                ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+                ''',
+            )
+        ),
+        # Keyset pagination of the admin user list
+        'CREATE INDEX IF NOT EXISTS idx_telegram_users_keyset ON telegram_users (created_at DESC, user_id DESC)',
+    )),
+    (4, "per-user activity counters", (
+        *(
+            f'ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS {column} INTEGER NOT NULL DEFAULT 0'
+            for column, _ in USER_ACTIVITY_COLUMNS
+        ),
+        '''
+        CREATE OR REPLACE FUNCTION telegram_count_user_activity() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                EXECUTE format('UPDATE telegram_users SET %I = %I + 1 WHERE user_id = $1', TG_ARGV[0], TG_ARGV[0])
+                USING NEW.user_id;
+            ELSE
+                EXECUTE format('UPDATE telegram_users SET %I = %I - 1 WHERE user_id = $1', TG_ARGV[0], TG_ARGV[0])
+                USING OLD.user_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        *(
+            statement
+            for column, table in USER_ACTIVITY_COLUMNS
+            for statement in (
+                f'DROP TRIGGER IF EXISTS {table}_user_count ON {table}',
+                f'''
+                CREATE TRIGGER {table}_user_count AFTER INSERT OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION telegram_count_user_activity('{column}')
+                ''',
+            )
+        ),
+        BACKFILL_USER_ACTIVITY,
+    )),
+    (5, "user search index", (
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        # E.164 digits only, so "90 123" finds "+998 90 123-45-67"
+        r"""
+        ALTER TABLE telegram_users ADD COLUMN IF NOT EXISTS phone_digits TEXT
+        GENERATED ALWAYS AS (NULLIF(regexp_replace(phone, '\D', '', 'g'), '')) STORED
+        """,
+        'CREATE INDEX IF NOT EXISTS idx_telegram_users_name_trgm ON telegram_users USING gin (name gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS idx_telegram_users_phone_trgm ON telegram_users USING gin (phone_digits gin_trgm_ops)',
+    )),
+    (6, "notification outbox", (
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            dedupe_key TEXT NOT NULL UNIQUE,
+            chat_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            claimed_at TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_telegram_outbox_due ON telegram_outbox (next_attempt_at)
+        WHERE status IN ('pending', 'sending')
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_telegram_outbox_dead ON telegram_outbox (id) WHERE status = 'dead'",
+    )),
+    (7, "broadcasts", (
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by BIGINT,
+            status TEXT NOT NULL DEFAULT 'draft',
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_broadcast_deliveries (
+            broadcast_id BIGINT NOT NULL REFERENCES telegram_broadcasts (id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        ''',
+    )),
+    (8, "conversation persistence", (
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+        ''',
+    )),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
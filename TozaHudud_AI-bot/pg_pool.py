@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+import query_log
+
+logger = logging.getLogger(__name__)
+
+# Connections whose statements are timed into query_log
+PG_CONNECTION_FACTORY = query_log.PgConnection if query_log.QUERY_STATS else None
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool.
+
+    - keeps between ``min_size`` and ``max_size`` connections open
+    - pings connections that sat idle longer than ``idle_check`` seconds
+    - recycles connections older than ``max_lifetime`` seconds
+    - waits at most ``timeout`` seconds for a free connection
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=5.0, max_lifetime=1800.0, idle_check=30.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_check = idle_check
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, created_at, last_used)
+        self._created = {}  # id(conn) -> created_at
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._checkout_time_total = 0.0
+        self._checkout_time_max = 0.0
+
+    def open(self):
+        """Pre-opens ``min_size`` connections."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            self._put_idle(conn)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PG_CONNECTION_FACTORY)
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _put_idle(self, conn):
+        with self._cond:
+            self._idle.append((conn, self._created.get(id(conn), time.monotonic()), time.monotonic()))
+            self._cond.notify()
+
+    def _is_usable(self, conn, created_at, last_used):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if self.idle_check and now - last_used > self.idle_check:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Dropping stale PostgreSQL connection: {e}")
+                return False
+        return True
+
+    def getconn(self):
+        """Checks out a connection, opening a new one if the pool has room."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            conn = None
+            entry = None
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                if not self._idle and self._size >= self.max_size:
+                    self._waiting += 1
+                    try:
+                        while not self._idle and self._size >= self.max_size:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                self._timeouts += 1
+                                raise PoolTimeout(
+                                    f"No PostgreSQL connection available within {self.timeout}s "
+                                    f"(size={self._size}, max={self.max_size})"
+                                )
+                            self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if entry is not None:
+                conn, created_at, last_used = entry
+                if not self._is_usable(conn, created_at, last_used):
+                    self._discard(conn)
+                    continue
+            else:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._checkout_time_total += elapsed
+                self._checkout_time_max = max(self._checkout_time_max, elapsed)
+            return conn
+
+    def putconn(self, conn):
+        """Returns a connection; broken or mid-transaction connections are cleaned up first."""
+        if self._closed or conn.closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        self._put_idle(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        """Returns pool usage counters for sizing and monitoring."""
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                "size": self._size,
+                "idle": idle,
+                "in_use": self._size - idle,
+                "waiting": self._waiting,
+                "max_size": self.max_size,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "avg_checkout_ms": round(self._checkout_time_total / self._checkouts * 1000, 2) if self._checkouts else 0.0,
+                "max_checkout_ms": round(self._checkout_time_max * 1000, 2),
+            }
+
+    def close(self):
+        """Closes idle connections; checked-out ones are closed when returned."""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
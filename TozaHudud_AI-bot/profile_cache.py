@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+
+class ProfileCache:
+    """LRU + TTL cache for user profiles, with negative entries.
+
+    ``None`` (an unregistered user) is cached too, but for the shorter
+    ``negative_ttl``, so unregistered senders do not reach the database on
+    every message. Writers call invalidate(); a read that started before an
+    invalidation is not stored, so a stale profile can never be cached.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0, negative_ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._generation = 0
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns (found, value); expired entries count as misses."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                if value is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return True, value
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def generation(self):
+        """Token to pass to put(), taken before reading from the database."""
+        return self._generation
+
+    def put(self, key, value, generation):
+        if self.maxsize <= 0 or generation != self._generation:
+            return
+        ttl = self.negative_ttl if value is None else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._generation += 1
+        self._entries.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.maxsize,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+class LRUSet:
+    """Set of at most ``maxsize`` keys; the least recently used is dropped first."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        if self.maxsize <= 0:
+            return
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+    def discard(self, key):
+        self._keys.pop(key, None)
+
+    def difference_update(self, keys):
+        for key in keys:
+            self._keys.pop(key, None)
@@ -0,0 +1,426 @@
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+
+try:
+    from psycopg2 import extensions as pg_extensions
+except ImportError:  # SQLite only
+    pg_extensions = None
+
+logger = logging.getLogger(__name__)
+# Slow queries go here; log_config also writes them to SLOW_QUERY_LOG_FILE
+slow_logger = logging.getLogger("slow_queries")
+
+# Set QUERY_STATS=0 to run statements without any instrumentation
+QUERY_STATS = os.getenv("QUERY_STATS", "1") != "0"
+# Statements taking longer (executing and fetching) are logged with their plan
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") != "0"
+# A statement is EXPLAINed at most once per this many seconds
+EXPLAIN_INTERVAL = 300
+# Distinct (statement, function, caller) entries; later ones are counted under "other"
+QUERY_STATS_MAX_ENTRIES = 1000
+SLOW_QUERY_HISTORY = 20
+
+# The code on whose behalf the database is called (set by async_db before handing the call to a thread)
+current_caller = ContextVar("query_caller", default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\$\d+|\?|(?<!:):\w+")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_LISTS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+_fingerprints = {}
+
+def fingerprint(sql):
+    """The statement with literals and placeholders replaced by ``?`` and value lists folded.
+
+    ``WHERE user_id IN (1, 2, 3)`` and ``WHERE user_id IN (?, ?)`` both
+    become ``WHERE user_id IN (...)``, so one statement is one entry.
+    """
+    result = _fingerprints.get(sql)
+    if result is None:
+        result = _SPACE.sub(" ", sql).strip()
+        result = _STRING.sub("?", result)
+        result = _PLACEHOLDER.sub("?", result)
+        result = _NUMBER.sub("?", result)
+        result = _LISTS.sub("(...)", _LIST.sub("(...)", result))
+        if len(_fingerprints) >= 4096:
+            _fingerprints.clear()
+        _fingerprints[sql] = result
+    return result
+
+_names = {}  # code object -> "module.function"
+
+def _describe(frame):
+    code = frame.f_code
+    name = _names.get(code)
+    if name is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        name = _names[code] = f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+    return name
+
+def describe_caller(frame, skip=()):
+    """"module.function" of the first frame outside the files in ``skip``."""
+    while frame is not None and frame.f_code.co_filename in skip:
+        frame = frame.f_back
+    return _describe(frame) if frame is not None else "-"
+
+def _find_caller():
+    """The function that ran the statement, and the code it ran on behalf of."""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return "-", "-"
+    caller = current_caller.get()
+    if caller is None:
+        caller = describe_caller(frame.f_back, (frame.f_code.co_filename,))
+    return _describe(frame), caller
+
+class _Entry:
+    __slots__ = ("function", "caller", "statement", "calls", "total", "max", "rows", "errors", "slow")
+
+    def __init__(self, function, caller, statement):
+        self.function = function
+        self.caller = caller
+        self.statement = statement
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+
+class QueryStats:
+    """Per-statement totals, aggregated by fingerprint, function and caller.
+
+    Statements run on many threads (the database executor, the write
+    queue), so every update takes the lock.
+    """
+
+    ORDERS = {
+        "total": lambda entry: entry.total,
+        "calls": lambda entry: entry.calls,
+        "rows": lambda entry: entry.rows,
+        "avg": lambda entry: entry.total / entry.calls if entry.calls else 0,
+        "max": lambda entry: entry.max,
+    }
+
+    def __init__(self, max_entries=QUERY_STATS_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._explained = {}  # fingerprint -> when it was last EXPLAINed
+        self.slow_queries = deque(maxlen=SLOW_QUERY_HISTORY)
+        self.since = time.time()
+
+    def record(self, statement, function, caller, duration, rows, error=False):
+        key = (function, caller, statement)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    key = ("-", "-", "(boshqa so'rovlar)")
+                    entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _Entry(*key)
+            entry.calls += 1
+            entry.total += duration
+            entry.max = max(entry.max, duration)
+            entry.rows += rows
+            if error:
+                entry.errors += 1
+            if duration * 1000 >= SLOW_QUERY_MS:
+                entry.slow += 1
+                self.slow_queries.append((time.time(), duration, rows, function, caller, statement))
+
+    def should_explain(self, statement):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(statement, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+                return False
+            self._explained[statement] = now
+            return True
+
+    def top(self, limit=10, order="total"):
+        """The ``limit`` heaviest entries by ``order`` (total, calls, rows, avg or max)."""
+        with self._lock:
+            entries = list(self._entries.values())
+        return sorted(entries, key=self.ORDERS[order], reverse=True)[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self.slow_queries.clear()
+            self.since = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "statements": len(self._entries),
+                "calls": sum(entry.calls for entry in self._entries.values()),
+                "total": sum(entry.total for entry in self._entries.values()),
+                "slow": sum(entry.slow for entry in self._entries.values()),
+            }
+
+STATS = QueryStats()
+
+class Execution:
+    """One statement being run: timed while it executes and while its rows are fetched."""
+
+    __slots__ = ("sql", "params", "function", "caller", "elapsed", "rows", "done")
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.function, self.caller = _find_caller()
+        self.elapsed = 0.0
+        self.rows = 0
+        self.done = False
+
+    def finish(self, explain=None, error=False):
+        """Adds the statement to STATS; a slow one is logged with its plan from ``explain(sql, params)``."""
+        if self.done:
+            return
+        self.done = True
+        statement = fingerprint(self.sql)
+        STATS.record(statement, self.function, self.caller, self.elapsed, self.rows, error)
+        if error or self.elapsed * 1000 < SLOW_QUERY_MS:
+            return
+        plan = ""
+        if (
+            explain is not None
+            and SLOW_QUERY_EXPLAIN
+            and self.params is not None
+            and statement.lstrip("( ").upper().startswith(_EXPLAINABLE)
+            and STATS.should_explain(statement)
+        ):
+            try:
+                plan = "\n".join(f"    {line}" for line in explain(self.sql, self.params))
+            except Exception as e:
+                plan = f"    EXPLAIN failed: {e}"
+        slow_logger.warning(
+            f"🐢 Slow query: {_ms(self.elapsed)}, {self.rows} rows, "
+            f"{self.function} <- {self.caller}\n    {_SPACE.sub(' ', self.sql).strip()}"
+            + (f"\n{plan}" if plan else "")
+        )
+
+def _ms(seconds):
+    ms = seconds * 1000
+    return f"{ms:.1f} ms" if ms < 10 else f"{ms:.0f} ms"
+
+def format_report(limit=10, order="total", stats=STATS):
+    """Top-N table of the statements for the /queries admin command."""
+    summary = stats.stats()
+    since = datetime.fromtimestamp(stats.since).strftime("%Y-%m-%d %H:%M")
+    lines = [
+        f"🗄 So'rovlar ({order} bo'yicha top {limit}), {since} dan beri:",
+        f"Jami {summary['calls']} ta so'rov, {summary['total']:.1f} s, "
+        f"{summary['slow']} ta sekin (>{SLOW_QUERY_MS:g} ms)",
+        "",
+    ]
+    for number, entry in enumerate(stats.top(limit, order), 1):
+        calls = entry.calls or 1
+        statement = entry.statement if len(entry.statement) <= 90 else entry.statement[:87] + "..."
+        lines.append(f"{number}. {entry.function} <- {entry.caller}")
+        lines.append(
+            f"   {entry.calls} marta, jami {_ms(entry.total)}, o'rtacha {_ms(entry.total / calls)}, "
+            f"max {_ms(entry.max)}, {entry.rows / calls:.0f} qator/so'rov"
+            + (f", {entry.errors} xato" if entry.errors else "")
+        )
+        lines.append(f"   {statement}")
+    if stats.slow_queries:
+        lines += ["", "🐢 Oxirgi sekin so'rovlar:"]
+        for at, duration, rows, function, caller, _ in list(stats.slow_queries)[-5:]:
+            lines.append(
+                f"   {datetime.fromtimestamp(at):%H:%M:%S} {_ms(duration)}, {rows} qator, {function} <- {caller}"
+            )
+    return "\n".join(lines)
+
+# SQLite
+def _sqlite_explain(path):
+    def explain(sql, params):
+        # A separate connection: the statement's own may already be back in the pool
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        finally:
+            conn.close()
+        depth = {0: -1}
+        lines = []
+        for node, parent, _, detail in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node] + detail)
+        return lines
+
+    return explain
+
+class SqliteCursor(sqlite3.Cursor):
+    """Times each statement until its last row is fetched (or the cursor is reused or closed)."""
+
+    _execution = None
+
+    def _start(self, sql, params):
+        self._finish()
+        return Execution(sql, params)
+
+    def _finish(self):
+        execution, self._execution = self._execution, None
+        if execution is not None:
+            execution.finish(self.connection.explain)
+
+    def _run(self, execution, method, sql, params):
+        started = time.perf_counter()
+        try:
+            method(sql, params)
+        except Exception:
+            execution.elapsed = time.perf_counter() - started
+            execution.finish(error=True)
+            raise
+        execution.elapsed = time.perf_counter() - started
+        if self.description is None:
+            execution.rows = max(self.rowcount, 0)
+            execution.finish(self.connection.explain)
+        else:
+            self._execution = execution
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._run(self._start(sql, parameters), super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(self._start(sql, None), super().executemany, sql, seq_of_parameters)
+
+    def _fetched(self, started, rows, exhausted):
+        execution = self._execution
+        if execution is not None:
+            execution.elapsed += time.perf_counter() - started
+            execution.rows += rows
+            if exhausted:
+                self._finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception as e:
+            logger.error(f"❌ Could not record query stats: {e}")
+
+class SqliteConnection(sqlite3.Connection):
+    """sqlite3 connection (``factory=``) whose statements are all timed."""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.explain = _sqlite_explain(database)
+
+    def cursor(self, factory=SqliteCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# PostgreSQL (psycopg2)
+if pg_extensions is not None:
+    def _pg_explain(conn, sql, params):
+        # A savepoint, so a failing EXPLAIN does not abort the caller's transaction
+        savepoint = not conn.autocommit
+        with pg_extensions.cursor(conn) as cursor:
+            if savepoint:
+                cursor.execute("SAVEPOINT query_log_explain")
+            try:
+                cursor.execute(f"EXPLAIN {sql}", params)
+                lines = [row[0] for row in cursor.fetchall()]
+            except Exception:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+                raise
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT query_log_explain")
+        return lines
+
+    class _PgCursorMixin:
+        # psycopg2 fetches the whole result in execute(), so rowcount is the rows returned
+        def _run(self, method, query, params, explain_params):
+            sql = query if isinstance(query, str) else (
+                query.decode() if isinstance(query, bytes) else query.as_string(self.connection)
+            )
+            execution = Execution(sql, explain_params)
+            started = time.perf_counter()
+            try:
+                method(query, params)
+            except Exception:
+                execution.elapsed = time.perf_counter() - started
+                execution.finish(error=True)
+                raise
+            execution.elapsed = time.perf_counter() - started
+            execution.rows = max(self.rowcount, 0)
+            execution.finish(lambda sql, params: _pg_explain(self.connection, sql, params))
+
+        def execute(self, query, vars=None):
+            self._run(super().execute, query, vars, vars if vars is not None else ())
+
+        def executemany(self, query, vars_list):
+            self._run(super().executemany, query, vars_list, None)
+
+    _pg_cursors = {}
+
+    def _timed_cursor(cursor_class):
+        timed = _pg_cursors.get(cursor_class)
+        if timed is None:
+            timed = _pg_cursors[cursor_class] = type(
+                f"Timed{cursor_class.__name__}", (_PgCursorMixin, cursor_class), {}
+            )
+        return timed
+
+    class PgConnection(pg_extensions.connection):
+        """psycopg2 connection (``connection_factory=``) whose cursors, of any cursor_factory, are timed."""
+
+        def cursor(self, *args, **kwargs):
+            cursor_factory = kwargs.pop("cursor_factory", None) or self.cursor_factory or pg_extensions.cursor
+            return super().cursor(*args, cursor_factory=_timed_cursor(cursor_factory), **kwargs)
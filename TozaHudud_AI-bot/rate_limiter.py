@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_LATENCY, TELEGRAM_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, passed to Bot methods as rate_limit_args (lower is served first)
+PRIORITY_REPLY = 0
+PRIORITY_ADMIN = 1
+PRIORITY_CLEANUP = 2
+PRIORITY_BROADCAST = 3
+PRIORITY_NAMES = {
+    PRIORITY_REPLY: "reply",
+    PRIORITY_ADMIN: "admin",
+    PRIORITY_CLEANUP: "cleanup",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+# Telegram limits: ~30 requests/s overall, ~1 message/s in a private chat
+# (short bursts are tolerated) and 20 messages/min in a group
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# Chats whose buckets are remembered; the least recently used is dropped first
+TELEGRAM_MAX_CHAT_BUCKETS = 10000
+
+class TokenBucket:
+    """Token bucket where a request may reserve a token ahead of time.
+
+    ``waiting`` and ``timer`` are used by per-chat buckets to hand out
+    tokens in priority order when requests queue for them.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "waiting", "timer")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = []  # heap of (priority, seq, future)
+        self.timer = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now):
+        """Takes a token, going into debt if needed; returns how long to wait for it."""
+        delay = self.delay(now)
+        self.tokens -= 1
+        return delay
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Throttles every Bot API call of the bot through shared token buckets.
+
+    - each chat has its own bucket (private and group chats have different
+      limits); a request first waits for its chat's turn, and when several
+      queue for the same chat the best priority class gets the next token
+    - all requests then share one global bucket; when callers queue for it,
+      the highest priority class is served first, FIFO within a class
+    - a 429 (RetryAfter) pauses all sending for the given time and the
+      request is retried, up to TELEGRAM_MAX_RETRIES times
+
+    ``rate_limit_args`` is the priority class; requests without one are
+    treated as user-facing replies.
+    """
+
+    def __init__(
+        self,
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        chat_rate=TELEGRAM_CHAT_RATE,
+        chat_burst=TELEGRAM_CHAT_BURST,
+        group_rate_per_minute=TELEGRAM_GROUP_RATE_PER_MINUTE,
+        max_retries=TELEGRAM_MAX_RETRIES,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()  # chat_id -> TokenBucket
+        self._waiting = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._dispatcher = None
+
+        self.requests = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.wait_total = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self.wait_max = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self.flood_waits = 0
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="rate-limiter")
+
+    async def shutdown(self):
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        try:
+            await self._dispatcher
+        except asyncio.CancelledError:
+            pass
+        self._dispatcher = None
+        for _, _, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+        for bucket in self._chats.values():
+            if bucket.timer is not None:
+                bucket.timer.cancel()
+                bucket.timer = None
+            for _, _, future in bucket.waiting:
+                future.cancel()
+            bucket.waiting.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                # Groups, channels and @usernames
+                bucket = TokenBucket(self.group_rate, 1)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > TELEGRAM_MAX_CHAT_BUCKETS and not next(iter(self._chats.values())).waiting:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, priority, chat_id):
+        started = time.monotonic()
+        self.depth[priority] += 1
+        try:
+            if chat_id is not None:
+                bucket = self._chat_bucket(chat_id)
+                if bucket.waiting or bucket.delay(started) > 0:
+                    future = asyncio.get_running_loop().create_future()
+                    heapq.heappush(bucket.waiting, (priority, next(self._seq), future))
+                    if bucket.timer is None:
+                        self._schedule_chat(bucket, started)
+                    await future
+                else:
+                    bucket.reserve(started)
+            now = time.monotonic()
+            if self._waiting or now < self._paused_until or self._global.delay(now) > 0:
+                future = asyncio.get_running_loop().create_future()
+                heapq.heappush(self._waiting, (priority, next(self._seq), future))
+                self._wakeup.set()
+                await future
+            else:
+                self._global.reserve(now)
+        finally:
+            self.depth[priority] -= 1
+        waited = time.monotonic() - started
+        self.requests[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+    def _schedule_chat(self, bucket, now):
+        bucket.timer = asyncio.get_running_loop().call_later(bucket.delay(now), self._release_chat, bucket)
+
+    def _release_chat(self, bucket):
+        """Gives a chat's next token to its best-priority waiting request."""
+        bucket.timer = None
+        while bucket.waiting and bucket.waiting[0][2].done():
+            # The caller was cancelled while waiting
+            heapq.heappop(bucket.waiting)
+        if not bucket.waiting:
+            return
+        now = time.monotonic()
+        if bucket.delay(now) <= 0:
+            _, _, future = heapq.heappop(bucket.waiting)
+            bucket.reserve(now)
+            future.set_result(None)
+        if bucket.waiting:
+            self._schedule_chat(bucket, now)
+
+    async def _dispatch(self):
+        """Hands out global tokens to queued requests, best priority first."""
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._global.delay(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                # The caller was cancelled while waiting
+                continue
+            self._global.reserve(now)
+            future.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args in PRIORITY_NAMES else PRIORITY_REPLY
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_id)
+            started = time.monotonic()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_REQUESTS.labels(endpoint, "retry_after").inc()
+                self.flood_waits += 1
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+                logger.warning(f"⏳ Flood wait on {endpoint}: pausing requests for {seconds:.0f}s")
+                if attempt == self.max_retries:
+                    raise
+            except Exception:
+                TELEGRAM_REQUESTS.labels(endpoint, "error").inc()
+                raise
+            else:
+                TELEGRAM_REQUESTS.labels(endpoint, "ok").inc()
+                return result
+            finally:
+                TELEGRAM_LATENCY.observe(time.monotonic() - started, endpoint)
+
+    def stats(self):
+        """Queue depth and wait times per priority class."""
+        classes = {}
+        for priority, name in PRIORITY_NAMES.items():
+            count = self.requests[priority]
+            classes[name] = {
+                "waiting": self.depth[priority],
+                "requests": count,
+                "avg_wait": self.wait_total[priority] / count if count else 0.0,
+                "max_wait": self.wait_max[priority],
+            }
+        return {
+            "classes": classes,
+            "flood_waits": self.flood_waits,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "chats": len(self._chats),
+        }
@@ -0,0 +1,29 @@
+import re
+
+_NON_DIGITS = re.compile(r"\D")
+# Characters people type inside phone numbers: "+998 (90) 123-45-67"
+_PHONE_PUNCTUATION = re.compile(r"[\s+\-().]")
+
+def normalize_phone(phone):
+    """Returns the E.164 digits of a phone number ("+998 90 123" -> "99890123")."""
+    if not phone:
+        return None
+    return _NON_DIGITS.sub("", phone) or None
+
+def parse_search_query(query):
+    """Splits an admin search query into (phone digits, name text).
+
+    A query made only of digits and phone punctuation is a phone/ID search
+    and comes back as digits; anything else is a name search.
+    """
+    query = (query or "").strip()
+    compact = _PHONE_PUNCTUATION.sub("", query)
+    if compact.isascii() and compact.isdigit():
+        return compact, None
+    return None, query
+
+def exact_user_id(digits):
+    """Returns digits as a Telegram user ID when they fit in BIGINT, else None."""
+    if digits and len(digits) <= 18:
+        return int(digits)
+    return None
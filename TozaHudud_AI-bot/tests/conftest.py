@@ -0,0 +1,33 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+import database  # noqa: E402
+from async_db import AsyncDatabase  # noqa: E402
+
+@pytest.fixture
+def sqlite_backend(tmp_path, monkeypatch):
+    """The sqlite backend on an empty database file in tmp_path."""
+    database.close_connections()
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "tozahudud.db"))
+    monkeypatch.setattr(database, "STATS_FILE", str(tmp_path / "stats.json"))
+    monkeypatch.setattr(database, "WRITE_QUEUE_DEAD_LETTER_FILE", str(tmp_path / "write_queue_dead.jsonl"))
+    yield database
+    database.close_connections()
+
+@pytest.fixture
+def v0_backend(sqlite_backend, tmp_path):
+    """The sqlite backend on a copy of the pre-migration database shipped with the bot."""
+    shutil.copy(os.path.join(BOT_DIR, "tozahudud.db"), sqlite_backend.DB_NAME)
+    return sqlite_backend
+
+@pytest.fixture
+def db(sqlite_backend):
+    """An AsyncDatabase over a migrated sqlite database."""
+    sqlite_backend.init_db()
+    return AsyncDatabase(sqlite_backend)
@@ -0,0 +1,53 @@
+import asyncio
+
+import database
+from broadcast import BroadcastEngine
+
+CREATOR = 1000
+SUBSCRIBERS = list(range(1, 21))
+
+class SlowBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+        await asyncio.sleep(0.05)
+
+def _deliveries(broadcast_id):
+    with database.connection() as conn:
+        return dict(conn.execute(
+            "SELECT user_id, status FROM broadcast_deliveries WHERE broadcast_id = ?", (broadcast_id,)
+        ).fetchall())
+
+def test_stop_mid_chunk_gives_back_untried_recipients(db):
+    for user_id in SUBSCRIBERS:
+        database.add_subscriber(user_id)
+    database.flush_writes()
+    broadcast_id = database.create_broadcast("Salom", CREATOR)
+
+    async def run():
+        first, second = SlowBot(), SlowBot()
+        engine = BroadcastEngine(db, chunk_size=10, concurrency=2)
+        await engine.start(first)
+        await engine.launch(broadcast_id)
+        await asyncio.sleep(0.12)
+        # Graceful shutdown while the first chunk is being sent
+        await engine.stop()
+        in_flight = {user_id for user_id, status in _deliveries(broadcast_id).items() if status == "pending"}
+
+        engine = BroadcastEngine(db, chunk_size=10, concurrency=2)
+        await engine.start(second)
+        await asyncio.gather(*engine._tasks.values())
+        return first.sent, second.sent, in_flight
+
+    first, second, in_flight = asyncio.run(run())
+    recipients = [user_id for user_id in first + second if user_id != CREATOR]
+
+    assert len(recipients) == len(set(recipients))
+    assert set(recipients) == set(SUBSCRIBERS)
+    # Only the sends cut off mid-request are left undecided
+    assert 0 < len(in_flight) <= 2
+    statuses = _deliveries(broadcast_id)
+    assert {user_id for user_id, status in statuses.items() if status == "unknown"} == in_flight
+    assert database.get_broadcast(broadcast_id)[3] == "done"
@@ -0,0 +1,35 @@
+import asyncio
+import sqlite3
+
+from async_db import AsyncDatabase
+from persistence import DatabasePersistence
+
+def _user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_init_db_migrates_v0_database_and_keeps_rows(v0_backend):
+    conn = sqlite3.connect(v0_backend.DB_NAME)
+    problems = conn.execute("SELECT COUNT(*) FROM problems").fetchone()[0]
+    conn.close()
+    assert _user_version(v0_backend.DB_NAME) == 0
+
+    v0_backend.init_db()
+
+    assert _user_version(v0_backend.DB_NAME) == v0_backend.SCHEMA_VERSION
+    assert v0_backend.get_counters()["problems"] == problems
+
+def test_init_db_is_a_no_op_when_up_to_date(v0_backend):
+    v0_backend.init_db()
+    v0_backend.init_db()
+    assert _user_version(v0_backend.DB_NAME) == v0_backend.SCHEMA_VERSION
+
+def test_persistence_reads_conversations_on_v0_database_before_init_db(v0_backend):
+    # PTB loads conversations in Application.initialize(), before post_init runs init_db
+    persistence = DatabasePersistence(AsyncDatabase(v0_backend))
+
+    assert asyncio.run(persistence.get_conversations("main")) == {}
+    assert _user_version(v0_backend.DB_NAME) == v0_backend.SCHEMA_VERSION
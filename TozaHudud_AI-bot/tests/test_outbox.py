@@ -0,0 +1,70 @@
+import asyncio
+
+import database
+from notifications import CAPTION_LIMIT, OutboxWorker
+
+ADMINS = (100, 200)
+
+class FakeBot:
+    """Records sends; send_photo fails once, like a timeout after the text went out."""
+
+    def __init__(self, photo_failures=0):
+        self.calls = []
+        self.photo_failures = photo_failures
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(("message", chat_id))
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        if self.photo_failures:
+            self.photo_failures -= 1
+            raise TimeoutError("timed out")
+        self.calls.append(("photo", chat_id))
+
+def _outbox_rows():
+    with database.connection() as conn:
+        return conn.execute("SELECT dedupe_key, status FROM outbox ORDER BY id").fetchall()
+
+def _report(text="Muammo"):
+    return {"kind": "report", "text": text, "media_type": "Rasm", "file_id": "file-1"}
+
+def test_redelivered_update_queues_no_second_notification(db):
+    async def handle():
+        # The same Telegram message, delivered twice (e.g. after a webhook timeout)
+        for _ in range(2):
+            async with db.session():
+                await db.add_problem(
+                    1, "Muammo", "Rasm", "file-1", 41.3, 69.2,
+                    notify_chat_ids=ADMINS, notification=_report(), event_key="1:42",
+                )
+
+    asyncio.run(handle())
+    assert [key for key, _ in _outbox_rows()] == ["problem:1:42:100", "problem:1:42:200"]
+
+def test_distinct_messages_get_their_own_notifications(db):
+    async def handle():
+        for message_id in (42, 43):
+            await db.add_feedback(1, "Fikr", ADMINS, {"kind": "feedback", "text": "Fikr"}, event_key=f"1:{message_id}")
+
+    asyncio.run(handle())
+    database.flush_writes()
+    assert len(_outbox_rows()) == 4
+
+def test_retry_after_partial_send_does_not_repeat_the_text(db):
+    asyncio.run(db.add_problem(
+        1, "Muammo", "Rasm", "file-1", notify_chat_ids=(100,),
+        notification=_report("x" * (CAPTION_LIMIT + 1)), event_key="1:42",
+    ))
+    worker = OutboxWorker(db)
+    worker.bot = FakeBot(photo_failures=1)
+
+    async def drain():
+        await worker.drain_once()
+        # Make the retry due now
+        with database.connection() as conn:
+            conn.execute("UPDATE outbox SET next_attempt_at = 0")
+        await worker.drain_once()
+
+    asyncio.run(drain())
+    assert worker.bot.calls == [("message", 100), ("photo", 100)]
+    assert [status for _, status in _outbox_rows()] == ["sent"]
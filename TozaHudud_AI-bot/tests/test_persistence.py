@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+from persistence import USER_DATA_MIN_IDLE, DatabasePersistence
+from user_state import UserState
+
+class FakeDatabase:
+    """Stores user_data JSON and profiles in dicts; counts the reads."""
+
+    def __init__(self, stored=None, profiles=None):
+        self.stored = {user_id: json.dumps(data) for user_id, data in (stored or {}).items()}
+        self.profiles = profiles or {}
+        self.loads = 0
+
+    async def init_db(self):
+        pass
+
+    async def load_user_data(self, user_id):
+        self.loads += 1
+        encoded = self.stored.get(user_id)
+        return json.loads(encoded) if encoded else None
+
+    async def get_user_info(self, user_id):
+        return self.profiles.get(user_id)
+
+    async def save_user_data(self, rows):
+        for user_id, encoded in rows:
+            if encoded is None:
+                self.stored.pop(user_id, None)
+            else:
+                self.stored[user_id] = encoded
+
+    async def save_conversations(self, name, rows):
+        pass
+
+def _load(persistence, user_data, *user_ids):
+    async def main():
+        for user_id in user_ids:
+            await persistence.refresh_user_data(user_id, user_data.setdefault(user_id, UserState()))
+
+    asyncio.run(main())
+
+def _idle(persistence, user_id, seconds):
+    persistence._loaded[user_id] -= seconds
+
+def test_idle_user_is_evicted_and_changes_are_written():
+    db = FakeDatabase()
+    persistence, user_data = DatabasePersistence(db, ttl=600), {}
+    _load(persistence, user_data, 1, 2)
+    user_data[1]["muammo"] = "Chiqindi"
+    _idle(persistence, 1, 601)
+
+    assert persistence.evict(user_data) == 1
+    assert list(user_data) == [2]
+    asyncio.run(persistence.flush())
+    assert json.loads(db.stored[1]) == {"muammo": "Chiqindi"}
+    assert persistence.stats()["evicted"] == 1
+
+def test_cap_evicts_least_recent_users_idle_long_enough():
+    persistence, user_data = DatabasePersistence(FakeDatabase(), max_users=2, ttl=3600), {}
+    _load(persistence, user_data, 1, 2, 3, 4)
+    for user_id in (1, 2, 3):
+        _idle(persistence, user_id, USER_DATA_MIN_IDLE)
+
+    persistence.evict(user_data)
+    assert sorted(user_data) == [3, 4]
+
+def test_recently_active_users_are_kept_above_the_cap():
+    persistence, user_data = DatabasePersistence(FakeDatabase(), max_users=1, ttl=3600), {}
+    _load(persistence, user_data, 1, 2, 3)
+
+    assert persistence.evict(user_data) == 0
+    assert sorted(user_data) == [1, 2, 3]
+
+def test_returning_user_gets_unwritten_data_back():
+    db = FakeDatabase(stored={1: {"muammo": "Eski"}})
+    persistence, user_data = DatabasePersistence(db, ttl=600), {}
+    _load(persistence, user_data, 1)
+    user_data[1]["muammo"] = "Yangi"
+    _idle(persistence, 1, 601)
+    persistence.evict(user_data)
+
+    # Evicted before the flush: read from the staged batch, not the database
+    _load(persistence, user_data, 1)
+    assert user_data[1]["muammo"] == "Yangi"
+    assert db.loads == 1
+
+def test_profile_fills_name_and_phone_when_not_stored():
+    db = FakeDatabase(stored={1: {"muammo": "Chiqindi"}}, profiles={1: ("Ali", "+998901234567")})
+    persistence, user_data = DatabasePersistence(db), {}
+    _load(persistence, user_data, 1)
+
+    assert dict(user_data[1]) == {"name": "Ali", "phone": "+998901234567", "muammo": "Chiqindi"}
+
+def test_update_for_user_not_loaded_keeps_stored_data():
+    db = FakeDatabase(stored={1: {"muammo": "Chiqindi"}})
+    persistence = DatabasePersistence(db)
+
+    async def main():
+        await persistence.update_user_data(1, {})
+        await persistence.flush()
+
+    asyncio.run(main())
+    assert json.loads(db.stored[1]) == {"muammo": "Chiqindi"}
+
+def test_entries_of_users_never_loaded_are_dropped():
+    persistence, user_data = DatabasePersistence(FakeDatabase()), {}
+    _load(persistence, user_data, 1)
+    user_data[2] = UserState()
+
+    persistence.evict(user_data)
+    assert list(user_data) == [1]
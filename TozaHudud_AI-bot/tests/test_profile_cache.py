@@ -0,0 +1,21 @@
+from profile_cache import LRUSet
+
+def test_lru_set_drops_the_least_recently_used_key():
+    keys = LRUSet(maxsize=2)
+    keys.add(1)
+    keys.add(2)
+    assert 1 in keys  # 2 is now the least recent
+    keys.add(3)
+
+    assert len(keys) == 2
+    assert 2 not in keys
+    assert 1 in keys and 3 in keys
+
+def test_lru_set_forgets_removed_keys():
+    keys = LRUSet(maxsize=10)
+    for key in range(5):
+        keys.add(key)
+    keys.discard(0)
+    keys.difference_update([1, 2, 99])
+
+    assert [key in keys for key in range(5)] == [False, False, False, True, True]
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from rate_limiter import PRIORITY_BROADCAST, PRIORITY_CLEANUP, PRIORITY_REPLY, PriorityRateLimiter
+
+def _run(limiter, scenario):
+    async def main():
+        await limiter.initialize()
+        try:
+            return await scenario()
+        finally:
+            await limiter.shutdown()
+
+    return asyncio.run(main())
+
+def test_reply_overtakes_queued_cleanup_in_the_same_chat():
+    limiter = PriorityRateLimiter(global_rate=1000, chat_rate=20, chat_burst=1)
+    order = []
+
+    async def request(priority, tag):
+        await limiter._acquire(priority, 42)
+        order.append(tag)
+
+    async def scenario():
+        cleanups = [asyncio.create_task(request(PRIORITY_CLEANUP, f"cleanup{i}")) for i in range(4)]
+        await asyncio.sleep(0.01)
+        reply = asyncio.create_task(request(PRIORITY_REPLY, "reply"))
+        await asyncio.gather(reply, *cleanups)
+
+    _run(limiter, scenario)
+    assert order[:2] == ["cleanup0", "reply"]
+
+def test_global_bucket_serves_the_best_priority_first():
+    limiter = PriorityRateLimiter(global_rate=20, chat_rate=1000, chat_burst=1000)
+    limiter._global.tokens = 0
+    order = []
+
+    async def request(priority, chat_id, tag):
+        await limiter._acquire(priority, chat_id)
+        order.append(tag)
+
+    async def scenario():
+        tasks = [asyncio.create_task(request(PRIORITY_BROADCAST, i, f"broadcast{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request(PRIORITY_REPLY, 99, "reply")))
+        await asyncio.gather(*tasks)
+
+    _run(limiter, scenario)
+    assert order[0] == "reply"
+
+def test_chat_rate_spaces_out_requests_to_one_chat():
+    limiter = PriorityRateLimiter(global_rate=1000, chat_rate=20, chat_burst=1)
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(limiter._acquire(PRIORITY_REPLY, 42) for _ in range(3)))
+        return time.monotonic() - started
+
+    # The first is free, then one every 1/20 s
+    assert _run(limiter, scenario) >= 0.09
+
+def test_cancelled_waiter_does_not_take_a_token():
+    limiter = PriorityRateLimiter(global_rate=1000, chat_rate=20, chat_burst=1)
+
+    async def scenario():
+        await limiter._acquire(PRIORITY_REPLY, 42)
+        waiter = asyncio.create_task(limiter._acquire(PRIORITY_REPLY, 42))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        started = time.monotonic()
+        await limiter._acquire(PRIORITY_CLEANUP, 42)
+        return time.monotonic() - started
+
+    assert _run(limiter, scenario) < 0.09
+
+def test_retry_after_pauses_and_retries():
+    limiter = PriorityRateLimiter(global_rate=1000, chat_rate=1000, chat_burst=1000, max_retries=1)
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(0.1)
+        return "ok"
+
+    async def scenario():
+        return await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 42}, None)
+
+    assert _run(limiter, scenario) == "ok"
+    assert calls[1] - calls[0] >= 0.09
+    assert limiter.flood_waits == 1
+
+def test_retry_after_gives_up_after_max_retries():
+    limiter = PriorityRateLimiter(global_rate=1000, chat_rate=1000, chat_burst=1000, max_retries=0)
+
+    async def callback():
+        raise RetryAfter(0.01)
+
+    async def scenario():
+        return await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 42}, None)
+
+    with pytest.raises(RetryAfter):
+        _run(limiter, scenario)
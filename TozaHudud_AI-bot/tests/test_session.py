@@ -0,0 +1,138 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import database
+from db_session import detached
+
+class FailingCommit:
+    """Pooled connection whose commit fails, as on a full disk."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def commit(self):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def _in_use():
+    return database.pool_stats()["in_use"]
+
+def test_commit_before_reply_makes_writes_visible_and_returns_connection(db):
+    async def handle():
+        async with db.session():
+            await db.add_user(1, "Ali", "+998901234567")
+            # TrackingBot._post does this before every Bot API request
+            await db.commit()
+            assert _in_use() == 0
+            assert database.get_user_info(1) == ("Ali", "+998901234567")
+
+    asyncio.run(handle())
+
+def test_failed_commit_raises_before_the_reply_and_drops_the_writes(db, monkeypatch):
+    manager = database._get_manager()
+    acquire, release = manager.acquire, manager.release
+
+    async def handle():
+        async with db.session():
+            await db.add_user(1, "Ali", "+998901234567")
+            with pytest.raises(sqlite3.OperationalError):
+                await db.commit()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(manager, "acquire", lambda: FailingCommit(acquire()))
+        patch.setattr(manager, "release", lambda conn: release(conn._conn))
+        asyncio.run(handle())
+    assert _in_use() == 0
+    assert database.get_user_info(1) is None
+
+def test_session_queued_writes_are_dropped_with_a_failed_update(db):
+    async def handle():
+        async with db.session():
+            await db.add_subscriber(1)
+            raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(handle())
+    database.flush_writes()
+    assert database.get_counters()["subscribers"] == 0
+
+def test_acquire_times_out_when_pool_is_exhausted(sqlite_backend):
+    manager = database.ConnectionManager(sqlite_backend.DB_NAME, size=1, timeout=0.05)
+    conn = manager.acquire()
+    try:
+        with pytest.raises(database.PoolTimeout):
+            manager.acquire()
+        assert manager.stats()["waiting"] == 0
+    finally:
+        manager.release(conn)
+    assert manager.acquire() is conn
+    manager.close_all()
+
+def test_write_queue_commits_while_sessions_hold_every_connection(db, monkeypatch):
+    manager = database._get_manager()
+    monkeypatch.setattr(manager, "size", 1)
+    monkeypatch.setattr(manager, "timeout", 0.05)
+    session = database.open_session()
+    session.connection()
+    try:
+        database.add_subscriber(1)
+        database.flush_writes()
+        with pytest.raises(database.PoolTimeout):
+            database.get_counters()
+    finally:
+        session.commit()
+    assert database.get_counters()["subscribers"] == 1
+
+def test_task_spawned_during_an_update_does_not_commit_its_session(db):
+    async def spawned():
+        # A Bot API request in the task: TrackingBot._post commits first
+        await db.commit()
+        # Its own connection: the update's writes are not committed yet
+        return await db.get_user_count()
+
+    async def handle():
+        async with db.session() as session:
+            await db.add_user(1, "Ali", "+998901234567")
+            task = asyncio.create_task(detached(spawned()))
+            await asyncio.sleep(0)
+            await db.add_user(2, "Hasan", "+998900000002")
+            assert await task == 0
+            assert session.in_transaction()
+
+    asyncio.run(handle())
+    assert database.get_counters()["users"] == 2
+
+def test_session_refuses_other_tasks(db):
+    async def handle():
+        async with db.session():
+            await db.add_user(1, "Ali", "+998901234567")
+            # Inherits the session through the context, but does not own it
+            with pytest.raises(RuntimeError):
+                await asyncio.create_task(db.commit())
+            with pytest.raises(RuntimeError):
+                await asyncio.create_task(db.add_user(2, "Hasan", "+998900000002"))
+
+    asyncio.run(handle())
+    assert database.get_user_info(1) == ("Ali", "+998901234567")
+    assert database.get_user_info(2) is None
+
+def test_failed_delete_user_raises_and_deletes_nothing(db):
+    database.add_user(1, "Ali", "+998901234567")
+    with database.connection() as conn:
+        # The last statement of the delete fails
+        conn.execute("CREATE TRIGGER fail_delete BEFORE DELETE ON users BEGIN SELECT RAISE(ABORT, 'disk I/O error'); END")
+
+    async def handle():
+        async with db.session():
+            await db.add_user(2, "Hasan", "+998900000002")
+            await db.delete_user_completely(1)
+
+    # The error reaches the handler, and the update's writes go with the delete
+    with pytest.raises(sqlite3.IntegrityError):
+        asyncio.run(handle())
+    assert database.get_user_info(1) == ("Ali", "+998901234567")
+    assert database.get_user_info(2) is None
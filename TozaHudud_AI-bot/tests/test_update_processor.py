@@ -0,0 +1,99 @@
+import asyncio
+
+from telegram import Update
+
+from update_processor import KeyedUpdateProcessor, update_key
+
+def _update(update_id, user_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "Salom",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Ali"},
+        },
+    }, None)
+
+class Recorder:
+    """Handler stand-in that logs when each update starts and ends."""
+
+    def __init__(self):
+        self.events = []
+        self.running = {}
+        self.max_running = 0
+        # The processor logs handler errors, so overlaps are counted rather than asserted
+        self.overlaps = 0
+
+    async def handle(self, update, delay=0.01):
+        key = update_key(update)
+        self.running[key] = self.running.get(key, 0) + 1
+        if self.running[key] > 1:
+            self.overlaps += 1
+        self.max_running = max(self.max_running, sum(self.running.values()))
+        self.events.append(("start", key, update.update_id))
+        await asyncio.sleep(delay)
+        self.events.append(("end", key, update.update_id))
+        self.running[key] -= 1
+
+def _process(processor, items):
+    async def main():
+        for update, coroutine in items:
+            await processor.do_process_update(update, coroutine)
+        await processor.shutdown()
+
+    asyncio.run(main())
+
+def test_updates_of_one_user_run_one_at_a_time_in_order():
+    processor, recorder = KeyedUpdateProcessor(workers=4), Recorder()
+    updates = [_update(i, 1) for i in range(1, 6)]
+    _process(processor, [(update, recorder.handle(update)) for update in updates])
+
+    started = [update_id for event, _, update_id in recorder.events if event == "start"]
+    assert started == [1, 2, 3, 4, 5]
+    assert recorder.overlaps == 0
+    assert processor.stats()["processed"] == 5
+
+def test_slow_user_does_not_hold_up_others():
+    processor, recorder = KeyedUpdateProcessor(workers=4), Recorder()
+    slow, fast = _update(1, 1), _update(2, 2)
+    _process(processor, [(slow, recorder.handle(slow, delay=0.2)), (fast, recorder.handle(fast))])
+
+    assert recorder.events.index(("end", 2, 2)) < recorder.events.index(("end", 1, 1))
+
+def test_workers_bound_the_users_processed_at_once():
+    processor, recorder = KeyedUpdateProcessor(workers=2), Recorder()
+    updates = [_update(i, i) for i in range(1, 7)]
+    _process(processor, [(update, recorder.handle(update)) for update in updates])
+
+    assert recorder.max_running == 2
+    assert len(recorder.events) == 12
+
+def test_full_key_queue_makes_the_fetcher_wait():
+    processor, recorder = KeyedUpdateProcessor(workers=4, key_queue_limit=2), Recorder()
+    updates = [_update(i, 1) for i in range(1, 6)]
+
+    async def main():
+        accepted = []
+        for update in updates:
+            await processor.do_process_update(update, recorder.handle(update, delay=0.05))
+            accepted.append(len(recorder.events))
+        await processor.shutdown()
+        return accepted
+
+    accepted = asyncio.run(main())
+    # Two updates wait for the user; the third is only taken once the first has started
+    assert accepted[:2] == [0, 0]
+    assert accepted[2] > 0
+    assert processor.max_key_depth == 2
+
+def test_failing_update_does_not_stop_the_users_queue():
+    processor, recorder = KeyedUpdateProcessor(workers=1), Recorder()
+
+    async def fail():
+        raise RuntimeError("handler failed")
+
+    first, second = _update(1, 1), _update(2, 1)
+    _process(processor, [(first, fail()), (second, recorder.handle(second))])
+
+    assert ("end", 1, 2) in recorder.events
+    assert processor.stats()["processed"] == 2
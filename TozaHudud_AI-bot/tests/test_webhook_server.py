@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+from webhook_server import MAX_BODY_SIZE, HttpServer, WebhookReceiver
+
+SECRET = "s3cret"
+
+class FakeApplication:
+    def __init__(self, queue_size):
+        self.bot = None
+        self.update_queue = asyncio.Queue(maxsize=queue_size)
+
+def _update(update_id):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {"message_id": 1, "date": 0, "chat": {"id": 42, "type": "private"}, "text": "Salom"},
+    }).encode()
+
+async def _post(port, body, path="/telegram", secret=SECRET, method="POST", content_length=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    length = len(body) if content_length is None else content_length
+    head = f"{method} {path} HTTP/1.1\r\nContent-Length: {length}\r\nConnection: close\r\n"
+    if secret is not None:
+        head += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    writer.write(head.encode() + b"\r\n" + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+def _serve(queue_size, scenario):
+    async def main():
+        application = FakeApplication(queue_size)
+        receiver = WebhookReceiver(application, SECRET)
+        server = HttpServer("127.0.0.1", 0)
+        server.route("POST", "/telegram", receiver.handle)
+        await server.start()
+        try:
+            return await scenario(server.port, application, receiver)
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+def test_update_is_queued_with_the_right_secret():
+    async def scenario(port, application, receiver):
+        assert await _post(port, _update(1)) == 200
+        update = application.update_queue.get_nowait()
+        assert update.update_id == 1
+        assert receiver.stats()["received"] == 1
+
+    _serve(10, scenario)
+
+def test_wrong_or_missing_secret_is_forbidden():
+    async def scenario(port, application, receiver):
+        assert await _post(port, _update(1), secret="wrong") == 403
+        assert await _post(port, _update(2), secret=None) == 403
+        assert application.update_queue.empty()
+        assert receiver.unauthorized == 2
+
+    _serve(10, scenario)
+
+def test_full_update_queue_answers_503_so_telegram_redelivers():
+    async def scenario(port, application, receiver):
+        assert await _post(port, _update(1)) == 200
+        assert await _post(port, _update(2)) == 503
+        assert receiver.rejected == 1
+        # Once the bot catches up the redelivered update is accepted
+        application.update_queue.get_nowait()
+        assert await _post(port, _update(2)) == 200
+
+    _serve(1, scenario)
+
+def test_bad_requests_are_rejected():
+    async def scenario(port, application, receiver):
+        assert await _post(port, b"{not json") == 400
+        assert await _post(port, _update(1), path="/other") == 404
+        assert await _post(port, b"", method="GET") == 405
+        # Refused from the headers, before the body is read
+        assert await _post(port, b"", content_length=MAX_BODY_SIZE + 1) == 413
+        assert application.update_queue.empty()
+
+    _serve(10, scenario)
@@ -0,0 +1,160 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from write_queue import WriteQueue, WriteQueueFull
+
+class FlakyDatabase:
+    """In-memory SQLite whose next ``failures`` transactions fail with ``error``."""
+
+    def __init__(self, failures=0, error="database is locked"):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.execute("CREATE TABLE ratings (user_id INTEGER, rating INTEGER CHECK (rating BETWEEN 1 AND 5))")
+        self.conn.commit()
+        self.failures = failures
+        self.error = error
+        self.transactions = 0
+
+    @contextmanager
+    def connection(self):
+        self.transactions += 1
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError(self.error)
+        try:
+            yield self.conn
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def ratings(self):
+        return self.conn.execute("SELECT user_id, rating FROM ratings ORDER BY user_id").fetchall()
+
+def _rating(user_id, rating=5):
+    return [("INSERT INTO ratings (user_id, rating) VALUES (?, ?)", (user_id, rating))]
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(db, **kwargs):
+        kwargs.setdefault("retry_delay", 0.001)
+        kwargs.setdefault("dead_letter_path", str(tmp_path / "dead.jsonl"))
+        queue = WriteQueue(db.connection, **kwargs)
+        queue.start()
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close()
+
+def _dead_letters(queue):
+    with open(queue.dead_letter_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_transient_error_is_retried(make_queue):
+    db = FlakyDatabase(failures=2)
+    queue = make_queue(db)
+    queue.submit(_rating(1))
+    queue.barrier()
+
+    assert db.ratings() == [(1, 5)]
+    assert queue.stats()["retried"] == 2
+    assert queue.stats()["failed"] == 0
+
+def test_write_still_failing_after_retries_is_dead_lettered(make_queue):
+    db = FlakyDatabase(failures=100)
+    queue = make_queue(db, max_retries=2)
+    queue.submit(_rating(1))
+    queue.barrier()
+
+    assert db.transactions == 3
+    assert queue.stats()["failed"] == 1
+    [entry] = _dead_letters(queue)
+    assert entry["error"] == "database is locked"
+    assert entry["statements"] == [[sql, list(params)] for sql, params in _rating(1)]
+
+def test_bad_row_is_dead_lettered_without_sinking_its_batch(make_queue):
+    db = FlakyDatabase()
+    queue = make_queue(db, max_delay=0.2)
+    for user_id, rating in ((1, 5), (2, 9), (3, 4)):
+        queue.submit(_rating(user_id, rating))
+    queue.barrier()
+
+    assert db.ratings() == [(1, 5), (3, 4)]
+    assert [entry["statements"][0][1] for entry in _dead_letters(queue)] == [[2, 9]]
+
+def test_dead_letters_are_queued_again_on_start(make_queue):
+    db = FlakyDatabase(failures=100)
+    queue = make_queue(db, max_retries=0)
+    queue.submit(_rating(1))
+    queue.close()
+
+    db.failures = 0
+    queue = make_queue(db)
+    queue.barrier()
+    assert db.ratings() == [(1, 5)]
+    assert not os.path.exists(queue.dead_letter_path)
+
+def test_burst_of_writes_is_committed_in_one_transaction(make_queue):
+    db = FlakyDatabase()
+    queue = make_queue(db, max_delay=0.2)
+    for user_id in range(1, 51):
+        queue.submit(_rating(user_id))
+    queue.barrier()
+
+    assert len(db.ratings()) == 50
+    assert db.transactions == 1
+    assert queue.stats()["batches"] == 1
+
+def test_batch_size_caps_a_transaction(make_queue):
+    db = FlakyDatabase()
+    queue = make_queue(db, batch_size=10, max_delay=0.2)
+    for user_id in range(1, 26):
+        queue.submit(_rating(user_id))
+    queue.barrier()
+
+    assert len(db.ratings()) == 25
+    assert db.transactions == 3
+
+def test_sync_durability_returns_after_the_commit(make_queue):
+    db = FlakyDatabase()
+    queue = make_queue(db, durability="sync")
+    seq = queue.submit(_rating(1))
+
+    assert queue.stats()["committed"] >= seq
+    assert db.ratings() == [(1, 5)]
+
+def test_full_backlog_times_out_submitters_side_by_side():
+    queue = WriteQueue(FlakyDatabase().connection, max_backlog=1, submit_timeout=0.2)  # writer not started
+    queue.submit(_rating(1))
+    timings = []
+
+    def submit():
+        started = time.monotonic()
+        with pytest.raises(WriteQueueFull):
+            queue.submit(_rating(2))
+        timings.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=submit) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Each waits its own timeout, not one behind the other
+    assert max(timings) < 0.4
+
+def test_close_flushes_queued_writes(make_queue):
+    db = FlakyDatabase()
+    queue = make_queue(db, max_delay=10)
+    queue.submit(_rating(1))
+    queue.close()
+
+    assert db.ratings() == [(1, 5)]
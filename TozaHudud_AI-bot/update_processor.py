@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Updates of different users processed at the same time. Every one of them may hold
+# a DB connection: keep it at most SQLITE_POOL_SIZE / PG_POOL_MAX_SIZE (and DB_EXECUTOR_WORKERS)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+# Updates of one user waiting behind the one being processed
+UPDATE_KEY_QUEUE_LIMIT = int(os.getenv("UPDATE_KEY_QUEUE_LIMIT", "20"))
+
+def update_key(update):
+    """Updates with the same key are processed in order: the user, else the chat."""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+class _KeyQueue:
+    __slots__ = ("pending", "space")
+
+    def __init__(self):
+        self.pending = deque()
+        self.space = asyncio.Event()
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently, each user's in order.
+
+    Every key (see update_key) with work is owned by one of ``workers``
+    worker tasks, which runs its updates one after another; so a user's
+    ConversationHandler state never sees two of their updates at once,
+    while a slow user no longer holds up everybody else.
+
+    PTB's own concurrency is kept at 1: the update fetcher waits here
+    until a worker is free (or the key's queue has room), so the bounded
+    update_queue still pushes back when the bot is saturated.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, key_queue_limit=UPDATE_KEY_QUEUE_LIMIT):
+        super().__init__(1)
+        self.workers = max(1, workers)
+        self.key_queue_limit = key_queue_limit
+        self._slots = asyncio.Semaphore(self.workers)
+        self._queues = {}  # key -> _KeyQueue of the key's worker
+        self._tasks = set()
+        self.processed = 0
+        self.max_key_depth = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        """Waits for the updates already accepted."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        queue = self._queues.get(key)
+        while queue is not None and len(queue.pending) >= self.key_queue_limit:
+            queue.space.clear()
+            await queue.space.wait()
+            queue = self._queues.get(key)
+        if queue is not None:
+            queue.pending.append(coroutine)
+            self.max_key_depth = max(self.max_key_depth, len(queue.pending))
+            return
+        # Only this method adds workers and PTB calls it one update at a time,
+        # so the key cannot get a worker while we wait for a slot
+        await self._slots.acquire()
+        queue = self._queues[key] = _KeyQueue()
+        queue.pending.append(coroutine)
+        task = asyncio.create_task(self._work(key, queue), name=f"update-worker:{key}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _work(self, key, queue):
+        try:
+            while queue.pending:
+                coroutine = queue.pending.popleft()
+                queue.space.set()
+                try:
+                    await coroutine
+                except Exception as e:
+                    logger.error(f"❌ Error processing update for {key}: {e}")
+                self.processed += 1
+        finally:
+            del self._queues[key]
+            queue.space.set()
+            self._slots.release()
+
+    def stats(self, top=5):
+        """Busy workers, waiting updates and the deepest per-user queues."""
+        depths = sorted(((key, len(q.pending)) for key, q in self._queues.items()), key=lambda item: -item[1])
+        return {
+            "workers": self.workers,
+            "busy": len(self._queues),
+            "waiting": sum(depth for _, depth in depths),
+            "deepest": [(key, depth) for key, depth in depths[:top] if depth],
+            "max_key_depth": self.max_key_depth,
+            "processed": self.processed,
+        }
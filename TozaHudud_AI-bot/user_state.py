@@ -0,0 +1,73 @@
+import sys
+from collections.abc import MutableMapping
+
+# context.user_data keys used by the bot; each gets a slot
+USER_STATE_FIELDS = ("name", "phone", "muammo", "media_type", "file_id", "delete_user_id", "delete_user_name")
+_FIELD_SET = frozenset(USER_STATE_FIELDS)
+
+class UserState(MutableMapping):
+    """context.user_data of one user: a slotted object with the dict interface.
+
+    A dict costs a few hundred bytes even when nearly empty; the known keys
+    here are plain slots (unset slot = missing key). Any other key goes to
+    a dict created on first use, so handlers are not limited to the fields.
+    """
+
+    __slots__ = USER_STATE_FIELDS + ("_extra",)
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        extra = getattr(self, "_extra", None)
+        if extra is None:
+            raise KeyError(key)
+        return extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+            return
+        extra = getattr(self, "_extra", None)
+        if extra is None:
+            extra = self._extra = {}
+        extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+            return
+        extra = getattr(self, "_extra", None)
+        if extra is None:
+            raise KeyError(key)
+        del extra[key]
+        if not extra:
+            del self._extra
+
+    def __iter__(self):
+        for field in USER_STATE_FIELDS:
+            if hasattr(self, field):
+                yield field
+        yield from getattr(self, "_extra", None) or ()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"UserState({dict(self)!r})"
+
+def user_data_size(user_data):
+    """Approximate bytes held by the user_data of all users (states and their values)."""
+    total = sys.getsizeof(user_data)
+    for state in user_data.values():
+        total += sys.getsizeof(state)
+        extra = getattr(state, "_extra", None)
+        if extra is not None:
+            total += sys.getsizeof(extra)
+        total += sum(sys.getsizeof(value) for value in state.values())
+    return total
@@ -0,0 +1,233 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Webhook mode is used when WEBHOOK_URL (the public HTTPS address of this bot) is set
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; a random one is used if unset
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Updates waiting to be processed; when full, Telegram is asked to redeliver later
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+MAX_BODY_SIZE = 1024 * 1024
+KEEPALIVE_TIMEOUT = 75
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    503: "Service Unavailable",
+}
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+class HttpServer:
+    """Small asyncio HTTP/1.1 server (keep-alive, Content-Length bodies only).
+
+    Enough for Telegram's webhook calls and internal endpoints, without
+    pulling in a web framework. Handlers are ``async def handler(request)``
+    returning ``(status, body_bytes, content_type)``.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._routes = {}  # (method, path) -> handler
+        self._server = None
+        self._connections = {}  # writer -> connection task
+
+    def route(self, method, path, handler):
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"🌐 HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        # Closing the sockets ends idle keep-alive connections with EOF
+        for writer in list(self._connections):
+            writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _serve(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request = await self._read_request(reader, writer)
+                if request is None:
+                    break
+                status, body, content_type = await self._dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, body, content_type, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"❌ HTTP connection error: {e}")
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+        except asyncio.IncompleteReadError:
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        if length > MAX_BODY_SIZE:
+            self._write_response(writer, 413, b"", "text/plain", keep_alive=False)
+            return None
+        body = await reader.readexactly(length) if length else b""
+        path, _, query = target.partition("?")
+        return Request(method, path, query, headers, body)
+
+    async def _dispatch(self, request):
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self._routes)
+            return (405 if known_path else 404), b"", "text/plain"
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"❌ Error handling {request.method} {request.path}: {e}")
+            return 503, b"", "text/plain"
+
+    @staticmethod
+    def _write_response(writer, status, body, content_type, keep_alive):
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+
+class WebhookReceiver:
+    """Accepts Telegram updates over HTTP and queues them for the Application.
+
+    The application's update_queue is bounded (UPDATE_QUEUE_SIZE): when it
+    is full the request is answered with 503 and Telegram redelivers the
+    update later, instead of the bot buffering without limit.
+    """
+
+    def __init__(self, application, secret_token):
+        self.application = application
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self.unauthorized = 0
+
+    async def handle(self, request):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            self.unauthorized += 1
+            return 403, b"", "text/plain"
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"⚠️ Invalid webhook payload: {e}")
+            return 400, b"", "text/plain"
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 503, b"", "text/plain"
+        self.received += 1
+        return 200, b"", "text/plain"
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "unauthorized": self.unauthorized,
+            "queued": self.application.update_queue.qsize(),
+            "queue_size": self.application.update_queue.maxsize,
+        }
+
+async def run_webhook(
+    application, url, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, secret_token=WEBHOOK_SECRET, server=None, stop=None
+):
+    """Runs the application in webhook mode until SIGINT/SIGTERM (or ``stop`` is set).
+
+    Mirrors Application.run_polling: post_init, post_stop and
+    post_shutdown are called at the same points.
+    """
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    path = urlsplit(url).path
+    if path in ("", "/"):
+        url, path = url.rstrip("/") + WEBHOOK_PATH, WEBHOOK_PATH
+    server = server or HttpServer(listen, port)
+    receiver = WebhookReceiver(application, secret_token)
+    server.route("POST", path, receiver.handle)
+    application.bot_data["webhook"] = receiver
+
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        await application.bot.set_webhook(
+            url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"🪝 Webhook set to {url}")
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
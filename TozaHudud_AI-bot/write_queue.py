@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class WriteQueueFull(Exception):
+    """Raised when the backlog stays full for longer than the submit timeout."""
+
+def _is_transient(error):
+    """SQLite errors that may go away on retry (another process holds the lock)."""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+class WriteQueue:
+    """Write-behind queue with a single writer thread and group commit.
+
+    Callers submit lists of ``(sql, params)`` statements. The writer thread
+    collects pending submissions until ``batch_size`` of them are queued or
+    ``max_delay`` seconds have passed, then runs them all in one
+    transaction, so a burst of taps costs one fsync instead of one each.
+
+    - ``durability="async"``: submit() returns as soon as the write is queued
+    - ``durability="sync"``: submit() waits until its batch is committed
+    - the backlog is bounded; a full queue blocks submitters for up to
+      ``submit_timeout`` seconds and then raises WriteQueueFull
+    - barrier() waits until everything queued so far is committed, so
+      reads can see rows that are still in the queue
+    - a transient error ("database is locked") is retried up to
+      ``max_retries`` times with exponential backoff; a failing batch is
+      then retried one write at a time, so one bad row does not sink the rest
+    - writes that still fail are appended to ``dead_letter_path`` (JSON
+      lines) instead of being dropped; start() queues them again
+    """
+
+    def __init__(self, connection, batch_size=200, max_delay=0.05, max_backlog=10000,
+                 submit_timeout=5.0, durability="async", on_commit=None,
+                 max_retries=3, retry_delay=0.1, dead_letter_path=None):
+        self.connection = connection
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max_delay
+        self.submit_timeout = submit_timeout
+        self.durability = durability
+        self.on_commit = on_commit
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.dead_letter_path = dead_letter_path
+
+        self._queue = queue.Queue(maxsize=max_backlog)
+        # Numbers submissions in queue order; waiting for space releases it
+        self._space = threading.Condition()
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._committed = 0
+        self._batches = 0
+        self._retried = 0
+        self._failed = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        self.requeue_dead_letters()
+
+    def requeue_dead_letters(self):
+        """Queues the writes saved in the dead-letter file again; returns how many."""
+        if not self.dead_letter_path:
+            return 0
+        # Writes that fail again are appended to a fresh file; a replay cut
+        # short by a crash is picked up first
+        replaying = f"{self.dead_letter_path}.replay"
+        count = 0
+        for path in (replaying, self.dead_letter_path):
+            if not os.path.exists(path):
+                continue
+            if path != replaying:
+                os.replace(path, replaying)
+            with open(replaying, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        statements = json.loads(line)["statements"]
+                        self.submit([(sql, tuple(params)) for sql, params in statements])
+                        count += 1
+            self.barrier()
+            os.remove(replaying)
+        if count:
+            logger.info("Requeued %s dead-lettered writes", count)
+        return count
+
+    def submit(self, statements):
+        """Queues statements to run together in the writer's next transaction."""
+        with self._space:
+            if not self._space.wait_for(self._has_space, self.submit_timeout):
+                raise WriteQueueFull(f"Write backlog is full ({self._queue.maxsize} pending)")
+            self._submitted += 1
+            seq = self._submitted
+            self._queue.put_nowait((seq, statements))
+        if self.durability == "sync":
+            self.wait_for(seq)
+        return seq
+
+    def _has_space(self):
+        return self._queue.maxsize <= 0 or self._queue.qsize() < self._queue.maxsize
+
+    def wait_for(self, seq, timeout=None):
+        """Blocks until submission ``seq`` has been committed."""
+        if threading.current_thread() is self._thread:
+            return True
+        with self._cond:
+            return self._cond.wait_for(lambda: self._committed >= seq, timeout)
+
+    def barrier(self, timeout=None):
+        """Blocks until every write submitted so far has been committed."""
+        seq = self._submitted
+        if seq <= self._committed:
+            return True
+        return self.wait_for(seq, timeout)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit(self, batch):
+        """Runs the batch in one transaction, retrying transient errors; returns the last error."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.connection() as conn:
+                    for _, statements in batch:
+                        for sql, params in statements:
+                            conn.execute(sql, params)
+                return None
+            except Exception as e:
+                if not _is_transient(e) or attempt == self.max_retries:
+                    return e
+                self._retried += 1
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning(f"⚠️ Group commit of {len(batch)} writes failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    def _write(self, batch):
+        error = self._commit(batch)
+        if error is None:
+            return
+        if len(batch) == 1:
+            self._dead_letter(batch[0][1], error)
+            return
+        # Retry one by one so a single bad row does not sink the whole batch
+        logger.warning(f"⚠️ Group commit of {len(batch)} writes failed ({error}), retrying individually")
+        for item in batch:
+            self._write([item])
+
+    def _dead_letter(self, statements, error):
+        self._failed += 1
+        entry = {
+            "failed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "error": str(error),
+            "statements": statements,
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        if self.dead_letter_path:
+            try:
+                with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                logger.error(f"❌ Queued write failed ({error}); saved to {self.dead_letter_path}")
+                return
+            except OSError as e:
+                logger.error(f"❌ Could not save failed write to {self.dead_letter_path}: {e}")
+        # Last resort: the log keeps the write so it can be replayed by hand
+        logger.error(f"❌ Queued write failed ({error}), not saved: {line}")
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch, stopping = self._collect(first)
+            with self._space:
+                self._space.notify_all()
+            self._write(batch)
+            with self._cond:
+                self._committed = batch[-1][0]
+                self._batches += 1
+                self._cond.notify_all()
+            if self.on_commit:
+                try:
+                    self.on_commit()
+                except Exception as e:
+                    logger.error(f"Error in write queue commit hook: {e}")
+
+    def close(self, timeout=None):
+        """Flushes everything still queued and stops the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        return {
+            "backlog": self._queue.qsize(),
+            "submitted": self._submitted,
+            "committed": self._committed,
+            "batches": self._batches,
+            "retried": self._retried,
+            "failed": self._failed,
+        }